@@ -0,0 +1,5 @@
+"""
+Performance benchmarks of ipwb, run offline against a stand-in of IPFS.
+
+    python -m benchmarks.indexing --help
+"""
@@ -0,0 +1,218 @@
+"""
+Throughput of indexing synthetic WARCs, offline.
+
+Each variant of storage (encryption, compression, ...) indexes the same
+WARC with index_file_at() in a process of its own, so its peak RSS is its
+own. IPFS is stood in for by hashing the content added to it, so only the
+work of ipwb is measured and no daemon is needed. The time spent in each
+stage of indexing is reported along with the records and bytes per second:
+
+    warc      reading the WARC records and writing the CDXJ
+    compress  zlib compression of the header and payload
+    encrypt   AES encryption of the header and payload
+    ipfs      adding to the IPFS stand-in
+
+    python -m benchmarks.indexing --records 1000 --json results.json
+"""
+
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from unittest.mock import patch
+
+from ipwb import frames, indexer
+from ipwb import __version__ as ipwb_version
+
+from . import synthetic
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+ENCRYPTION_KEY = 'ipwb-benchmark'
+
+VARIANTS = {
+    'plain': {},
+    'compressed': {'compression_level': 6},
+    'framed': {'compression_level': 6, 'frame_size': frames.FRAME_SIZE},
+    'encrypted': {'encryption_key': ENCRYPTION_KEY},
+    'encrypted-compressed': {'encryption_key': ENCRYPTION_KEY,
+                             'compression_level': 6},
+    'compressed-encrypted': {'encryption_key': ENCRYPTION_KEY,
+                             'compression_level': 6,
+                             'encrypt_THEN_compress': False}
+}
+
+STAGES = ('warc', 'compress', 'encrypt', 'ipfs')
+
+
+class OfflineIPFS:
+    """Stands in for the IPFS daemon, addressing content by its SHA-256"""
+
+    def __init__(self):
+        self.added_bytes = 0
+
+    def add_bytes(self, content):
+        self.added_bytes += len(content)
+        return hashlib.sha256(content).hexdigest()
+
+
+class StageTimer:
+    """Accumulates the time spent in functions of a module"""
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+
+    def timed(self, stage, f):
+        def timed_f(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.seconds[stage] += time.perf_counter() - start
+
+        return timed_f
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes, if available"""
+    if resource is None:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':  # In bytes rather than kilobytes
+        return max_rss
+
+    return max_rss * 1024
+
+
+def index_offline(warc_path, variant):
+    """Index a WARC with a variant of storage, returns its measurements"""
+    ipfs = OfflineIPFS()
+    timer = StageTimer()
+
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stderr(devnull), \
+            patch.object(indexer, 'push_bytes_to_ipfs',
+                         timer.timed('ipfs', ipfs.add_bytes)), \
+            patch.object(indexer, 'compress',
+                         timer.timed('compress', indexer.compress)), \
+            patch.object(indexer, 'encrypt',
+                         timer.timed('encrypt', indexer.encrypt)):
+        start = time.perf_counter()
+        cdxj_lines = indexer.index_file_at(warc_path, quiet=True,
+                                           **VARIANTS[variant])
+        seconds = time.perf_counter() - start
+
+    stages = timer.seconds
+    stages['warc'] = seconds - sum(stages.values())
+    records = sum(1 for line in cdxj_lines if not line.startswith('!'))
+
+    return {
+        'variant': variant,
+        'records': records,
+        'seconds': seconds,
+        'records_per_second': records / seconds,
+        'bytes_per_second': os.path.getsize(warc_path) / seconds,
+        'ipfs_bytes': ipfs.added_bytes,
+        'peak_rss': peak_rss(),
+        'stages': stages
+    }
+
+
+def run(warc_path, variants):
+    results = []
+    for variant in variants:
+        # A fresh process for the peak RSS of each variant to be its own
+        with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as pool:
+            results.append(
+                pool.submit(index_offline, warc_path, variant).result())
+
+    return results
+
+
+def format_results(results):
+    columns = ('variant', 'records/s', 'MB/s', 'IPFS MB', 'peak RSS MB') + \
+        tuple(f'{stage} s' for stage in STAGES)
+    rows = [columns]
+    for result in results:
+        peak = result['peak_rss']
+        rows.append((
+            result['variant'],
+            f"{result['records_per_second']:.1f}",
+            f"{result['bytes_per_second'] / 2 ** 20:.2f}",
+            f"{result['ipfs_bytes'] / 2 ** 20:.2f}",
+            'n/a' if peak is None else f'{peak / 2 ** 20:.1f}'
+        ) + tuple(f"{result['stages'][stage]:.3f}" for stage in STAGES))
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return '\n'.join(
+        '  '.join(cell.ljust(width)
+                  for (cell, width) in zip(row, widths)).rstrip()
+        for row in rows)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.indexing',
+        description='Benchmark indexing synthetic WARCs, offline')
+    parser.add_argument('--records', type=int, default=1000,
+                        help='Number of response records in the WARC')
+    parser.add_argument('--size', type=int, default=16 * 1024,
+                        help='Median size of the payloads in bytes')
+    parser.add_argument('--distribution', default='lognormal',
+                        choices=synthetic.SIZE_DISTRIBUTIONS,
+                        help='Distribution of the sizes of the payloads')
+    parser.add_argument('--html-ratio', type=float, default=0.5,
+                        dest='html_ratio',
+                        help='Ratio of the payloads that are HTML pages')
+    parser.add_argument('--gzip', action='store_true', default=False,
+                        help='Compress the records of the WARC with gzip')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--variant', action='append', dest='variants',
+                        choices=VARIANTS,
+                        help='Variants of storage to run, all by default')
+    parser.add_argument('--json', metavar='PATH',
+                        help='Write the results to a JSON file as well')
+    args = parser.parse_args(args)
+
+    parameters = {k: v for (k, v) in vars(args).items()
+                  if k not in ('variants', 'json')}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        warc_path = os.path.join(tmp_dir, 'synthetic.warc')
+        if args.gzip:
+            warc_path += '.gz'
+
+        start = time.perf_counter()
+        payload_bytes = synthetic.generate_warc(
+            warc_path, args.records, args.size, args.distribution,
+            args.html_ratio, args.gzip, args.seed)
+        print((f'Generated {args.records} records, '
+               f'{payload_bytes / 2 ** 20:.1f} MB of payloads, '
+               f'{os.path.getsize(warc_path) / 2 ** 20:.1f} MB WARC in '
+               f'{time.perf_counter() - start:.1f}s'))
+
+        results = run(warc_path, args.variants or list(VARIANTS))
+
+    print(format_results(results))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'ipwb_version': ipwb_version,
+                       'python': platform.python_version(),
+                       'parameters': parameters,
+                       'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
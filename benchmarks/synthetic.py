@@ -0,0 +1,91 @@
+"""
+Generation of synthetic WARCs of a controllable scale for the benchmarks.
+
+The records are deterministic for a given seed: HTML pages of random words,
+which compress like text, and JPEG-typed random bytes, which do not.
+"""
+
+import math
+import random
+from io import BytesIO
+
+from warcio.statusandheaders import StatusAndHeaders
+from warcio.warcwriter import WARCWriter
+
+SIZE_DISTRIBUTIONS = ('fixed', 'lognormal')
+
+# A lognormal distribution of this sigma spans sizes from about a tenth of
+# the median to ten times it, like the resources of a crawl
+LOGNORMAL_SIGMA = 1.0
+
+WORDS = ('memento', 'archive', 'wayback', 'interplanetary', 'web', 'ipfs',
+         'replay', 'index', 'crawl', 'record', 'payload', 'header', 'the',
+         'of', 'and', 'to', 'in', 'is', 'a', 'for')
+
+
+def payload_sizes(records, size, distribution='fixed', seed=0):
+    """The payload size of each record, size being the median one"""
+    if distribution not in SIZE_DISTRIBUTIONS:
+        raise ValueError(f'Unknown size distribution: {distribution}')
+
+    rng = random.Random(seed)
+    for _ in range(records):
+        if distribution == 'fixed':
+            yield size
+        else:
+            yield max(1, int(rng.lognormvariate(math.log(size),
+                                                LOGNORMAL_SIGMA)))
+
+
+def html_payload(rng, size):
+    page = (b'<html><head><title>Page</title></head>'
+            b'<body><p>%s</p></body></html>')
+
+    words = []
+    length = len(page) - 2
+    while length < size:
+        words.append(rng.choice(WORDS))
+        length += len(words[-1]) + 1
+
+    return page % ' '.join(words).encode()
+
+
+def binary_payload(rng, size):
+    return rng.getrandbits(8 * size).to_bytes(size, 'little')
+
+
+def generate_warc(path, records=1000, size=16 * 1024,
+                  distribution='fixed', html_ratio=0.5, gzip=False, seed=0):
+    """
+    Write a WARC of response records to path, with payloads of a median
+    size and a ratio of them HTML pages, returns the bytes of payloads
+    """
+    rng = random.Random(seed)
+    payload_bytes = 0
+
+    with open(path, 'wb') as warc:
+        writer = WARCWriter(warc, gzip=gzip)
+        sizes = payload_sizes(records, size, distribution, seed)
+        for (i, payload_size) in enumerate(sizes):
+            if rng.random() < html_ratio:
+                (mime, payload) = ('text/html',
+                                   html_payload(rng, payload_size))
+            else:
+                (mime, payload) = ('image/jpeg',
+                                   binary_payload(rng, payload_size))
+            payload_bytes += len(payload)
+
+            http_headers = StatusAndHeaders(
+                '200 OK', [('Content-Type', mime),
+                           ('Content-Length', str(len(payload)))],
+                protocol='HTTP/1.1')
+            (minutes, seconds) = divmod(i % 3600, 60)
+            record = writer.create_warc_record(
+                f'http://example.com/{i // 3600}/{i}', 'response',
+                payload=BytesIO(payload), http_headers=http_headers,
+                warc_headers_dict={
+                    'WARC-Date': f'2020-01-01T00:{minutes:02}:{seconds:02}Z'
+                })
+            writer.write_record(record)
+
+    return payload_bytes
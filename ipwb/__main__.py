@@ -1,12 +1,11 @@
 import argparse
 import os
-import random  # For generating a temp file for stdin
-import string  # For generating a temp file for stdin
 import sys
 import tempfile
 
-# ipwb modules
-from ipwb import settings, replay, indexer, util
+# ipwb modules, the ones of the commands are imported by the commands for
+# ipwb to start fast, see checkArgs_index() and checkArgs_replay()
+from ipwb import settings
 from ipwb.error_handler import exception_logger
 from .__init__ import __version__ as ipwb_version
 
@@ -17,49 +16,66 @@ def main():
 
 
 def checkArgs_index(args):
+    from ipwb import indexer, util
+
     util.check_daemon_is_alive()
 
     encKey = None
     compression_level = None
     if args.e:
         encKey = ''
-    if args.c:
+    if args.c or args.frames:
         compression_level = 6  # Magic 6, TA-DA!
 
+    frame_size = None
+    if args.frames:
+        from ipwb import frames
+        frame_size = frames.FRAME_SIZE
+
     indexer.index_file_at(args.warc_path, encKey, compression_level,
-                          args.compressFirst, outfile=args.outfile,
-                          debug=args.debug)
+                          not args.compressFirst, outfile=args.outfile,
+                          debug=args.debug,
+                          inline_headers=args.inline_headers,
+                          zipnum=args.zipnum, frame_size=frame_size,
+                          stream=args.stream, compact=args.compact)
 
 
 def checkArgs_replay(args):
-    supplied_index_parameter = hasattr(args, 'index') and \
-                               args.index is not None
+    from ipwb import replay
+
+    supplied_index_parameter = hasattr(args, 'index') and bool(args.index)
     likely_piping = not sys.stdin.isatty()
 
     if not supplied_index_parameter and likely_piping:
-        cdxjIn = ''.join(sys.stdin.readlines())
-        if len(cdxjIn) == 0:  # Daemon was not running, so nothing was indexed
-            print(('ERROR: The IPFS daemon must be running to pipe input from'
-                  ' the indexer to the replay system.'))
-            sys.exit()
-
-        random.seed()
-        # Write data to temp file (sub-optimal)
+        from ipwb import jobs
 
-        fh, args.index = tempfile.mkstemp(suffix='.cdxj')
+        # Replay starts right away, the piped records are added to the
+        # index as the indexer writes them
+        fh, index_path = tempfile.mkstemp(suffix='.cdxj')
         os.close(fh)
-        with open(args.index, 'w') as f:
-            f.write(cdxjIn)
+        jobs.start_stream_ingestion(sys.stdin, index_path)
 
+        args.index = [index_path]
         supplied_index_parameter = True
 
+    if supplied_index_parameter and len(args.index) == 1:
+        args.index = args.index[0]
+
     proxy = None
     if hasattr(args, 'proxy') and args.proxy is not None:
         print(f'Proxying to {args.proxy}')
         proxy = args.proxy
 
     # TODO: add any other sub-arguments for replay here
-    if supplied_index_parameter:
+    if supplied_index_parameter and args.use_async:
+        from ipwb import replay_async
+        replay_async.start(cdxj_file_path=args.index, proxy=proxy)
+    elif supplied_index_parameter and (args.workers or args.threads):
+        from ipwb import replay_workers
+        replay_workers.start(cdxj_file_path=args.index, proxy=proxy,
+                             workers=args.workers or 1,
+                             threads=args.threads or 1)
+    elif supplied_index_parameter:
         replay.start(cdxj_file_path=args.index, proxy=proxy)
     else:
         print('ERROR: An index file must be specified if not piping, e.g.,')
@@ -70,6 +86,12 @@ def checkArgs_replay(args):
         sys.exit()
 
 
+def check_for_update(args):
+    from ipwb import util
+
+    util.check_for_update(args)
+
+
 def checkArgs(argsIn):
     """
     Check to ensure valid arguments were passed in and provides guidance
@@ -103,6 +125,12 @@ def checkArgs(argsIn):
         help='Compress WARC content prior to adding to IPFS',
         action='store_true',
         default=False)
+    indexParser.add_argument(
+        '--frames',
+        help=('Compress WARC content in frames decompressed independently, '
+              'for parts of it to be replayed alone (implies -c)'),
+        action='store_true',
+        default=False)
     indexParser.add_argument(
         '--compressFirst',
         help='Compress data before encryption, where applicable',
@@ -112,6 +140,30 @@ def checkArgs(argsIn):
         '-o', '--outfile',
         help='Path to an output CDXJ file, defaults to STDOUT',
         default=None)
+    indexParser.add_argument(
+        '--inline-headers',
+        help='Store the parsed HTTP headers in the CDXJ for faster replay',
+        action='store_true',
+        default=False,
+        dest='inline_headers')
+    indexParser.add_argument(
+        '--zipnum',
+        help=('Compress the CDXJ in blocks with a summary index for replay, '
+              'written to <outfile>.idx'),
+        action='store_true',
+        default=False)
+    indexParser.add_argument(
+        '--stream',
+        help=('Write each record to STDOUT as soon as indexed, unsorted, '
+              'e.g., to pipe into ipwb replay'),
+        action='store_true',
+        default=False)
+    indexParser.add_argument(
+        '--compact',
+        help=('Merge the records added to an existing outfile into it '
+              'rather than next to it, e.g., to share the outfile alone'),
+        action='store_true',
+        default=False)
     indexParser.add_argument(
         '--debug',
         help='Convenience flag to help with testing and debugging',
@@ -126,13 +178,32 @@ def checkArgs(argsIn):
         help="Start the ipwb replay system")
     replayParser.add_argument(
         'index',
-        help='path, URI, or multihash of file to use for replay',
-        nargs='?')
+        help=('path, URI, or multihash of file to use for replay, many '
+              'indexes are replayed as one'),
+        nargs='*')
     replayParser.add_argument(
         '-P', '--proxy',
         help='Proxy URL',
         metavar='<host:port>',
         nargs='?')
+    replayParser.add_argument(
+        '--async',
+        help='Serve on an asyncio server with non-blocking IPFS fetches',
+        action='store_true',
+        default=False,
+        dest='use_async')
+    replayParser.add_argument(
+        '--workers',
+        help='Number of pre-forked worker processes serving the replay',
+        metavar='N',
+        type=int,
+        default=None)
+    replayParser.add_argument(
+        '--threads',
+        help='Number of threads per worker process',
+        metavar='M',
+        type=int,
+        default=None)
     replayParser.set_defaults(func=checkArgs_replay,
                               onError=replayParser.print_help)
 
@@ -140,7 +211,7 @@ def checkArgs(argsIn):
         '-d', '--daemon',
         help=("Multi-address of IPFS daemon "
               "(default /dns/localhost/tcp/5001/http)"),
-        default=util.IPFSAPI_MUTLIADDRESS,
+        default='/dns/localhost/tcp/5001/http',  # util.IPFSAPI_MUTLIADDRESS
         dest='daemon_address')
     parser.add_argument(
         '-v', '--version', help='Report the version of ipwb', action='version',
@@ -150,7 +221,7 @@ def checkArgs(argsIn):
         action='store_true',
         help='Check whether an updated version of ipwb is available'
         )
-    parser.set_defaults(func=util.check_for_update)
+    parser.set_defaults(func=check_for_update)
 
     argCount = len(argsIn)
     cmdList = ['index', 'replay']
@@ -1,4 +1,11 @@
-/* global uris */
+// Number of URI-Rs fetched from the listing API at once
+const URIS_PAGE_SIZE = 100
+
+// Cursor of the next page of the URI listing, null once all are fetched
+let urisCursor = null
+
+// The page of the URI listing being fetched, null when none is
+let urisPageLoading = null
 
 function handleSubmit () { // eslint-disable-line no-unused-vars
   const val = document.getElementById('url').value
@@ -7,10 +14,6 @@ function handleSubmit () { // eslint-disable-line no-unused-vars
   }
 }
 
-function shortestFirst (a, b) {
-  return a.replace(/\/+$/, '').split('/').length - b.replace(/\/+$/, '').split('/').length
-}
-
 function hideURIs () {
   document.getElementById('uris').classList.add('hidden')
   document.getElementById('memCountListLink').classList.remove('activated')
@@ -21,18 +24,59 @@ function splitDatetime (datetime) {
   return datetime.replace(/(\d{4})(\d{2})(\d{2})(\d{2})(\d{2})(\d{2})/, '$1-$2-$3 $4:$5:$6')
 }
 
-function addURIListToDOM () {
+function fetchURIsPage (cursor) {
+  let address = '/ipwbapi/uris?limit=' + URIS_PAGE_SIZE
+  if (cursor) {
+    address += '&cursor=' + encodeURIComponent(cursor)
+  }
+
+  return window.fetch(address)
+    .then(function (resp) {
+      if (!resp.ok) {
+        throw new Error('Fetching the URI listing failed: ' + resp.status)
+      }
+      return resp.json()
+    })
+}
+
+function addURIsPageToDOM () {
+  if (urisPageLoading) { // The page would otherwise be added twice
+    return urisPageLoading
+  }
+
+  const moreButton = document.getElementById('moreURIs')
+  moreButton.setAttribute('disabled', 'disabled')
+
+  urisPageLoading = fetchURIsPage(urisCursor).then(function (page) {
+    addURIListToDOM(page.uris)
+
+    urisCursor = page.cursor
+    if (urisCursor) {
+      moreButton.classList.remove('hidden')
+    } else {
+      moreButton.classList.add('hidden')
+    }
+  }).catch(function (err) {
+    console.log(err)
+  }).then(function () {
+    moreButton.removeAttribute('disabled')
+    urisPageLoading = null
+  })
+
+  return urisPageLoading
+}
+
+function addURIListToDOM (urisPage) {
   const ul = document.getElementById('uriList')
-  const uriKeys = Object.keys(uris).sort(shortestFirst)
 
-  uriKeys.forEach(urir => {
-    uris[urir].forEach(function (memento) {
+  urisPage.forEach(function (urir) {
+    urir.mementos.forEach(function (memento) {
       const li = document.createElement('li')
       const a = document.createElement('a')
       const dt = document.createElement('span')
-      const title = memento.title || urir
+      const title = memento.title || urir.uri
 
-      a.href = 'memento/' + memento.datetime + '/' + urir
+      a.href = 'memento/' + memento.datetime + '/' + urir.uri
       a.appendChild(document.createTextNode(title))
       a.title = title
 
@@ -59,27 +103,33 @@ function addURIListToDOM () {
 }
 
 function showURIs () {
+  let urisLoaded = Promise.resolve()
   if (document.getElementById('uriList').childNodes.length === 0) {
-    addURIListToDOM() // Prevent multiple adds of the URI list to the DOM
+    urisLoaded = addURIsPageToDOM() // Prevent multiple adds of the URI list to the DOM
   }
 
   document.getElementById('memCountListLink').className = ['activated']
   document.getElementById('uris').classList.remove('hidden')
-  setPlurality()
-  setShowAllButtonStatus()
+  urisLoaded.then(function () {
+    setPlurality()
+    setShowAllButtonStatus()
+  })
 
-  setUIExpandedState(uris)
+  setUIExpandedState()
   // Maintain visible state of URI display for future retrieval
   window.localStorage.setItem('showURIs', 'true')
 }
 
-function setUIExpandedState (urisObj) {
-  const urisHash = calculateURIsHash(urisObj)
-  setURIsHash(urisHash)
+function setUIExpandedState () {
+  setURIsHash(calculateURIsHash())
 }
 
-function calculateURIsHash (urisObj) {
-  return getStringHashCode(JSON.stringify(urisObj))
+function calculateURIsHash () {
+  // The listing is not in the page anymore, the collection is identified
+  // by its summary instead
+  const summary = document.getElementById('memCountInt').innerHTML + ' ' +
+    document.getElementById('htmlCountHeader').textContent
+  return getStringHashCode(summary)
 }
 
 function getURIsHash () {
@@ -94,11 +144,11 @@ function getStringHashCode (str) {
   let hash = 0
   let i
   let chr
-  if (this.length === 0) {
+  if (str.length === 0) {
     return hash
   }
-  for (i = 0; i < this.length; i++) {
-    chr = this.charCodeAt(i)
+  for (i = 0; i < str.length; i++) {
+    chr = str.charCodeAt(i)
     hash = ((hash << 5) - hash) + chr
     hash |= 0 // Convert to 32bit integer
   }
@@ -117,6 +167,10 @@ function addEventListeners () { // eslint-disable-line no-unused-vars
   const target = document.getElementById('memCountListLink')
   target.addEventListener('click', toggleURIDisplay, false)
 
+  document.getElementById('moreURIs').onclick = function showMoreURIs () {
+    addURIsPageToDOM() // Ignored while a page is being fetched
+  }
+
   const showAllInListingButton = document.getElementById('showEmbeddedURI')
   showAllInListingButton.onclick = function showAllURIs () {
     const uriList = document.getElementById('uriList')
@@ -140,7 +194,7 @@ function addEventListeners () { // eslint-disable-line no-unused-vars
 
 function setShowURIsVisibility () {
   const previousHash = getURIsHash() + ''
-  const newHash = calculateURIsHash(uris) + ''
+  const newHash = calculateURIsHash() + ''
 
   if (window.localStorage.getItem('showURIs') && previousHash === newHash) {
     showURIs()
@@ -1,5 +1,20 @@
+import contextlib
 import dataclasses
-from typing import Optional
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import os
+import struct
+import tempfile
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 from urllib.parse import urlparse
 
 import ipfshttpclient
@@ -7,6 +22,54 @@ import requests
 
 from ipwb import util
 
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+
+# Kinds of URI-R lookups, as in the CDX server API
+MATCH_TYPES = ('exact', 'prefix', 'host', 'domain')
+
+# Records added to a local index are appended to a delta file next to it,
+# compacted into the index once larger than this fraction of the index
+DELTA_SUFFIX = '.delta'
+COMPACTION_RATIO = 0.1
+# Writers of a local index take a lock on this file next to it
+LOCK_SUFFIX = '.lock'
+
+# Number of indexes of a federation loaded at once
+MAX_INDEX_LOADERS = 8
+
+# Remote indexes are kept on disk here, the ones on the Web are checked for
+# changes at most this often, in seconds
+INDEX_CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME',
+                   os.path.join(os.path.expanduser('~'), '.cache')),
+    'ipwb', 'indexes')
+WEB_INDEX_REFRESH_INTERVAL = 60
+
+# Indexes on the Web larger than this, in bytes, are searched in place with
+# Range requests instead of being downloaded, reading blocks of this size
+WEB_INDEX_DOWNLOAD_LIMIT = 64 * 1024 * 1024
+REMOTE_INDEX_BLOCK_SIZE = 16 * 1024
+REMOTE_INDEX_MAX_BLOCKS = 1024
+
+# Indexes compressed in blocks have a summary of the first record and
+# location of every block, given to the replay system, next to the blocks
+ZIPNUM_SUMMARY_SUFFIX = '.idx'
+ZIPNUM_BLOCKS_SUFFIX = '.gz'
+ZIPNUM_BLOCK_LINES = 3000
+ZIPNUM_MAX_BLOCKS = 64
+# A summary is read again while its blocks are being replaced
+ZIPNUM_OPEN_ATTEMPTS = 50
+ZIPNUM_OPEN_RETRY_INTERVAL = 0.05
+
+# The Bloom filters of the SURTs of an index answer that a SURT is in the
+# index when it is not at most this often
+BLOOM_SUFFIX = '.bloom'
+BLOOM_FALSE_POSITIVE_RATE = 0.01
+
 
 @dataclasses.dataclass(frozen=True)
 class BackendError(Exception):
@@ -70,10 +133,8 @@ def get_web_archive_index(path: str) -> str:
     Based on path, choose appropriate backend and fetch the file contents.
     """
 
-    # TODO right now, every backend is just a function which returns contents
-    #   of a CDXJ file as string. In the future, however, backends will be
-    #   probably represented as classes with much more sophisticated methods
-    #   of manipulating the archive index records.
+    # The replay system loads indexes through the IndexBackend classes
+    #   instead, which cache remote indexes, see get_backend().
     # TODO also, it will be possible to choose a backend and configure it;
     #   whereas right now we choose a backend automatically based on the given
     #   path itself.
@@ -97,3 +158,1180 @@ def get_web_archive_index(path: str) -> str:
         f'Unknown format of index file location: {path}. Please provide '
         f'a valid local path, HTTP or FTP URL, or an IPFS QmHash.'
     ))
+
+
+class IndexBackend:
+    """
+    Where an index is read from.
+
+    `signature()` identifies the version of the index, the index is read
+    again with `read()` only once its signature changed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def signature(self) -> Optional[tuple]:
+        raise NotImplementedError
+
+    def read(self) -> str:
+        raise NotImplementedError
+
+    def read_delta(self) -> Optional[List[str]]:
+        """Records added to the index since it was written, if any."""
+        return None
+
+    def in_place_index(self):
+        """The index searched where it is stored rather than in memory."""
+        return None
+
+
+class LocalIndexBackend(IndexBackend):
+    """An index file on local disk, with its delta file."""
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.zipnum = None
+        self.lock = threading.Lock()
+
+    def signature(self) -> Optional[tuple]:
+        signature = _index_signature(self.path)
+        if signature is not None:
+            signature = (signature, _index_signature(delta_path(self.path)))
+
+        return signature
+
+    def read(self) -> str:
+        return fetch_local_index(self.path)
+
+    def in_place_index(self):
+        """Indexes compressed in blocks are searched in place."""
+        if not is_zipnum_index(self.path):
+            return None
+
+        signature = self.signature()
+        with self.lock:
+            if self.zipnum is None or self.zipnum[0] != signature:
+                self.zipnum = (signature, ZipNumIndex(self.path))
+
+            return self.zipnum[1]
+
+    def read_delta(self) -> Optional[List[str]]:
+        try:
+            with open(delta_path(self.path), 'r') as f:
+                return list(_read_records(_complete_lines(f)))
+        except FileNotFoundError:
+            return None
+
+
+class IPFSIndexBackend(IndexBackend):
+    """An index in IPFS, kept on disk forever as its content never changes."""
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        self.cid = format_ipfs_cid(path)
+
+    def signature(self) -> Optional[tuple]:
+        return (('ipfs', self.cid), None)
+
+    def read(self) -> str:
+        cache_path = os.path.join(INDEX_CACHE_DIR, f'{self.cid}.cdxj')
+        if os.path.exists(cache_path):
+            return fetch_local_index(cache_path)
+
+        content = fetch_ipfs_index(self.cid)
+        _write_cache(cache_path, content)
+
+        return content
+
+
+class WebIndexBackend(IndexBackend):
+    """
+    An index on the Web, kept on disk and revalidated with conditional
+    requests at most every WEB_INDEX_REFRESH_INTERVAL seconds.
+    """
+
+    def __init__(self, path: str):
+        super().__init__(path)
+        name = hashlib.sha256(path.encode('utf-8')).hexdigest()
+        self.cache_path = os.path.join(INDEX_CACHE_DIR, f'{name}.cdxj')
+        self.validators_path = os.path.join(INDEX_CACHE_DIR, f'{name}.json')
+        self.checked_at = None
+        self.lock = threading.Lock()
+        self.searched_in_place = None
+        self.remote = None
+
+    def validators(self) -> dict:
+        try:
+            with open(self.validators_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def signature(self) -> Optional[tuple]:
+        with self.lock:
+            if self.checked_at is None or time.monotonic() - \
+                    self.checked_at >= WEB_INDEX_REFRESH_INTERVAL:
+                self.refresh()
+                self.checked_at = time.monotonic()
+
+        return (('web', self.validators().get('version')), None)
+
+    def refresh(self):
+        """Download the index again, unless the copy on disk is current."""
+        validators = {}
+        if os.path.exists(self.cache_path):
+            validators = self.validators()
+
+        headers = {}
+        if 'etag' in validators:
+            headers['If-None-Match'] = validators['etag']
+        if 'last_modified' in validators:
+            headers['If-Modified-Since'] = validators['last_modified']
+
+        try:
+            response = requests.get(self.path, headers=headers)
+            response.raise_for_status()
+        except (requests.ConnectionError, requests.HTTPError) as err:
+            if validators:
+                print(f'Refreshing the index at {self.path} failed, '
+                      f'using the copy from {self.cache_path}: {err}')
+                return
+            raise BackendError(backend_name='web') from err
+
+        if response.status_code == 304:
+            return
+
+        content = response.text
+        validators = {
+            'version': hashlib.sha256(content.encode('utf-8')).hexdigest()
+        }
+        if 'ETag' in response.headers:
+            validators['etag'] = response.headers['ETag']
+        if 'Last-Modified' in response.headers:
+            validators['last_modified'] = response.headers['Last-Modified']
+
+        _write_cache(self.cache_path, content)
+        _write_cache(self.validators_path, json.dumps(validators))
+
+    def read(self) -> str:
+        return fetch_local_index(self.cache_path)
+
+    def in_place_index(self):
+        """
+        Indexes larger than WEB_INDEX_DOWNLOAD_LIMIT are searched with
+        Range requests when the server supports them, decided once.
+        """
+        with self.lock:
+            if self.searched_in_place is None:
+                self.searched_in_place = self.supports_ranges()
+                if self.searched_in_place:
+                    self.remote = RemoteCDXJIndex(self.path)
+
+        return self.remote
+
+    def supports_ranges(self) -> bool:
+        try:
+            response = requests.head(self.path, allow_redirects=True)
+            response.raise_for_status()
+        except (requests.ConnectionError, requests.HTTPError):
+            return False  # Downloading it reports the error
+
+        size = int(response.headers.get('Content-Length') or 0)
+
+        return response.headers.get('Accept-Ranges') == 'bytes' and \
+            size > WEB_INDEX_DOWNLOAD_LIMIT
+
+
+_backends: Dict[str, IndexBackend] = {}
+
+
+def get_backend(path: str) -> IndexBackend:
+    """
+    The backend of an index, chosen from its path as by
+    get_web_archive_index() and kept to reuse what it cached.
+    """
+    backend = _backends.get(path)
+    if backend is None:
+        if format_ipfs_cid(path) is not None:
+            backend = IPFSIndexBackend(path)
+        elif urlparse(path).scheme:
+            backend = WebIndexBackend(path)
+        else:
+            backend = LocalIndexBackend(path)
+        backend = _backends.setdefault(path, backend)
+
+    return backend
+
+
+def _write_cache(path: str, content: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _write_lines(path, [content.rstrip('\n')])
+
+
+class CDXJIndex:
+    """
+    Sorted, in-memory view of the records of a CDXJ index.
+
+    Lookups bisect lists of SURT keys that are built once when the index is
+    loaded, instead of re-reading and re-splitting the index per request.
+    Nothing is mutated after construction, so an index loaded before forking
+    is shared by worker processes.
+    """
+
+    def __init__(self, content: str):
+        self.metadata: List[str] = []
+        self.lines: List[str] = []
+
+        for line in content.split('\n'):
+            if not line.strip():
+                continue
+            if line[:1] == '!':
+                self.metadata.append(line)
+            else:
+                self.lines.append(line)
+
+        self.keys = [' '.join(line.split(' ', 2)[:2]) for line in self.lines]
+        self.surts = [key.split(' ', 1)[0] for key in self.keys]
+
+        self._summary = None
+
+    def __len__(self):
+        return len(self.lines)
+
+    def find(self, needle: str, only_uri: bool = False) -> Optional[int]:
+        """Position of the record with a `surt datetime` key (or a SURT)."""
+        keys = self.surts if only_uri else self.keys
+        pos = bisect_left(keys, needle)
+
+        if pos != len(keys) and keys[pos] == needle:
+            return pos
+        return None
+
+    def get_summary(self) -> dict:
+        """
+        Aggregate statistics of the mementos in the index.
+
+        Computed in a single pass on first use and kept with the index, so
+        it is served from memory until the index is reloaded.
+        """
+        if self._summary is not None:
+            return self._summary
+
+        summary = _new_summary()
+        for line in self.lines:
+            _add_to_summary(summary, line)
+
+        self._summary = summary
+        return summary
+
+    def merged(self, new_lines: List[str]) -> 'CDXJIndex':
+        """
+        A new index with the records of this one and some new records.
+
+        The sorted lists are spliced instead of parsing every record again
+        and the summary, if already computed, is updated with the new
+        records only. This index is left untouched for concurrent readers.
+        """
+        index = CDXJIndex('')
+        index.metadata = list(self.metadata)
+
+        added = []
+        prev = 0
+        for line in sorted(set(new_lines)):
+            pos = bisect_left(self.lines, line, prev)
+            if pos < len(self.lines) and self.lines[pos] == line:
+                continue  # Already in the index
+
+            key = ' '.join(line.split(' ', 2)[:2])
+            index.lines += self.lines[prev:pos] + [line]
+            index.keys += self.keys[prev:pos] + [key]
+            index.surts += self.surts[prev:pos] + [key.split(' ', 1)[0]]
+            added.append(line)
+            prev = pos
+
+        index.lines += self.lines[prev:]
+        index.keys += self.keys[prev:]
+        index.surts += self.surts[prev:]
+
+        if self._summary is not None:
+            summary = dict(self._summary)
+            summary['surt_uris'] = dict(summary['surt_uris'])
+            for line in added:
+                _add_to_summary(summary, line)
+            index._summary = summary
+
+        return index
+
+    def surt_range(self, surt_prefix: str = '',
+                   start_after: Optional[str] = None) -> Tuple[int, int]:
+        """Positions of the records whose SURT starts with a prefix."""
+        start = bisect_left(self.surts, surt_prefix)
+        if start_after is not None:
+            start = max(start, bisect_right(self.surts, start_after))
+
+        end = len(self.surts)
+        if surt_prefix:
+            # The smallest string greater than all strings with the prefix
+            prefix_end = surt_prefix[:-1] + chr(ord(surt_prefix[-1]) + 1)
+            end = bisect_left(self.surts, prefix_end, start)
+
+        return (start, max(start, end))
+
+    def match_ranges(self, surt_uri: str,
+                     match_type: str = 'exact') -> List[Tuple[int, int]]:
+        """
+        Positions of the records matching a SURT URI, in SURT order.
+
+        `prefix` matches the SURT URIs starting with `surt_uri`, `host` all
+        the URIs of its host and `domain` those of its host and subdomains.
+        """
+        if match_type == 'exact':
+            start = bisect_left(self.surts, surt_uri)
+            return [(start, bisect_right(self.surts, surt_uri, start))]
+        if match_type == 'prefix':
+            return [self.surt_range(surt_uri)]
+
+        host = surt_uri.split(')', 1)[0]
+        if match_type == 'host':
+            return [self.surt_range(f'{host})')]
+        if match_type == 'domain':
+            # The subdomains of com,example) are com,example,*) and sort
+            # right after it
+            return [self.surt_range(f'{host})'), self.surt_range(f'{host},')]
+
+        raise ValueError(f'Unknown match type: {match_type}')
+
+    def iter_ranges(self, ranges: List[Tuple[int, int]]) -> Iterator[str]:
+        """Lazily iterate over the records at ranges of positions."""
+        for (start, end) in ranges:
+            for pos in range(start, end):
+                yield self.lines[pos]
+
+    def lines_with_surt(self, surt_uri: str) -> List[str]:
+        """All records of a SURT URI, in datetime order."""
+        [(start, end)] = self.match_ranges(surt_uri)
+
+        return self.lines[start:end]
+
+    # The lookups below are shared by all kinds of indexes
+
+    def might_contain(self, surt_uri: str) -> bool:
+        """Whether the index may have records of a SURT, exact in memory."""
+        return self.find(surt_uri, only_uri=True) is not None
+
+    def find_line(self, needle: str,
+                  only_uri: bool = False) -> Optional[str]:
+        """The record with a `surt datetime` key (or the first of a SURT)."""
+        pos = self.find(needle, only_uri)
+
+        return None if pos is None else self.lines[pos]
+
+    def match(self, surt_uri: str, match_type: str = 'exact') \
+            -> Tuple[Optional[int], Iterator[str]]:
+        """The count of the records matching a SURT URI and the records."""
+        ranges = self.match_ranges(surt_uri, match_type)
+        count = sum(end - start for (start, end) in ranges)
+
+        return (count, self.iter_ranges(ranges))
+
+    def iter_prefix(self, surt_prefix: str = '',
+                    start_after: Optional[str] = None) -> Iterator[str]:
+        """The records whose SURT starts with a prefix, after a SURT."""
+        return self.iter_ranges([self.surt_range(surt_prefix, start_after)])
+
+
+class BlockCache:
+    """A bounded cache of the blocks last read from an index."""
+
+    def __init__(self, max_blocks: int):
+        self.max_blocks = max_blocks
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, number: int, read):
+        """The block of a number, read with `read(number)` if not cached."""
+        with self._lock:
+            block = self._blocks.get(number)
+            if block is not None:
+                self._blocks.move_to_end(number)
+                return block
+
+        block = read(number)
+
+        with self._lock:
+            self._blocks[number] = block
+            while len(self._blocks) > self.max_blocks:
+                self._blocks.popitem(last=False)
+
+        return block
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+
+
+class InPlaceIndex:
+    """
+    An index searched where it is stored rather than loaded in memory.
+
+    The lookups are built on `iter_lines()`, listing the records starting
+    with a prefix in order.
+    """
+
+    def iter_lines(self, prefix: str,
+                   start_after: Optional[str] = None) -> Iterator[str]:
+        raise NotImplementedError
+
+    def might_contain(self, surt_uri: str) -> bool:
+        """Whether the index may have records of a SURT, see ZipNumIndex."""
+        return True
+
+    def find_line(self, needle: str,
+                  only_uri: bool = False) -> Optional[str]:
+        return next(self.iter_lines(f'{needle} '), None)
+
+    def lines_with_surt(self, surt_uri: str) -> List[str]:
+        return list(self.iter_lines(f'{surt_uri} '))
+
+    def match(self, surt_uri: str, match_type: str = 'exact') \
+            -> Tuple[Optional[int], Iterator[str]]:
+        """
+        The records matching a SURT URI, their count is unknown without
+        reading them all.
+        """
+        prefixes = match_prefixes(surt_uri, match_type)
+
+        return (None, itertools.chain.from_iterable(
+            self.iter_lines(prefix) for prefix in prefixes))
+
+    def iter_prefix(self, surt_prefix: str = '',
+                    start_after: Optional[str] = None) -> Iterator[str]:
+        return self.iter_lines(surt_prefix, start_after)
+
+    def get_summary(self) -> dict:
+        """Statistics of the index, unknown without reading it all."""
+        summary = _new_summary()
+        summary['memento_count'] = summary['html_count'] = None
+
+        return summary
+
+
+class RemoteCDXJIndex(InPlaceIndex):
+    """
+    A CDXJ index on the Web searched in place with HTTP Range requests.
+
+    Records are found by a binary search over byte offsets, reading the
+    index in blocks that are kept in a bounded cache. The blocks read by the
+    first steps of every search are the same, so they are fetched once and
+    a lookup usually transfers a few blocks only.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.size = None
+        self.etag = None
+        self._blocks = BlockCache(REMOTE_INDEX_MAX_BLOCKS)
+
+    def _fetch_block(self, block_number: int) -> bytes:
+        start = block_number * REMOTE_INDEX_BLOCK_SIZE
+        end = start + REMOTE_INDEX_BLOCK_SIZE - 1
+
+        try:
+            response = requests.get(
+                self.url, headers={'Range': f'bytes={start}-{end}'})
+            response.raise_for_status()
+        except (requests.ConnectionError, requests.HTTPError) as err:
+            raise BackendError(backend_name='web') from err
+
+        if response.status_code != 206:
+            raise BackendError(backend_name='web (no Range support)')
+
+        etag = response.headers.get('ETag')
+        if self.etag is not None and etag != self.etag:
+            # The index changed, the cached blocks are from another version
+            self._blocks.clear()
+        self.etag = etag
+        self.size = int(response.headers['Content-Range'].split('/')[-1])
+
+        return response.content
+
+    def _block(self, block_number: int) -> bytes:
+        return self._blocks.get(block_number, self._fetch_block)
+
+    def _size(self) -> int:
+        if self.size is None:
+            self._block(0)
+        return self.size
+
+    def _read_line(self, offset: int) -> Tuple[bytes, int]:
+        """The line starting at an offset and the offset of the next one."""
+        line = b''
+        while offset < self._size():
+            (block_number, start) = divmod(offset, REMOTE_INDEX_BLOCK_SIZE)
+            block = self._block(block_number)
+            if len(block) <= start:  # Shorter than announced
+                break
+            end = block.find(b'\n', start)
+            if end != -1:
+                return (line + block[start:end], offset + end - start + 1)
+            line += block[start:]
+            offset += len(block) - start
+
+        return (line, offset)
+
+    def _line_start(self, offset: int) -> int:
+        """Offset of the first line starting at or after an offset."""
+        if offset == 0:
+            return 0
+        return self._read_line(offset - 1)[1]
+
+    def _search(self, needle: bytes) -> int:
+        """Offset of the first line not sorting before a needle."""
+        (lo, hi) = (0, self._size())
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self._line_start(mid)
+            if start >= hi:  # No line starts in the upper half
+                start = lo
+
+            (line, next_start) = self._read_line(start)
+            if line < needle:
+                lo = next_start
+            else:
+                hi = start
+
+        return lo
+
+    def iter_lines(self, prefix: str,
+                   start_after: Optional[str] = None) -> Iterator[str]:
+        """The records starting with a prefix, in order."""
+        needle = prefix.encode('utf-8')
+        offset = self._search(needle)
+        if start_after is not None:
+            # The records of a SURT are followed by the next SURT, as
+            # no SURT has a character sorting before the space
+            offset = max(offset, self._search(f'{start_after}!'.encode()))
+
+        while offset < self._size():
+            (line, offset) = self._read_line(offset)
+            if not line.startswith(needle):
+                return
+            if line.strip() and line[:1] != b'!':  # Skip the metadata
+                yield line.decode('utf-8')
+
+
+class ZipNumIndex(InPlaceIndex):
+    """
+    A local index compressed in blocks of ZIPNUM_BLOCK_LINES records, each
+    a gzip member, with a summary of where every block starts.
+
+    Only the summary is kept in memory, a lookup bisects it and decompresses
+    the blocks holding the records. The blocks file is kept open, so the
+    blocks of the summary remain readable once the index is rewritten.
+    """
+
+    def __init__(self, path: str, summary: Optional[List[str]] = None):
+        self.path = path
+        self.blocks_path = zipnum_blocks_path(path)
+
+        for attempt in range(ZIPNUM_OPEN_ATTEMPTS):
+            self._read_summary(summary)
+            self._blocks_file = open(self.blocks_path, 'rb')
+            # The blocks are replaced before the summary, which tells the
+            # size of its blocks
+            blocks_size = os.fstat(self._blocks_file.fileno()).st_size
+            if summary is not None or blocks_size == self._blocks_size():
+                break
+
+            self._blocks_file.close()
+            time.sleep(ZIPNUM_OPEN_RETRY_INTERVAL)
+        else:
+            raise BackendError(backend_name='local (blocks do not match)')
+
+        self._blocks_lock = threading.Lock()
+        self._blocks = BlockCache(ZIPNUM_MAX_BLOCKS)
+
+        # Written by the indexer, the SURTs absent from the index are told
+        # without decompressing any block
+        self.bloom_filter = None
+        if os.path.exists(zipnum_bloom_path(path)):
+            with open(zipnum_bloom_path(path), 'rb') as f:
+                self.bloom_filter = SURTBloomFilter.from_bytes(f.read())
+
+    def _read_summary(self, summary: Optional[List[str]]):
+        self.metadata = []
+        self.first_lines = []
+        self.locations = []
+
+        if summary is None:
+            with open(self.path, 'r') as f:
+                summary = [line.rstrip('\n') for line in f]
+
+        for line in summary:
+            if line[:1] == '!':
+                self.metadata.append(line)
+            elif line.strip():
+                (first_line, offset, length) = line.rsplit('\t', 2)
+                self.first_lines.append(first_line)
+                self.locations.append((int(offset), int(length)))
+
+    def _blocks_size(self) -> int:
+        if not self.locations:
+            return 0
+
+        (offset, length) = self.locations[-1]
+        return offset + length
+
+    def might_contain(self, surt_uri: str) -> bool:
+        return self.bloom_filter is None or surt_uri in self.bloom_filter
+
+    def _read_block(self, block_number: int) -> List[str]:
+        (offset, length) = self.locations[block_number]
+        with self._blocks_lock:
+            self._blocks_file.seek(offset)
+            data = self._blocks_file.read(length)
+
+        return gzip.decompress(data).decode('utf-8').splitlines()
+
+    def _block(self, block_number: int) -> List[str]:
+        return self._blocks.get(block_number, self._read_block)
+
+    def iter_lines(self, prefix: str,
+                   start_after: Optional[str] = None) -> Iterator[str]:
+        """The records starting with a prefix, in order."""
+        needle = prefix
+        if start_after is not None:
+            needle = max(needle, f'{start_after}!')
+
+        # The block before the first one starting after the needle may
+        # already hold records following it
+        first_block = max(0, bisect_left(self.first_lines, needle) - 1)
+        for block_number in range(first_block, len(self.first_lines)):
+            block = self._block(block_number)
+            for line in itertools.islice(
+                    block, bisect_left(block, needle), None):
+                if not line.startswith(prefix):
+                    return
+                yield line
+
+
+class FederatedIndex:
+    """
+    A k-way merged view of many indexes, the records of none are copied.
+    Every lookup queries all of the indexes, in parallel when some of them
+    are not in memory, e.g., remote ones.
+    """
+
+    def __init__(self, indexes: list):
+        self.indexes = indexes
+        self._in_memory = all(isinstance(idx, CDXJIndex) for idx in indexes)
+        self._summary = None
+
+    def _query_all(self, lookup, *args) -> list:
+        def query(index):
+            return getattr(index, lookup)(*args)
+
+        if self._in_memory:  # Bisects, faster than handing them to threads
+            return [query(index) for index in self.indexes]
+
+        return list(_index_query_pool().map(query, self.indexes))
+
+    def might_contain(self, surt_uri: str) -> bool:
+        return any(index.might_contain(surt_uri) for index in self.indexes)
+
+    def find_line(self, needle: str,
+                  only_uri: bool = False) -> Optional[str]:
+        lines = [line for line in self._query_all('find_line', needle,
+                                                  only_uri)
+                 if line is not None]
+
+        return min(lines) if lines else None
+
+    def lines_with_surt(self, surt_uri: str) -> List[str]:
+        return list(_unique(heapq.merge(
+            *self._query_all('lines_with_surt', surt_uri))))
+
+    def match(self, surt_uri: str, match_type: str = 'exact') \
+            -> Tuple[Optional[int], Iterator[str]]:
+        """
+        The records matching a SURT URI in any of the indexes, their count
+        is unknown as the records in many indexes are listed once.
+        """
+        matches = [index.match(surt_uri, match_type)
+                   for index in self.indexes]
+
+        return (None, _unique(heapq.merge(*(lines for (_, lines)
+                                            in matches))))
+
+    def iter_prefix(self, surt_prefix: str = '',
+                    start_after: Optional[str] = None) -> Iterator[str]:
+        return _unique(heapq.merge(
+            *(index.iter_prefix(surt_prefix, start_after)
+              for index in self.indexes)))
+
+    def get_summary(self) -> dict:
+        """Statistics of all the indexes, records in many are counted once
+        per index."""
+        if self._summary is not None:
+            return self._summary
+
+        summary = _new_summary()
+        for index_summary in (idx.get_summary() for idx in self.indexes):
+            for field in ('memento_count', 'html_count'):
+                if summary[field] is not None:
+                    summary[field] = None if index_summary[field] is None \
+                        else summary[field] + index_summary[field]
+            for (surt_uri, count) in index_summary['surt_uris'].items():
+                summary['surt_uris'][surt_uri] = \
+                    summary['surt_uris'].get(surt_uri, 0) + count
+            for (field, pick) in (('oldest_datetime', min),
+                                  ('newest_datetime', max)):
+                datetimes = [dt for dt in (summary[field],
+                                           index_summary[field]) if dt]
+                summary[field] = pick(datetimes) if datetimes else None
+
+        self._summary = summary
+        return summary
+
+
+class SURTBloomFilter:
+    """
+    A Bloom filter of SURTs, telling without false negatives whether a SURT
+    may be in an index.
+    """
+
+    DIGEST_SIZE = 16
+
+    def __init__(self, bit_count: int, hash_count: int,
+                 bits: Optional[bytearray] = None):
+        self.bit_count = bit_count
+        self.hash_count = hash_count
+        self.bits = bits or bytearray((bit_count + 7) // 8)
+
+    @classmethod
+    def for_count(cls, count: int,
+                  false_positive_rate: float = BLOOM_FALSE_POSITIVE_RATE):
+        """An empty filter sized for a number of SURTs."""
+        count = max(count, 1)
+        bit_count = math.ceil(-count * math.log(false_positive_rate) /
+                              math.log(2) ** 2)
+        hash_count = max(1, round(bit_count / count * math.log(2)))
+
+        return cls(bit_count, hash_count)
+
+    @classmethod
+    def digest(cls, surt_uri: str) -> bytes:
+        """The hash of a SURT, to be added later with add_digest()."""
+        return hashlib.blake2b(surt_uri.encode('utf-8'),
+                               digest_size=cls.DIGEST_SIZE).digest()
+
+    def _positions(self, digest: bytes) -> Iterator[int]:
+        (h1, h2) = struct.unpack('<QQ', digest)
+
+        return ((h1 + i * h2) % self.bit_count
+                for i in range(self.hash_count))
+
+    def add_digest(self, digest: bytes):
+        for pos in self._positions(digest):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def add(self, surt_uri: str):
+        self.add_digest(self.digest(surt_uri))
+
+    def __contains__(self, surt_uri: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(self.digest(surt_uri)))
+
+    def to_bytes(self) -> bytes:
+        return struct.pack('<QB', self.bit_count, self.hash_count) + \
+            bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'SURTBloomFilter':
+        (bit_count, hash_count) = struct.unpack_from('<QB', data)
+
+        return cls(bit_count, hash_count, bytearray(data[9:]))
+
+
+_index_query_pools: Dict[int, ThreadPoolExecutor] = {}
+
+
+def _index_query_pool() -> ThreadPoolExecutor:
+    """A thread pool of this process, the threads do not survive forks."""
+    pool = _index_query_pools.get(os.getpid())
+    if pool is None:
+        pool = ThreadPoolExecutor(max_workers=MAX_INDEX_LOADERS,
+                                  thread_name_prefix='ipwb-query')
+        pool = _index_query_pools.setdefault(os.getpid(), pool)
+
+    return pool
+
+
+def _unique(lines: Iterable[str]) -> Iterator[str]:
+    """Drop the repeated records of sorted records."""
+    return (line for (line, _) in itertools.groupby(lines))
+
+
+def match_prefixes(surt_uri: str, match_type: str = 'exact') -> List[str]:
+    """The prefixes of the records matching a SURT URI, see match_ranges."""
+    if match_type == 'exact':
+        return [f'{surt_uri} ']
+    if match_type == 'prefix':
+        return [surt_uri]
+
+    host = surt_uri.split(')', 1)[0]
+    if match_type == 'host':
+        return [f'{host})']
+    if match_type == 'domain':
+        return [f'{host})', f'{host},']
+
+    raise ValueError(f'Unknown match type: {match_type}')
+
+
+def _new_summary() -> dict:
+    return {
+        'memento_count': 0,
+        'html_count': 0,
+        'surt_uris': {},
+        'oldest_datetime': None,
+        'newest_datetime': None
+    }
+
+
+def _add_to_summary(summary: dict, line: str):
+    try:
+        (surt_uri, datetime, json_data) = line.split(' ', 2)
+        fields = json.loads(json_data)
+    except ValueError:  # Skip lines w/o JSON block
+        return
+    if len(datetime) != 14:
+        return
+
+    summary['memento_count'] += 1
+    surt_uris = summary['surt_uris']
+    surt_uris[surt_uri] = surt_uris.get(surt_uri, 0) + 1
+
+    mime = fields.get('mime_type') or ''
+    status = fields.get('status_code', '')
+
+    # Count only non-redirect HTML pages for html_count display
+    if mime.lower().startswith('text/html') and status[:1] != '3':
+        summary['html_count'] += 1
+
+    if summary['oldest_datetime'] is None or \
+            datetime < summary['oldest_datetime']:
+        summary['oldest_datetime'] = datetime
+    if summary['newest_datetime'] is None or \
+            datetime > summary['newest_datetime']:
+        summary['newest_datetime'] = datetime
+
+
+_loaded_indexes: Dict[str, tuple] = {}
+_loaded_indexes_lock = threading.Lock()
+_index_locks: Dict[str, threading.Lock] = {}
+_federated_indexes: Dict[tuple, tuple] = {}
+
+
+def _index_signature(path: str) -> Optional[tuple]:
+    """Identify the version of a local file, None if there is none."""
+    try:
+        stat = os.stat(path)
+    except (OSError, ValueError):
+        return None
+
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def delta_path(path: str) -> str:
+    """Path of the file of the records recently added to a local index."""
+    return f'{path}{DELTA_SUFFIX}'
+
+
+def _is_loaded(path: str) -> bool:
+    if get_backend(path).in_place_index() is not None:
+        return True
+
+    with _loaded_indexes_lock:
+        cached = _loaded_indexes.get(path)
+
+    return cached is not None and cached[0] == get_backend(path).signature()
+
+
+def load_index(path: str) -> CDXJIndex:
+    """
+    Load and cache an index in memory.
+
+    Local files are re-read once they change on disk, e.g., when a WARC is
+    uploaded to the replay system. Remote indexes are cached by their
+    backend, see get_backend(). The records of the delta file of a local
+    index are merged into it, when only the delta file changed the index
+    itself is not read again. Large indexes on the Web are not loaded but
+    searched in place, see RemoteCDXJIndex.
+    """
+    backend = get_backend(path)
+    in_place_index = backend.in_place_index()
+    if in_place_index is not None:
+        return in_place_index
+
+    signature = backend.signature()
+
+    with _loaded_indexes_lock:
+        cached = _loaded_indexes.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        index_lock = _index_locks.setdefault(path, threading.Lock())
+
+    # Only the loads of the same index wait for each other
+    with index_lock:
+        cached = _loaded_indexes.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        if cached is not None and signature is not None and \
+                cached[0][0] == signature[0]:
+            base_index = cached[2]
+        else:
+            base_index = CDXJIndex(backend.read())
+
+        index = base_index
+        delta = backend.read_delta()
+        if delta is not None:
+            index = base_index.merged(delta)
+
+        with _loaded_indexes_lock:
+            _loaded_indexes[path] = (signature, index, base_index)
+
+        return index
+
+
+def load_indexes(paths: List[str]):
+    """
+    Load many indexes and federate them into one, see FederatedIndex.
+
+    The indexes are loaded in parallel, as fetching remote ones is mostly
+    waiting on the network. The federated index is created anew only once
+    one of its indexes changed, which is then the only one reloaded.
+    """
+    if len(paths) == 1:
+        return load_index(paths[0])
+
+    stale_paths = [path for path in paths if not _is_loaded(path)]
+    if len(stale_paths) > 1:
+        with ThreadPoolExecutor(
+                max_workers=min(len(stale_paths), MAX_INDEX_LOADERS),
+                thread_name_prefix='ipwb-index') as pool:
+            list(pool.map(load_index, stale_paths))
+
+    indexes = [load_index(path) for path in paths]
+
+    key = tuple(paths)
+    with _loaded_indexes_lock:
+        cached = _federated_indexes.get(key)
+    if cached is not None and \
+            all(old is new for (old, new) in zip(cached[0], indexes)):
+        return cached[1]
+
+    index = FederatedIndex(indexes)
+    with _loaded_indexes_lock:
+        _federated_indexes[key] = (indexes, index)
+
+    return index
+
+
+def reload_indexes():
+    """Forget the cached indexes so that they are loaded anew."""
+    with _loaded_indexes_lock:
+        paths = list(_loaded_indexes.keys())
+        _loaded_indexes.clear()
+        _federated_indexes.clear()
+
+    for path in paths:
+        load_index(path)
+
+
+def append_to_index(path: str, lines: List[str],
+                    metadata: Optional[List[str]] = None,
+                    compact: bool = False):
+    """
+    Add records to a local index file.
+
+    Rather than rewriting the whole index, each batch of records is
+    appended to its delta file, which is sorted and merged into the index
+    when it is loaded, so the cost of adding records stays proportional to
+    their size. The delta file is compacted into the index apart from
+    adding records, once needs_compaction(), or right away with `compact`
+    for the index file alone to hold all of the records. Indexes compressed
+    in blocks are rewritten instead.
+    """
+    with locked_index(path):
+        if is_zipnum_index(path):
+            add_to_zipnum_index(path, lines, metadata)
+            return
+
+        metadata = metadata or []
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            _write_lines(path, metadata + sorted(set(lines)))
+            return
+
+        # Written at once, readers ignore a last line not yet complete
+        with open(delta_path(path), 'a') as f:
+            f.write(''.join(f'{line}\n' for line in sorted(set(lines))))
+
+        if compact:
+            _compact_index(path, metadata)
+
+
+def needs_compaction(path: str) -> bool:
+    """Whether the delta file of a local index outgrew a fraction of it."""
+    try:
+        return os.path.getsize(delta_path(path)) > \
+            COMPACTION_RATIO * os.path.getsize(path)
+    except FileNotFoundError:
+        return False
+
+
+def compact_index(path: str, metadata: Optional[List[str]] = None):
+    """Merge the delta file of a local index into it."""
+    with locked_index(path):
+        _compact_index(path, metadata)
+
+
+@contextlib.contextmanager
+def locked_index(path: str):
+    """
+    Hold the lock of a local index while writing it.
+
+    The lock is a file lock, so that the replay system and `ipwb index`
+    never write the same index at once, not even from other processes.
+    """
+    with open(f'{path}{LOCK_SUFFIX}', 'w') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def _compact_index(path: str, metadata: Optional[List[str]] = None):
+    if not os.path.exists(delta_path(path)):
+        return
+
+    with open(delta_path(path), 'r') as delta_file:
+        # Sorted batches, only the delta file is sorted in memory
+        delta = sorted(set(_read_records(delta_file)))
+
+    with open(path, 'r') as index_file:
+        if not metadata:
+            metadata = [line.rstrip('\n') for line in
+                        itertools.takewhile(lambda ln: ln[:1] == '!',
+                                            index_file)]
+            index_file.seek(0)
+
+        # The index is sorted, a streaming merge does not hold it in memory
+        records = heapq.merge(_read_records(index_file), delta)
+        _write_lines(path, itertools.chain(metadata, _unique(records)))
+
+    os.remove(delta_path(path))
+
+
+def is_zipnum_index(path: str) -> bool:
+    """Whether a path is the summary of an index compressed in blocks."""
+    return path.endswith(ZIPNUM_SUMMARY_SUFFIX)
+
+
+def zipnum_blocks_path(path: str) -> str:
+    """Path of the compressed blocks of the summary of an index."""
+    return f'{path[:-len(ZIPNUM_SUMMARY_SUFFIX)]}{ZIPNUM_BLOCKS_SUFFIX}'
+
+
+def zipnum_bloom_path(path: str) -> str:
+    """Path of the Bloom filter of the SURTs of the summary of an index."""
+    return f'{path[:-len(ZIPNUM_SUMMARY_SUFFIX)]}{BLOOM_SUFFIX}'
+
+
+def add_to_zipnum_index(path: str, lines: List[str],
+                        metadata: Optional[List[str]] = None):
+    """Merge records into an index compressed in blocks, rewriting it."""
+    records = sorted(set(lines))
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        index = ZipNumIndex(path)
+        metadata = metadata or index.metadata
+        records = _unique(heapq.merge(index.iter_prefix(), records))
+
+    write_zipnum_index(path, records, metadata or [])
+
+
+def write_zipnum_index(path: str, records: Iterable[str],
+                       metadata: List[str]):
+    """
+    Write sorted records compressed in blocks, with the summary at `path`.
+
+    The blocks are concatenated gzip members, so the whole file can still
+    be read with any gzip tool.
+    """
+    records = iter(records)
+    summary = []
+    # Of the SURTs of the records, the filter is sized once they are counted
+    digests = bytearray()
+    last_surt = None
+    with _replaced_file(zipnum_blocks_path(path), 'wb') as f:
+        offset = 0
+        for block in iter(
+                lambda: list(itertools.islice(records, ZIPNUM_BLOCK_LINES)),
+                []):
+            data = gzip.compress(('\n'.join(block) + '\n').encode('utf-8'))
+            f.write(data)
+            summary.append(f'{block[0]}\t{offset}\t{len(data)}')
+            offset += len(data)
+
+            for line in block:
+                surt_uri = line.split(' ', 1)[0]
+                if surt_uri != last_surt:
+                    digests += SURTBloomFilter.digest(surt_uri)
+                    last_surt = surt_uri
+
+    # Replaced before the summary, readers reload both once the summary
+    # changes
+    digest_size = SURTBloomFilter.DIGEST_SIZE
+    bloom_filter = SURTBloomFilter.for_count(len(digests) // digest_size)
+    for i in range(0, len(digests), digest_size):
+        bloom_filter.add_digest(bytes(digests[i:i + digest_size]))
+    with _replaced_file(zipnum_bloom_path(path), 'wb') as f:
+        f.write(bloom_filter.to_bytes())
+
+    _write_lines(path, metadata + summary)
+
+
+def _read_records(f) -> Iterator[str]:
+    for line in f:
+        line = line.rstrip('\n')
+        if line.strip() and line[:1] != '!':
+            yield line
+
+
+def _complete_lines(f) -> Iterator[str]:
+    """The lines of a file, but the last one if still being written."""
+    for line in f:
+        if line[-1:] == '\n':
+            yield line
+
+
+def _write_lines(path: str, lines: Iterable[str]):
+    with _replaced_file(path) as f:
+        for line in lines:
+            f.write(line + '\n')
+
+
+@contextlib.contextmanager
+def _replaced_file(path: str, mode: str = 'w'):
+    """Replace a file atomically, readers never see it partially written."""
+    (fd, tmp_path) = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), suffix='.cdxj')
+    try:
+        if os.path.exists(path):  # Keep the permissions of the file
+            os.chmod(tmp_path, os.stat(path).st_mode)
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
@@ -0,0 +1,95 @@
+"""
+Framed zlib compression of the payloads stored in IPFS.
+
+The data is split in frames of a fixed size, compressed independently, so
+any byte range of it is decompressed from the frames holding it alone.
+The frames are preceded by a table of where each of them starts:
+
+    IPZF | frame size (uint32) | data length (uint64)
+    | compressed length of each frame (uint32) | frames...
+
+All integers are big-endian.
+"""
+
+import dataclasses
+import struct
+import zlib
+from typing import List
+
+FRAME_MAGIC = b'IPZF'
+FRAME_SIZE = 64 * 1024
+
+_header = struct.Struct('>4sIQ')
+_frame_length = struct.Struct('>I')
+
+
+@dataclasses.dataclass(frozen=True)
+class FrameTable:
+    frame_size: int
+    length: int
+    # Where each frame starts in the stored bytes, then where the last ends
+    offsets: List[int]
+
+
+def frame_count(length, frame_size):
+    return -(-length // frame_size)
+
+
+def table_size(length, frame_size=FRAME_SIZE):
+    """Number of bytes the table takes before the frames of some data"""
+    return _header.size + _frame_length.size * frame_count(length, frame_size)
+
+
+def compress_frames(data, level=6, frame_size=FRAME_SIZE):
+    frames = [zlib.compress(data[i:i + frame_size], level)
+              for i in range(0, len(data), frame_size)]
+
+    table = [_header.pack(FRAME_MAGIC, frame_size, len(data))]
+    table.extend(_frame_length.pack(len(frame)) for frame in frames)
+
+    return b''.join(table + frames)
+
+
+def read_table(data):
+    """Parse the frame table at the start of framed data"""
+    (magic, frame_size, length) = _header.unpack_from(data)
+    if magic != FRAME_MAGIC:
+        raise ValueError('Not framed data')
+
+    offsets = [table_size(length, frame_size)]
+    for i in range(frame_count(length, frame_size)):
+        (frame_length,) = _frame_length.unpack_from(
+            data, _header.size + i * _frame_length.size)
+        offsets.append(offsets[-1] + frame_length)
+
+    return FrameTable(frame_size, length, offsets)
+
+
+def locate(table, window):
+    """The (start, stop) stored bytes holding the frames of a data window"""
+    (start, stop) = window
+    first = start // table.frame_size
+    last = frame_count(stop, table.frame_size)
+
+    return (table.offsets[first], table.offsets[last])
+
+
+def extract(stored, table, window):
+    """A (start, stop) window of the data, from the frames located for it"""
+    (start, stop) = window
+    first = start // table.frame_size
+    base = table.offsets[first]
+
+    data = []
+    for i in range(first, frame_count(stop, table.frame_size)):
+        frame = stored[table.offsets[i] - base:table.offsets[i + 1] - base]
+        data.append(zlib.decompress(frame))
+
+    skip = start - first * table.frame_size
+    return b''.join(data)[skip:skip + stop - start]
+
+
+def decompress_frames(data):
+    table = read_table(data)
+
+    return extract(data[table.offsets[0]:], table, (0, table.length))
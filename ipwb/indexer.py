@@ -15,7 +15,6 @@ import os
 import json
 import ipfshttpclient as ipfsapi
 import zlib
-import surt
 import ntpath
 import traceback
 import tempfile
@@ -32,15 +31,18 @@ from six.moves import input
 from six import PY2
 from six import PY3
 
-from ipwb.util import iso8601_to_digits14, ipfs_client
+from ipwb.util import iso8601_to_digits14, ipfs_client, uri_to_surt
+from ipwb.util import derive_encryption_key
+from ipwb.util import archived_header_name
+from ipwb.backends import append_to_index, is_zipnum_index
+from ipwb.backends import ZIPNUM_SUMMARY_SUFFIX
+from ipwb import frames
 
 import requests
 import datetime
 
 from bs4 import BeautifulSoup
 
-from Crypto.Cipher import AES
-from Crypto.Util.Padding import pad
 import base64
 
 from .__init__ import __version__ as ipwb_version
@@ -91,18 +93,40 @@ def push_to_ipfs(hstr, payload):
 
 
 def encrypt(hstr, payload, encryption_key):
-    padded_encryption_key = pad(encryption_key, AES.block_size)
-    key = base64.b64encode(padded_encryption_key)
-    cipher = AES.new(key, AES.MODE_CTR)
+    """
+    Encrypt the HTTP header and payload of a record with a key derived by
+    derive_encryption_key(), returns the raw ciphertexts and the nonce
+    """
+    if isinstance(hstr, str):
+        hstr = s2b(hstr)
+    if isinstance(payload, str):
+        payload = s2b(payload)
 
-    hstr_bytes = base64.b64encode(cipher.encrypt(hstr)).decode('utf-8')
+    from Crypto.Cipher import AES  # Only needed to encrypt
 
-    payload_bytes = base64.b64encode(cipher.encrypt(payload)).decode('utf-8')
+    cipher = AES.new(encryption_key, AES.MODE_CTR)
+
+    hstr_bytes = cipher.encrypt(hstr)
+    payload_bytes = cipher.encrypt(payload)
     nonce = base64.b64encode(cipher.nonce).decode('utf-8')
 
     return [hstr_bytes, payload_bytes, nonce]
 
 
+def compress(data, compression_level=6, frame_size=None):
+    """
+    Compress a record with zlib, in independently compressed frames of
+    frame_size bytes if given for parts of it to be decompressed alone
+    """
+    if isinstance(data, str):
+        data = s2b(data)
+
+    if frame_size is None:
+        return zlib.compress(data, compression_level)
+
+    return frames.compress_frames(data, compression_level, frame_size)
+
+
 def create_ipfs_temp_path():
     ipfs_temp_path = tempfile.gettempdir() + '/ipfs/'
 
@@ -113,7 +137,9 @@ def create_ipfs_temp_path():
 
 def index_file_at(warc_paths, encryption_key=None,
                   compression_level=None, encrypt_THEN_compress=True,
-                  quiet=False, outfile=None, debug=False):
+                  quiet=False, outfile=None, debug=False,
+                  inline_headers=False, zipnum=False, frame_size=None,
+                  stream=False, compact=False):
     global DEBUG
     DEBUG = debug
 
@@ -125,6 +151,12 @@ def index_file_at(warc_paths, encryption_key=None,
 
     cdxj_lines = []
 
+    if zipnum and not outfile:
+        logError('Compressing the index in blocks needs an output file')
+    elif zipnum and not is_zipnum_index(outfile):
+        # The summary of the blocks is the index given to the replay system
+        outfile += ZIPNUM_SUMMARY_SUFFIX
+
     if outfile:
         outdir = os.path.dirname(os.path.abspath(outfile))
         if not os.path.exists(outdir):
@@ -134,9 +166,9 @@ def index_file_at(warc_paths, encryption_key=None,
                 logError(e)
                 logError('CDXJ output directory was not created')
         try:
-            output_file = open(outfile, 'a+')
-            # Read existing non-meta lines (if any) to allow automatic merge
-            cdxj_lines = [ln.strip() for ln in output_file if ln[:1] != '!']
+            # Existing records (if any) are merged with the new ones by
+            # append_to_index, without reading them here
+            open(outfile, 'a').close()
         except IOError as e:
             logError(e)
             logError('Writing generated CDXJ to STDOUT instead')
@@ -148,21 +180,43 @@ def index_file_at(warc_paths, encryption_key=None,
             encryption_key = None
             logError('Blank key entered, encryption disabled')
 
+    if inline_headers and encryption_key is not None:
+        logError('HTTP headers are not stored in the index when encrypting')
+        inline_headers = False
+
     encryption_and_compression_setting = {
         'encrypt_THEN_compress': encrypt_THEN_compress,
         'encryption_key': encryption_key,
-        'compression_level': compression_level
+        'cipher_key': None if encryption_key is None
+        else derive_encryption_key(encryption_key),
+        'compression_level': compression_level,
+        'frame_size': frame_size
     }
 
+    # Lines piped to another process, e.g., `ipwb replay`, are written as
+    # soon as indexed rather than sorted once all of the WARCs are indexed.
+    # The output is then not a valid CDXJ, the reader has to sort it.
+    stream = stream and not quiet and not outfile
+    if stream:
+        print('\n'.join(generate_cdxj_metadata()), flush=True)
+
     for warc_path in warc_paths:
         warc_file_full_path = warc_path
 
         try:
-            cdxj_lines += cdx_cdxj_lines_from_file(
-                warc_file_full_path, **encryption_and_compression_setting)
+            for cdxj_line in cdx_cdxj_lines_from_file(
+                    warc_file_full_path, inline_headers,
+                    **encryption_and_compression_setting):
+                if stream:
+                    print(cdxj_line, flush=True)
+                else:
+                    cdxj_lines.append(cdxj_line)
         except ArchiveLoadFailed:
             logError(warc_path + ' is not a valid WARC file.')
 
+    if stream:
+        return
+
     # De-dupe and sort, needed for CDXJ adherence
     cdxj_lines = list(set(cdxj_lines))
     cdxj_lines.sort()
@@ -175,12 +229,8 @@ def index_file_at(warc_paths, encryption_key=None,
         return cdxj_lines
 
     if outfile:
-        # Truncate existing CDXJ file contents (if any) before writing to it
-        output_file.seek(0)
-        output_file.truncate()
-        for line in cdxj_lines:
-            output_file.write(line + "\n")
-        output_file.close()
+        append_to_index(outfile, cdxj_lines[len(cdxj_metadata_lines):],
+                        cdxj_metadata_lines, compact=compact)
     else:
         print('\n'.join(cdxj_lines))
 
@@ -189,7 +239,9 @@ def sanitize_cdxj_line(cdxj_line):
     return cdxj_line
 
 
-def cdx_cdxj_lines_from_file(warc_path, **enc_comp_opts):
+def cdx_cdxj_lines_from_file(warc_path, inline_headers=False,
+                             **enc_comp_opts):
+    """Generate the CDXJ lines of a WARC as its records are indexed"""
     record_count = 0
     with open(warc_path, 'rb') as fhForCounting:
         record_count = 0
@@ -201,7 +253,6 @@ def cdx_cdxj_lines_from_file(warc_path, **enc_comp_opts):
             print('Encountered a bad WARC record.', file=sys.stderr)
 
     with open(warc_path, 'rb') as fh:
-        cdxj_lines = []
         records_processed = 0
         # Throws pywb.warc.recordloader.ArchiveLoadFailed if not a warc
         for record in ArchiveIterator(fh):
@@ -225,6 +276,7 @@ def cdx_cdxj_lines_from_file(warc_path, **enc_comp_opts):
                 break
 
             payload = record.content_stream().read()
+            payload_length = len(payload)
 
             title = None
             try:
@@ -244,19 +296,21 @@ def cdx_cdxj_lines_from_file(warc_path, **enc_comp_opts):
 
             if enc_comp_opts.get('encrypt_THEN_compress'):
                 if enc_comp_opts.get('encryption_key') is not None:
-                    key = enc_comp_opts.get('encryption_key')
+                    key = enc_comp_opts.get('cipher_key')
                     (hstr, payload, nonce) = encrypt(hstr, payload, key)
                 if enc_comp_opts.get('compression_level') is not None:
                     compression_level = enc_comp_opts.get('compression_level')
-                    hstr = zlib.compress(hstr, compression_level)
-                    payload = zlib.compress(payload, compression_level)
+                    frame_size = enc_comp_opts.get('frame_size')
+                    hstr = compress(hstr, compression_level, frame_size)
+                    payload = compress(payload, compression_level, frame_size)
             else:
                 if enc_comp_opts.get('compression_level') is not None:
                     compression_level = enc_comp_opts.get('compression_level')
-                    hstr = zlib.compress(hstr, compression_level)
-                    payload = zlib.compress(payload, compression_level)
+                    frame_size = enc_comp_opts.get('frame_size')
+                    hstr = compress(hstr, compression_level, frame_size)
+                    payload = compress(payload, compression_level, frame_size)
                 if enc_comp_opts.get('encryption_key') is not None:
-                    encryption_key = enc_comp_opts.get('encryption_key')
+                    encryption_key = enc_comp_opts.get('cipher_key')
                     (hstr, payload, nonce) = \
                         encrypt(hstr, payload, encryption_key)
 
@@ -272,9 +326,7 @@ def cdx_cdxj_lines_from_file(warc_path, **enc_comp_opts):
             (http_header_ipfs_hash, payload_ipfs_hash) = ipfs_hashes
 
             original_uri = record.rec_headers.get_header('WARC-Target-URI')
-            original_uri_surted = \
-                surt.surt(original_uri,
-                          path_strip_trailing_slash_unless_empty=False)
+            original_uri_surted = uri_to_surt(original_uri)
             timestamp = iso8601_to_digits14(
                 record.rec_headers.get_header('WARC-Date'))
             mime = record.http_headers.get_header('content-type')
@@ -283,20 +335,37 @@ def cdx_cdxj_lines_from_file(warc_path, **enc_comp_opts):
                     f'urn:ipfs/{http_header_ipfs_hash}/{payload_ipfs_hash}',
                 'status_code': status_code,
                 'mime_type': mime or '',
-                'original_uri': original_uri
+                'original_uri': original_uri,
+                'payload_length': payload_length
             }
             if enc_comp_opts.get('encryption_key') is not None:
                 obj['encryption_key'] = enc_comp_opts.get('encryption_key')
                 obj['encryption_method'] = 'aes'
                 obj['encryption_nonce'] = nonce
+                # Stored as raw bytes, base64 encoded by older versions
+                obj['encryption_encoding'] = 'binary'
+            if enc_comp_opts.get('compression_level') is not None:
+                obj['compression'] = 'zlib'
+                if enc_comp_opts.get('frame_size') is not None:
+                    obj['compression'] = 'zlib-frames'
+                    obj['frame_size'] = enc_comp_opts.get('frame_size')
+                if enc_comp_opts.get('encryption_key') is not None:
+                    obj['compressed_first'] = \
+                        not enc_comp_opts.get('encrypt_THEN_compress')
             if title is not None:
                 obj['title'] = title
+            # The payload read from warcio is already de-chunked
+            te = record.http_headers.get_header('transfer-encoding')
+            if te and 'chunked' in te.lower():
+                obj['dechunked'] = True
+            if inline_headers:  # Ready to be set on the replay response
+                obj['headers'] = [[archived_header_name(k), v.strip()]
+                                  for (k, v) in record.http_headers.headers]
 
             objJSON = json.dumps(obj)
 
             cdxj_line = f'{original_uri_surted} {timestamp} {objJSON}'
-            cdxj_lines.append(cdxj_line)  # + '\n'
-        return cdxj_lines
+            yield cdxj_line
 
 
 def generate_cdxj_metadata(cdxj_lines=None):
@@ -0,0 +1,267 @@
+"""
+Background indexing of the WARCs uploaded to the replay system.
+
+Uploaded WARCs are indexed one at a time by a worker thread, so requests
+are never blocked by indexing and concurrent uploads never overwrite each
+other's records. The records are added to the delta file of the index and
+merged into the index served from memory once a WARC is indexed.
+
+The status of every job is kept in a file next to the index, so that any
+worker process of the replay system can serve it. The delta file of an
+index is compacted into it by the same worker thread, never while serving
+a request.
+
+The records piped from `ipwb index` into `ipwb replay` are ingested the
+same way, in small batches as they arrive.
+"""
+
+import dataclasses
+import json
+import os
+import queue
+import re
+import tempfile
+import threading
+import time
+import uuid
+from typing import Optional
+
+from . import indexer
+from .backends import append_to_index, compact_index, load_index
+from .backends import needs_compaction
+
+# Number of jobs whose status is remembered, in a directory next to the
+# index with a JSON file per job
+MAX_JOBS = 100
+JOBS_SUFFIX = '.jobs'
+
+# Piped records are added to the index by this many at most, or once the
+# first of them arrived this many seconds ago
+STREAM_BATCH_SIZE = 1000
+STREAM_BATCH_INTERVAL = 0.5
+
+# Callables run by the worker thread, one at a time
+_job_queue = queue.Queue()
+_job_worker = None
+_compactions = set()  # Indexes whose compaction is queued
+_compactions_lock = threading.Lock()
+
+
+@dataclasses.dataclass
+class IndexingJob:
+    id: str
+    warc_path: str
+    cdxj_path: str
+    status: str = 'queued'  # queued, indexing, done or failed
+    record_count: int = 0
+    error: Optional[str] = None
+    submitted_at: float = dataclasses.field(default_factory=time.time)
+    finished_at: Optional[float] = None
+
+    def to_dict(self):
+        return dataclasses.asdict(self)
+
+    def save(self):
+        """Write the status of the job, replacing the previous one"""
+        jobs_path = f'{self.cdxj_path}{JOBS_SUFFIX}'
+        os.makedirs(jobs_path, exist_ok=True)
+
+        (fd, tmp_path) = tempfile.mkstemp(dir=jobs_path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.to_dict(), f)
+            os.replace(tmp_path, os.path.join(jobs_path, f'{self.id}.json'))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+def submit(warc_path, cdxj_path):
+    """Queue a WARC to be indexed into a CDXJ file in the background"""
+    job = IndexingJob(id=uuid.uuid4().hex, warc_path=warc_path,
+                      cdxj_path=cdxj_path)
+    job.save()
+
+    start_job_worker()
+    _job_queue.put(lambda: run_job(job))
+
+    return job
+
+
+def compact_later(cdxj_path):
+    """Queue the compaction of a local index, if its delta file outgrew it"""
+    if not needs_compaction(cdxj_path):
+        return
+
+    with _compactions_lock:
+        if cdxj_path in _compactions:
+            return
+        _compactions.add(cdxj_path)
+
+    def compact():
+        with _compactions_lock:
+            _compactions.discard(cdxj_path)
+
+        print(f'Compacting the index at {cdxj_path}')
+        compact_index(cdxj_path)
+        # Read again here rather than by the next request
+        load_index(cdxj_path)
+
+    start_job_worker()
+    _job_queue.put(compact)
+
+
+def get_job(job_id, cdxj_path):
+    """The job of an id indexing into a CDXJ file, from any process"""
+    if not re.fullmatch('[0-9a-f]{32}', job_id):
+        return None
+
+    try:
+        with open(os.path.join(f'{cdxj_path}{JOBS_SUFFIX}',
+                               f'{job_id}.json'), 'r') as f:
+            return IndexingJob(**json.load(f))
+    except FileNotFoundError:
+        return None
+
+
+def forget_old_jobs(cdxj_path):
+    """Remove the status of all but the last MAX_JOBS jobs updated"""
+    jobs_path = f'{cdxj_path}{JOBS_SUFFIX}'
+    with os.scandir(jobs_path) as entries:
+        statuses = sorted((entry for entry in entries
+                           if entry.name.endswith('.json')),
+                          key=lambda entry: entry.stat().st_mtime)
+
+    for entry in statuses[:-MAX_JOBS]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:  # Removed by another process
+            pass
+
+
+def start_job_worker():
+    """Start the thread running the queued jobs, once per process"""
+    global _job_worker
+
+    if _job_worker is not None and _job_worker.is_alive():
+        return _job_worker
+
+    def work():
+        while True:
+            job = _job_queue.get()
+            try:
+                job()
+            except Exception as e:
+                print(f'Background job failed: {e!r}')
+            finally:
+                _job_queue.task_done()
+
+    _job_worker = threading.Thread(
+        target=work, name='ipwb-indexing-jobs', daemon=True)
+    _job_worker.start()
+
+    return _job_worker
+
+
+def run_job(job):
+    job.status = 'indexing'
+    job.save()
+    print(f'Indexing file from uploaded WARC at {job.warc_path} '
+          f'to {job.cdxj_path}')
+
+    try:
+        job.record_count = index_warc_into(job.warc_path, job.cdxj_path)
+    except (Exception, SystemExit) as e:  # The indexer exits on bad input
+        print(f'Indexing {job.warc_path} failed: {e!r}')
+        job.status = 'failed'
+        job.error = repr(e)
+    else:
+        print(f'Index updated at {job.cdxj_path}')
+        job.status = 'done'
+
+    job.finished_at = time.time()
+    job.save()
+    forget_old_jobs(job.cdxj_path)
+
+
+def index_warc_into(warc_path, cdxj_path):
+    """Add the records of a WARC to a local CDXJ index, returns their count"""
+    cdxj_lines = indexer.index_file_at(warc_path, quiet=True)
+    metadata = [line for line in cdxj_lines if line[:1] == '!']
+    cdxj_lines = [line for line in cdxj_lines if line[:1] != '!']
+
+    add_to_index(cdxj_path, cdxj_lines, metadata)
+
+    return len(cdxj_lines)
+
+
+def add_to_index(cdxj_path, cdxj_lines, metadata):
+    """Add records to a local index and serve them right away"""
+    append_to_index(cdxj_path, cdxj_lines, metadata)
+    compact_later(cdxj_path)
+
+    # Merge the new records into the index served from memory right away
+    load_index(cdxj_path)
+
+
+def start_stream_ingestion(stream, cdxj_path):
+    """
+    Add the CDXJ lines read from a stream to a local index as they arrive,
+    from a thread reading the stream and one adding its lines in batches.
+    """
+    lines = queue.Queue()
+
+    def read():
+        for line in stream:
+            lines.put(line.rstrip('\n'))
+        lines.put(None)
+
+    threading.Thread(target=read, name='ipwb-stream-reader',
+                     daemon=True).start()
+
+    ingester = threading.Thread(
+        target=ingest_lines, args=(lines, cdxj_path),
+        name='ipwb-stream-ingestion', daemon=True)
+    ingester.start()
+
+    return ingester
+
+
+def ingest_lines(lines, cdxj_path):
+    """Add the lines of a queue to an index until a None line"""
+    metadata = []
+    batch = []
+    batch_deadline = None  # When the lines received so far are added
+    record_count = 0
+    done = False
+
+    while not done:
+        timeout = None
+        if batch:
+            timeout = max(0, batch_deadline - time.monotonic())
+
+        try:
+            line = lines.get(timeout=timeout)
+        except queue.Empty:
+            line = ''
+
+        if line is None:
+            done = True
+        elif line[:1] == '!':
+            metadata.append(line)
+        elif line.strip():
+            if not batch:
+                batch_deadline = time.monotonic() + STREAM_BATCH_INTERVAL
+            batch.append(line)
+
+        if batch and (done or len(batch) >= STREAM_BATCH_SIZE or
+                      time.monotonic() >= batch_deadline):
+            add_to_index(cdxj_path, batch, metadata)
+            record_count += len(batch)
+            batch = []
+
+    if record_count == 0:  # Nothing was indexed
+        print('ERROR: No records were piped to the replay system, the IPFS '
+              'daemon must be running to pipe input from the indexer.')
+    else:
+        print(f'{record_count} piped records added to {cdxj_path}')
@@ -14,17 +14,16 @@ import os
 import ipfshttpclient as ipfsapi
 import json
 import subprocess
-import pkg_resources
-import surt
 import re
 import traceback
+import zlib
+import itertools
 import tempfile
 
 from flask import (
-    Flask, Response, request, redirect, render_template,
+    Flask, Response, request, redirect, render_template, jsonify,
 )
 
-from bisect import bisect_left
 from socket import gaierror
 from socket import error as socketerror
 
@@ -34,20 +33,23 @@ from six.moves.urllib_parse import urlsplit, urlunsplit
 from requests.exceptions import HTTPError
 
 from . import util as ipwb_utils
-from .backends import get_web_archive_index
+from .backends import load_indexes, MATCH_TYPES
+from .backends import get_backend, LocalIndexBackend
 from .exceptions import IPFSDaemonNotAvailable
 from .util import unsurt, ipfs_client
 from .util import IPWBREPLAY_HOST, IPWBREPLAY_PORT
 from .util import INDEX_FILE
 
-from . import indexer
+from . import frames
+from . import jobs
 
 from base64 import b64decode
 from Crypto.Cipher import AES
-from Crypto.Util.Padding import pad
 
-import base64
 
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.http import parse_accept_header, parse_etags
+from werkzeug.http import parse_range_header
 from werkzeug.routing import BaseConverter
 from .__init__ import __version__ as ipwb_version
 
@@ -102,24 +104,41 @@ def upload_file():
         flash('No selected file')
         return resp
     if file and allowed_file(file.filename):
+        index_path = get_upload_index_path()
+        if index_path is None:
+            return Response('Uploaded WARCs are only added to local indexes',
+                            status=409)
+
         filename = secure_filename(file.filename)
         warc_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         file.save(warc_path)
 
-        # TODO: Check if semaphore lock exists, log it if so, wait for the lock
-        # to be released, and create a new lock
+        # Indexed in the background, the status is served by show_job()
+        job = jobs.submit(warc_path, index_path)
 
-        print((f'Indexing file from uploaded WARC at'
-               f'{warc_path} to {app.cdxj_file_path}'))
-        indexer.index_file_at(warc_path, outfile=app.cdxj_file_path)
-        print(f'Index updated at {app.cdxj_file_path}')
+        if request.accept_mimetypes.best == 'application/json':
+            resp = jsonify(job.to_dict())
+            resp.status_code = 202
+            resp.headers['Location'] = f'/ipwbapi/jobs/{job.id}'
+            return resp
 
-        # TODO: Release semaphore lock
         resp.location = request.referrer
 
         return resp
 
 
+@app.route('/ipwbapi/jobs/<job_id>')
+def show_job(job_id):
+    index_path = get_upload_index_path()
+    job = None
+    if index_path is not None:
+        job = jobs.get_job(job_id, index_path)
+    if job is None:
+        return Response(f'No indexing job {job_id}', status=404)
+
+    return jsonify(job.to_dict())
+
+
 @app.route('/ipwbassets/<path:path>')
 def serve_assets(path):
     resp = make_response(send_from_directory('assets', path))
@@ -143,7 +162,7 @@ def command_daemon(cmd):
     elif cmd == 'stop':
         try:
             ipfs_version = ipfs_client().version()['Version']
-            if ipwb_utils.compare_versions(ipfs_version, '0.4.10') < 0:
+            if ipwb_utils.compare_versions(ipfs_version, '0.4.10'):
                 raise UnsupportedIPFSVersions()
             ipfs_client().shutdown()
         except (subprocess.CalledProcessError, UnsupportedIPFSVersions) as e:
@@ -170,6 +189,10 @@ def show_mementos_for_urirs_sans_js():
     return redirect(f'/memento/*/{urir}', code=301)
 
 
+# Number of records listed for a prefix or domain query, unless requested
+URIR_QUERY_LIMIT = 10000
+
+
 @app.route('/memento/*/<path:urir>')
 def show_mementos_for_urirs(urir):
     urir = compile_target_uri(urir, request.query_string)
@@ -177,32 +200,85 @@ def show_mementos_for_urirs(urir):
     if ipwb_utils.is_localhosty(urir):
         urir = urir.split('/', 4)[4]
 
-    index_path = ipwb_utils.get_ipwb_replay_index_path()
+    (urir, match_type) = parse_urir_query(urir)
 
-    print(f'Getting CDXJ lines with the URI-R {urir} from {index_path}')
-    cdxj_lines_with_urir = get_cdxj_lines_with_urir(urir, index_path)
+    index_path = ipwb_utils.get_ipwb_replay_index_path()
 
-    if len(cdxj_lines_with_urir) == 1:
-        fields = cdxj_lines_with_urir[0].split(' ', 2)
+    print(f'Getting CDXJ lines matching the URI-R {urir} ({match_type}) '
+          f'from {index_path}')
+    (count, cdxj_lines) = get_cdxj_lines_matching(
+        urir, match_type, index_path)
+    if count is None:  # Not known in advance for indexes searched in place
+        cdxj_lines = list(itertools.islice(cdxj_lines, URIR_QUERY_LIMIT + 1))
+        count = len(cdxj_lines)
+        cdxj_lines = iter(cdxj_lines)
+
+    if count == 1 and match_type == 'exact':
+        fields = next(cdxj_lines).split(' ', 2)
         redirect_uri = f'/memento/{fields[1]}/{unsurt(fields[0])}'
 
         return redirect(redirect_uri, code=302)
 
-    msg = ''
-    if cdxj_lines_with_urir:
-        msg += f'<p>{len(cdxj_lines_with_urir)} capture(s) available:</p><ul>'
+    if count == 0:  # No captures for URI-R
+        return Response(generate_no_mementos_interface_noDatetime(urir))
 
-        for line in cdxj_lines_with_urir:
-            fields = line.split(' ', 2)
-            dt14 = fields[1]
-            dt_rfc1123 = ipwb_utils.digits14_to_rfc1123(fields[1])
-            msg += (f'<li><a href="/memento/{dt14}/{unsurt(fields[0])}">'
-                    f'{unsurt(fields[0])} at {dt_rfc1123}</a></li>')
-        msg += '</ul>'
-    else:  # No captures for URI-R
-        msg = generate_no_mementos_interface_noDatetime(urir)
+    return Response(generate_captures_listing(
+        count, cdxj_lines, URIR_QUERY_LIMIT))
+
+
+def generate_captures_listing(count, cdxj_lines, limit):
+    """Stream the HTML list of the captures of a URI-R query"""
+    yield f'<p>{count} capture(s) available:</p><ul>'
+
+    for line in itertools.islice(cdxj_lines, limit):
+        fields = line.split(' ', 2)
+        dt14 = fields[1]
+        dt_rfc1123 = ipwb_utils.digits14_to_rfc1123(fields[1])
+        yield (f'<li><a href="/memento/{dt14}/{unsurt(fields[0])}">'
+               f'{unsurt(fields[0])} at {dt_rfc1123}</a></li>')
+    yield '</ul>'
+
+    if count > limit:
+        yield f'<p>Only the first {limit} captures are listed.</p>'
+
+
+@app.route('/ipwbapi/cdxj')
+def query_cdxj():
+    """Stream the CDXJ records of a URI-R, URI-R prefix, host or domain"""
+    urir = request.args.get('url', '').strip()
+    if not urir:
+        return Response('Searching for nothing is not allowed!', status=400)
+
+    (urir, match_type) = parse_urir_query(urir)
+    match_type = request.args.get('matchType', match_type)
+    if match_type not in MATCH_TYPES:
+        return Response(f'The matchType must be one of {MATCH_TYPES}',
+                        status=400)
+
+    try:
+        limit = int(request.args.get('limit', URIR_QUERY_LIMIT))
+    except ValueError:
+        return Response('The limit must be an integer', status=400)
+
+    index_path = ipwb_utils.get_ipwb_replay_index_path()
+    (_, cdxj_lines) = get_cdxj_lines_matching(urir, match_type, index_path)
+
+    return Response((f'{line}\n'
+                     for line in itertools.islice(cdxj_lines, max(0, limit))),
+                    mimetype='application/cdxj+ors')
+
+
+def parse_urir_query(urir):
+    """
+    Tell the match type of a URI-R query from its wildcards, as
+    `*.example.com` for a domain and `example.com/path*` for a prefix
+    """
+    if urir.startswith('*.'):
+        return (urir[2:].rstrip('*'), 'domain')
+    if urir.endswith('*'):
+        return (urir.rstrip('*'), 'prefix')
 
-    return Response(msg)
+    return (urir, 'exact')
 
 
 class RegexConverter(BaseConverter):
@@ -218,19 +294,21 @@ def resolve_memento(urir, datetime):
     """ Request a URI-R at a supplied datetime from the CDXJ """
     if ipwb_utils.is_localhosty(urir):
         urir = urir.split('/', 4)[4]
-    s = surt.surt(urir, path_strip_trailing_slash_unless_empty=False)
+    s = ipwb_utils.uri_to_surt(urir)
     index_path = ipwb_utils.get_ipwb_replay_index_path()
 
+    # Misses, frequent for resources never captured, are told without
+    # looking the URI-R up, or computing its TimeMap
+    if not load_replay_index(index_path).might_contain(s):
+        return generate_missing_urir_response(urir, datetime)
+
     print(f'Getting CDXJ lines with the URI-R {urir} from {index_path}')
     cdxj_lines_with_urir = get_cdxj_lines_with_urir(urir, index_path)
 
     closest_line = get_cdxj_line_closest_to(datetime, cdxj_lines_with_urir)
 
     if closest_line is None:
-        msg = '<h1>ERROR 404</h1>'
-        msg += f'<p>No captures found for {urir} at {datetime}.</p>'
-
-        return Response(msg, status=404)
+        return generate_missing_urir_response(urir, datetime)
 
     uri = unsurt(closest_line.split(' ')[0])
     new_datetime = closest_line.split(' ')[1]
@@ -289,45 +367,30 @@ def get_cdxj_line_closest_to(datetime_target, cdxj_lines):
     return best_line
 
 
-def get_cdxj_lines_with_urir(urir, index_path):
-    """ Get all CDXJ records corresponding to a URI-R """
+def get_cdxj_lines_matching(urir, match_type, index_path):
+    """
+    Count and lazily iterate over the CDXJ records matching a URI-R query,
+    in SURT order. The count is None when it is not known without reading
+    all of the records.
+    """
     if not index_path:
         index_path = ipwb_utils.get_ipwb_replay_index_path()
 
-    index_path = get_index_file_full_path(index_path)
-
-    print(f'Getting CDXJ lines with {urir} in {index_path}')
-    s = surt.surt(urir, path_strip_trailing_slash_unless_empty=False)
-    cdxj_lines_with_urir = []
-
-    cdxj_line_index = get_cdxj_line_binarySearch(
-        s, index_path, True, True)  # get i
+    index = load_replay_index(index_path)
+    s = ipwb_utils.uri_to_surt(urir)
 
-    if cdxj_line_index is None:
-        return []
+    return index.match(s, match_type)
 
-    cdxj_lines = []
 
-    content = get_web_archive_index(index_path)
-
-    cdxj_lines = content.split('\n')
-    base_cdxj_line = cdxj_lines[cdxj_line_index]  # via binsearch
+def get_cdxj_lines_with_urir(urir, index_path):
+    """ Get all CDXJ records corresponding to a URI-R """
+    if not index_path:
+        index_path = ipwb_utils.get_ipwb_replay_index_path()
 
-    cdxj_lines_with_urir.append(base_cdxj_line)
+    print(f'Getting CDXJ lines with {urir} in {index_path}')
+    s = ipwb_utils.uri_to_surt(urir)
 
-    # Get lines before pivot that match surt
-    sI = cdxj_line_index - 1
-    while sI >= 0:
-        if cdxj_lines[sI].split(' ')[0] == s:
-            cdxj_lines_with_urir.append(cdxj_lines[sI])
-        sI -= 1
-    # Get lines after pivot that match surt
-    sI = cdxj_line_index + 1
-    while sI < len(cdxj_lines):
-        if cdxj_lines[sI].split(' ')[0] == s:
-            cdxj_lines_with_urir.append(cdxj_lines[sI])
-        sI += 1
-    return cdxj_lines_with_urir
+    return load_replay_index(index_path).lines_with_surt(s)
 
 
 @app.route('/timegate/<path:urir>')
@@ -361,7 +424,7 @@ def query_timegate(urir):
 def show_timemap(urir, format):
     urir = compile_target_uri(urir, request.query_string)
 
-    s = surt.surt(urir, path_strip_trailing_slash_unless_empty=False)
+    s = ipwb_utils.uri_to_surt(urir)
     index_path = ipwb_utils.get_ipwb_replay_index_path()
 
     cdxj_lines_with_urir = get_cdxj_lines_with_urir(urir, index_path)
@@ -388,7 +451,7 @@ def show_timemap(urir, format):
 
 
 def get_link_header_abbreviated_timemap(urir, pivot_datetime):
-    s = surt.surt(urir, path_strip_trailing_slash_unless_empty=False)
+    s = ipwb_utils.uri_to_surt(urir)
     index_path = ipwb_utils.get_ipwb_replay_index_path()
 
     cdxj_lines_with_urir = get_cdxj_lines_with_urir(urir, index_path)
@@ -548,6 +611,70 @@ def all_exception_handler(error):
     return 'Error', 500
 
 
+# Number of URI-Rs listed per page of the web UI
+URIS_PAGE_SIZE = 100
+URIS_PAGE_SIZE_MAX = 1000
+
+
+@app.route('/ipwbapi/uris')
+def list_uris():
+    """List the URI-Rs of the index with their mementos, a page at a time"""
+    prefix = request.args.get('prefix', '').strip()
+    cursor = request.args.get('cursor') or None
+    try:
+        limit = int(request.args.get('limit', URIS_PAGE_SIZE))
+    except ValueError:
+        return Response('The limit must be an integer', status=400)
+    limit = max(1, min(limit, URIS_PAGE_SIZE_MAX))
+
+    surt_prefix = ''
+    if prefix:
+        surt_prefix = ipwb_utils.uri_to_surt(prefix)
+
+    index_path = ipwb_utils.get_ipwb_replay_index_path()
+    index = load_replay_index(index_path)
+
+    (uris, next_cursor) = get_uris_page(index, surt_prefix, cursor, limit)
+
+    return jsonify({'uris': uris, 'cursor': next_cursor})
+
+
+def get_uris_page(index, surt_prefix, cursor, limit):
+    """
+    Up to `limit` URI-Rs with a SURT prefix, following the SURT of a cursor.
+
+    Returns the URI-Rs in SURT order with their mementos and the cursor of
+    the next page, None on the last page.
+    """
+    uris = []
+    last_surt = None
+    for line in index.iter_prefix(surt_prefix, cursor):
+        (surt_uri, datetime, json_data) = line.split(' ', 2)
+        if surt_uri != last_surt:
+            if len(uris) == limit:
+                return (uris, last_surt)
+            uris.append({'uri': unsurt(surt_uri), 'mementos': []})
+            last_surt = surt_uri
+
+        try:
+            json_fields = json.loads(json_data)
+        except ValueError:  # Skip lines w/o JSON block
+            continue
+        if len(datetime) != 14:
+            continue
+
+        memento = {
+            'datetime': datetime,
+            'mime': json_fields.get('mime_type') or '',
+            'status': json_fields.get('status_code', '')
+        }
+        if 'title' in json_fields:
+            memento['title'] = json_fields['title']
+        uris[-1]['mementos'].append(memento)
+
+    return (uris, None)
+
+
 @app.route('/ipwbadmin', strict_slashes=False)
 def show_admin():
     status = {'ipwb_version': ipwb_version,
@@ -556,23 +683,21 @@ def show_admin():
 
     memento_info = calculate_memento_info_in_index(index_file)
 
-    m_count = memento_info['memento_count']
-    unique_urirs = len(memento_info['surt_uris'].keys())
-    html_count = memento_info['html_count']
+    (m_count, unique_urirs, html_count) = summarize_counts(memento_info)
     oldest_datetime = memento_info['oldest_datetime']
     newest_datetime = memento_info['newest_datetime']
 
-    uris = get_uris_and_datetimes_in_cdxj(index_file)
-
-    # TODO: Calculate actual URI-R/M counts
-    indexes = [{'path': ipwb_utils.get_ipwb_replay_index_path(),
-                'enabled': True,
-                'urim_count': m_count,
-                'urir_count': unique_urirs}]
+    indexes = []
+    for index_path in get_index_paths(index_file):
+        index_info = calculate_memento_info_in_index(index_path)
+        (urim_count, urir_count, _) = summarize_counts(index_info)
+        indexes.append({'path': index_path,
+                        'enabled': True,
+                        'urim_count': urim_count,
+                        'urir_count': urir_count})
     # TODO: Calculate actual values
     summary = {'urim_count': m_count,
                'urir_count': unique_urirs,
-               'uris': uris,
                'html_count': html_count,
                'earliest': oldest_datetime,
                'latest': newest_datetime}
@@ -586,41 +711,32 @@ def show_landing_page():
     index_file = ipwb_utils.get_ipwb_replay_index_path()
     memento_info = calculate_memento_info_in_index(index_file)
 
-    m_count = memento_info['memento_count']
-    unique_urirs = len(memento_info['surt_uris'].keys())
-    html_count = memento_info['html_count']
+    (m_count, unique_urirs, html_count) = summarize_counts(memento_info)
 
-    summary = {'index_path': index_file,
+    summary = {'index_path': ', '.join(get_index_paths(index_file)),
                'urim_count': m_count,
                'urir_count': unique_urirs,
                'html_count': html_count}
-    uris = get_uris_and_datetimes_in_cdxj(index_file)
-    return render_template('index.html', summary=summary, uris=uris)
 
+    # The URI listing is fetched by the page on demand, see list_uris()
+    return render_template('index.html', summary=summary)
 
-def show_uri(path, datetime=None):
-    try:
-        ipwb_utils.check_daemon_is_alive(ipwb_utils.IPFSAPI_MUTLIADDRESS)
 
-    except IPFSDaemonNotAvailable:
-        errStr = ('IPFS daemon not running. '
-                  'Start it using $ ipfs daemon on the command-line '
-                  ' or from the <a href="/">'
-                  'IPWB replay homepage</a>.')
+DAEMON_NOT_RUNNING_MSG = ('IPFS daemon not running. '
+                          'Start it using $ ipfs daemon on the command-line '
+                          ' or from the <a href="/">'
+                          'IPWB replay homepage</a>.')
+
 
-        return Response(errStr, status=503)
+def show_uri(path, datetime=None):
+    # Daemon health is tracked from the outcome of real IPFS calls and a
+    # background monitor, so no liveness probe is needed per request
+    if not ipwb_utils.daemon_health.is_available():
+        return Response(DAEMON_NOT_RUNNING_MSG, status=503)
 
     cdxj_line = ''
     try:
-        surted_uri = surt.surt(
-                     path, path_strip_trailing_slash_unless_empty=False)
-        index_path = ipwb_utils.get_ipwb_replay_index_path()
-
-        search_string = surted_uri
-        if datetime is not None:
-            search_string = f'{surted_uri} {datetime}'
-
-        cdxj_line = get_cdxj_line_binarySearch(search_string, index_path)
+        cdxj_line = get_memento_cdxj_line(path, datetime)
 
     except Exception as e:
         print(sys.exc_info()[0])
@@ -634,8 +750,19 @@ def show_uri(path, datetime=None):
 
     cdxj_parts = cdxj_line.split(" ", 2)
     json_object = json.loads(cdxj_parts[2])
-    datetime = cdxj_parts[1]
 
+    # Mementos are immutable, a cached copy is valid without fetching it
+    etag = get_memento_etag(json_object,
+                            request.headers.get('Accept-Encoding'))
+    if is_not_modified(request.headers.get('If-None-Match'), etag):
+        return generate_not_modified_response(etag, cdxj_parts[1])
+
+    # Only the bytes asked for are fetched when they can be decoded alone
+    try:
+        window = get_payload_window(json_object, request.headers.get('Range'),
+                                    request.headers.get('If-Range'))
+    except RequestedRangeNotSatisfiable as e:
+        return e.get_response()
     digests = json_object['locator'].split('/')
 
     class HashNotFoundError(Exception):
@@ -651,12 +778,21 @@ def show_uri(path, datetime=None):
         #    signal.signal(signal.SIGALRM, handler)
         #    signal.alarm(10)
 
-        payload = ipfs_client().cat(digests[-1])
-        header = ipfs_client().cat(digests[-2])
+        if window is None:
+            payload = ipfs_client().cat(digests[-1])
+        else:
+            payload = fetch_payload_window(
+                ipfs_client().cat, digests[-1], json_object, window)
+        if 'headers' not in json_object:  # Not stored in the index
+            header = ipfs_client().cat(digests[-2])
+        ipwb_utils.daemon_health.record_success()
 
         # if os.name != 'nt':  # Bug #310
         #    signal.alarm(0)
 
+    except ipfsapi.exceptions.ConnectionError:
+        ipwb_utils.daemon_health.record_failure()
+        return Response(DAEMON_NOT_RUNNING_MSG, status=503)
     except ipfsapi.exceptions.TimeoutError:
         print(f"{cdxj_parts[0]} not found at {digests[-1]}")
         resp_string = (
@@ -684,24 +820,276 @@ def show_uri(path, datetime=None):
         print(e)
         return "An unknown exception occurred", 500
 
+    return build_memento_response(cdxj_line, header, payload, request.url,
+                                  request.headers.get('Accept-Encoding'),
+                                  window)
+
+
+def get_memento_cdxj_line(path, datetime=None):
+    """Look up the CDXJ line of a URI-R, optionally at an exact datetime"""
+    surted_uri = ipwb_utils.uri_to_surt(path)
+    index_path = ipwb_utils.get_ipwb_replay_index_path()
+
+    search_string = surted_uri
+    if datetime is not None:
+        search_string = f'{surted_uri} {datetime}'
+
+    return get_cdxj_line_binarySearch(search_string, index_path)
+
+
+def build_memento_response(cdxj_line, header, payload, request_url,
+                           accept_encoding=None, payload_window=None):
+    """
+    Assemble the replay response of a memento from its IPFS contents.
+
+    When a payload_window (start, stop) is given, the payload is only those
+    bytes of the stored one, as fetched for a Range request.
+    """
+    cdxj_parts = cdxj_line.split(" ", 2)
+    json_object = json.loads(cdxj_parts[2])
+    datetime = cdxj_parts[1]
+    mime = json_object['mime_type']
+
+    layers = get_storage_layers(json_object)
+    pass_through = is_passed_through(json_object, accept_encoding)
+    if pass_through:
+        layers.pop()
+
+    for layer in layers:
+        if layer == 'aes':
+            (header, payload) = decrypt_record(
+                header, payload, json_object,
+                payload_window[0] if payload_window else 0)
+        elif layer == 'zlib':
+            payload = zlib.decompress(payload)
+            if header is not None:
+                header = zlib.decompress(header)
+        elif layer == 'zlib-frames':
+            if payload_window is None:  # Otherwise decompressed when fetched
+                payload = frames.decompress_frames(payload)
+            if header is not None:
+                header = frames.decompress_frames(header)
+    if pass_through and header is not None:
+        header = zlib.decompress(header)
+
+    status = 200
+    if 'status_code' in json_object:
+        status = json_object['status_code']
+
+    resp = Response(payload, status=status)
+
+    if 'headers' in json_object:
+        # Parsed and rewritten for replay by the indexer already
+        for (k, v) in json_object['headers']:
+            resp.headers[k] = v
+    else:
+        apply_archived_headers(resp, header, json_object)
+
+    if json_object.get('compression') == 'zlib':
+        resp.headers['Vary'] = 'Accept-Encoding'
+        if pass_through:
+            resp.headers['Content-Encoding'] = 'deflate'
+
+    if is_seekable(json_object):
+        resp.headers['Accept-Ranges'] = 'bytes'
+    if payload_window is not None:
+        (start, stop) = payload_window
+        resp.status_code = 206
+        resp.headers['Content-Range'] = \
+            f'bytes {start}-{stop - 1}/{json_object["payload_length"]}'
+
+    # Add ipwb header for additional SW logic
+    if 'text/html' in mime:
+        resp.set_data(inject_ipwb_js(resp.get_data()))
+
+    resp.headers['Memento-Datetime'] = ipwb_utils.digits14_to_rfc1123(datetime)
+    set_cache_validators(resp, get_memento_etag(json_object, accept_encoding))
+
+    if header is None and 'headers' not in json_object:
+        resp.headers['X-Headers-Generated-By'] = 'InterPlanetary Wayback'
+
+    # Get TimeMap for Link response header
+    # respWithlink_header = get_link_header_abbreviated_timemap(path, datetime)
+    # resp.headers['Link'] = respWithlink_header.replace('\n', ' ')
+
+    if status[0] == '3' and isUri(resp.headers.get('Location')):
+        # Bad assumption that the URI-M will contain \d14 but works for now.
+        uri_before_urir = request_url[
+                          :re.search(r'/\d{14}/', request_url).end()]
+        new_urim = uri_before_urir + resp.headers['Location']
+        resp.headers['Location'] = new_urim
+
+    return resp
+
+
+# URI-Ms with an exact datetime never change
+MEMENTO_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+def get_memento_etag(json_object, accept_encoding=None):
+    """
+    Strong entity tag of a memento, derived from the CID of its payload.
+
+    The ipwb scripts injected into HTML pages change with the version of
+    ipwb, so the version is part of the tag of those. Payloads sent
+    compressed as stored have a tag of their own.
+    """
+    etag = json_object['locator'].split('/')[-1]
+
+    if 'text/html' in json_object.get('mime_type', ''):
+        etag = f'{etag}-{ipwb_version}'
+    elif is_passed_through(json_object, accept_encoding):
+        etag = f'{etag}-deflate'
+
+    return etag
+
+
+def is_not_modified(if_none_match, etag):
+    """Whether an If-None-Match request header matches an entity tag"""
+    if not if_none_match:
+        return False
+
+    return parse_etags(if_none_match).contains_weak(etag)
+
+
+def set_cache_validators(resp, etag):
+    resp.set_etag(etag)
+    resp.headers['Cache-Control'] = MEMENTO_CACHE_CONTROL
+
+
+def generate_not_modified_response(etag, datetime):
+    resp = Response(status=304)
+    set_cache_validators(resp, etag)
+    resp.headers['Memento-Datetime'] = ipwb_utils.digits14_to_rfc1123(datetime)
+
+    return resp
+
+
+def is_passed_through(json_object, accept_encoding=None):
+    """
+    Whether a compressed payload is sent as it is stored, to the clients
+    that accept it, rather than decompressed. HTML is rewritten so never is.
+    """
+    return get_storage_layers(json_object)[-1:] == ['zlib'] and \
+        'text/html' not in json_object.get('mime_type', '') and \
+        parse_accept_header(accept_encoding).quality('deflate') > 0
+
+
+def get_storage_layers(json_object):
+    """The codecs the indexer stored a record with, the outermost first"""
+    layers = []
     if 'encryption_method' in json_object:
-        key_string = None
-        while key_string is None:
-            if 'encryption_key' in json_object:
-                key_string = json_object['encryption_key']
-            else:
-                ask_for_key = ('Enter a path for file',
-                               ' containing decryption key: \n> ')
-                key_string = raw_input(ask_for_key)
+        layers.append('aes')
+    if 'compression' in json_object:
+        if json_object.get('compressed_first'):
+            layers.append(json_object['compression'])
+        else:
+            layers.insert(0, json_object['compression'])
+
+    return layers
+
+
+def is_seekable(json_object):
+    """
+    Whether any byte range of a memento can be fetched from IPFS and decoded
+    without the rest of its payload, i.e., it is stored as is or only
+    encrypted with AES-CTR, which is seekable, then possibly compressed in
+    frames
+    """
+    layers = get_storage_layers(json_object)
+    if layers[:1] == ['zlib-frames']:
+        layers.pop(0)  # Only the frames holding a range are decompressed
+
+    return 'payload_length' in json_object and \
+        json_object.get('status_code', '200') == '200' and \
+        'text/html' not in json_object['mime_type'] and \
+        layers in ([], ['aes']) and \
+        json_object.get('encryption_encoding', 'binary') == 'binary'
+
+
+def fetch_payload_window(cat, ipfs_hash, json_object, window):
+    """
+    Fetch a (start, stop) window of a payload with only the bytes stored for
+    it, decompressed from its frames if stored in frames
+    """
+    if json_object.get('compression') != 'zlib-frames':
+        (start, stop) = window
+        return cat(ipfs_hash, offset=start, length=stop - start)
+
+    size = frames.table_size(json_object['payload_length'],
+                             json_object['frame_size'])
+    table = frames.read_table(cat(ipfs_hash, offset=0, length=size))
+    (start, stop) = frames.locate(table, window)
+
+    return frames.extract(cat(ipfs_hash, offset=start, length=stop - start),
+                          table, window)
+
+
+def get_payload_window(json_object, range_header, if_range=None):
+    """
+    The (start, stop) byte offsets of the payload asked for by a Range
+    request, None when the whole memento is to be sent instead
+    """
+    if not range_header or not is_seekable(json_object):
+        return None
+    if if_range and if_range != f'"{get_memento_etag(json_object)}"':
+        return None  # The client has another representation
+
+    byte_range = parse_range_header(range_header)
+    if byte_range is None or byte_range.units != 'bytes' or \
+            len(byte_range.ranges) != 1:
+        return None  # Multiple ranges are served as a whole
+
+    length = json_object['payload_length']
+    window = byte_range.range_for_length(length)
+    if window is None:
+        raise RequestedRangeNotSatisfiable(length)
+
+    return window
+
+
+def seek_cipher(key, nonce, position):
+    """An AES-CTR cipher positioned at a byte offset of its key stream"""
+    (block, skip) = divmod(position, AES.block_size)
+    cipher = AES.new(key, AES.MODE_CTR, nonce=nonce, initial_value=block)
+    cipher.decrypt(bytes(skip))
+
+    return cipher
+
+
+def decrypt_record(header, payload, json_object, payload_offset=0):
+    """
+    Decrypt the HTTP header and payload of a record, the payload starting
+    at payload_offset bytes of the stored one
+    """
+    key_string = None
+    while key_string is None:
+        if 'encryption_key' in json_object:
+            key_string = json_object['encryption_key']
+        else:
+            ask_for_key = ('Enter a path for file',
+                           ' containing decryption key: \n> ')
+            key_string = raw_input(ask_for_key)
+
+    key = ipwb_utils.derive_encryption_key(key_string)
 
-        padded_encryption_key = pad(key_string, AES.block_size)
-        key = base64.b64encode(padded_encryption_key)
+    if json_object.get('encryption_encoding') != 'binary':
+        # Indexed by older versions, which base64 encoded the ciphertext
+        header = b64decode(header)
+        payload = b64decode(payload)
 
-        nonce = b64decode(json_object['encryption_nonce'])
-        cipher = AES.new(key, AES.MODE_CTR, nonce=nonce)
-        header = cipher.decrypt(base64.b64decode(header))
-        payload = cipher.decrypt(base64.b64decode(payload))
+    nonce = b64decode(json_object['encryption_nonce'])
+    cipher = AES.new(key, AES.MODE_CTR, nonce=nonce)
+    header = cipher.decrypt(header)
+    if payload_offset:
+        # The payload was encrypted right after the header
+        cipher = seek_cipher(key, nonce, len(header) + payload_offset)
 
+    return (header, cipher.decrypt(payload))
+
+
+def apply_archived_headers(resp, header, json_object):
+    """Parse an archived HTTP header block and set it on the response"""
     h_lines = header.decode() \
         .replace('\r', '') \
         .replace('\n\t', '\t') \
@@ -709,60 +1097,60 @@ def show_uri(path, datetime=None):
         .split('\n')
     h_lines.pop(0)
 
-    status = 200
-    if 'status_code' in json_object:
-        status = json_object['status_code']
-
-    resp = Response(payload, status=status)
-
     for idx, hLine in enumerate(h_lines):
         k, v = hLine.split(':', 1)
 
+        # Payloads are de-chunked by the indexer as of recording `dechunked`
         if k.lower() == 'transfer-encoding' and \
+                not json_object.get('dechunked') and \
                 re.search(r'\bchunked\b', v, re.I):
             try:
-                unchunked_payload = extract_response_from_chunked_data(payload)
+                unchunked_payload = extract_response_from_chunked_data(
+                    resp.get_data())
             except Exception as e:
                 continue  # Data not chunked
             resp.set_data(unchunked_payload)
 
-        if k.lower() not in ["content-type", "content-encoding", "location"]:
-            k = f'X-Archive-Orig-{k}'
+        resp.headers[ipwb_utils.archived_header_name(k)] = v.strip()
 
-        resp.headers[k] = v.strip()
 
-    # Add ipwb header for additional SW logic
-    new_payload = resp.get_data()
+IPWB_JS_INJECT = b"""<script src="/ipwbassets/webui.js"></script>
+                      <script>injectIPWBJS()</script>"""
 
-    line_json = cdxj_line.split(' ', 2)[2]
-    mime = json.loads(line_json)['mime_type']
+# Only the tail of a payload is searched for the closing html tag
+JS_INJECT_SEARCH_WINDOW = 4096
 
-    if 'text/html' in mime:
-        ipwb_js_inject = """<script src="/ipwbassets/webui.js"></script>
-                      <script>injectIPWBJS()</script>"""
+html_end_tag = re.compile(rb'</html\s*>', re.IGNORECASE)
 
-        new_payload = new_payload.decode('utf-8').replace(
-            '</html>', f'{ipwb_js_inject}</html>')
+utf16_boms = {b'\xff\xfe': 'utf-16-le', b'\xfe\xff': 'utf-16-be'}
 
-        resp.set_data(new_payload)
 
-    resp.headers['Memento-Datetime'] = ipwb_utils.digits14_to_rfc1123(datetime)
+def inject_ipwb_js(payload):
+    """
+    Insert the ipwb scripts before the last closing html tag of a payload.
 
-    if header is None:
-        resp.headers['X-Headers-Generated-By'] = 'InterPlanetary Wayback'
+    The bytes are rewritten in place of decoding the page, so any
+    ASCII-compatible encoding is preserved. Pages without a closing html
+    tag near their end get the scripts appended.
+    """
+    encoding = utf16_boms.get(payload[:2], '')
+    tail_start = max(0, len(payload) - JS_INJECT_SEARCH_WINDOW)
 
-    # Get TimeMap for Link response header
-    # respWithlink_header = get_link_header_abbreviated_timemap(path, datetime)
-    # resp.headers['Link'] = respWithlink_header.replace('\n', ' ')
+    if not encoding:
+        inject = IPWB_JS_INJECT
+        last_match = None
+        for last_match in html_end_tag.finditer(payload, tail_start):
+            pass
+        pos = last_match.start() if last_match else -1
+    else:
+        inject = IPWB_JS_INJECT.decode('ascii').encode(encoding)
+        pos = max(payload.rfind(tag.encode(encoding), tail_start)
+                  for tag in ('</html>', '</HTML>'))
 
-    if status[0] == '3' and isUri(resp.headers.get('Location')):
-        # Bad assumption that the URI-M will contain \d14 but works for now.
-        uri_before_urir = request.url[
-                          :re.search(r'/\d{14}/', request.url).end()]
-        new_urim = uri_before_urir + resp.headers['Location']
-        resp.headers['Location'] = new_urim
+    if pos < 0:
+        return payload + inject
 
-    return resp
+    return b''.join([payload[:pos], inject, payload[pos:]])
 
 
 def isUri(str):
@@ -788,6 +1176,13 @@ def page_not_found(e):
     return "<h1>ERROR 404</h1><p>Resource not found</p>", 404
 
 
+def generate_missing_urir_response(urir, datetime):
+    msg = '<h1>ERROR 404</h1>'
+    msg += f'<p>No captures found for {urir} at {datetime}.</p>'
+
+    return Response(msg, status=404)
+
+
 def generate_no_mementos_interface(path, datetime):
     msg = '<h1>ERROR 404</h1>'
     msg += f'<p>No captures found for {path} at {datetime}.</p>'
@@ -830,28 +1225,81 @@ def generate_no_mementos_interface(path, datetime):
     return resp
 
 
-def extract_response_from_chunked_data(data):
-    retStr = ''
+class ChunkedDecoder:
+    """
+    Incremental decoder of a payload with chunked transfer coding.
+
+    Data can be fed as it arrives, each call returns the payload bytes that
+    could be decoded so far. Chunk extensions are ignored and trailer
+    fields are collected in `trailers`. Raises ValueError on data that is
+    not chunked.
+    """
+
+    def __init__(self):
+        self.trailers = []
+        self.last_chunk_seen = False
+        self.done = False
+        self._buffer = bytearray()
+        self._remaining = 0  # Bytes left in the current chunk
+        self._expect_crlf = False
+
+    def feed(self, data):
+        self._buffer += data
+        view = memoryview(self._buffer)
+        parts = []
+        pos = 0
+
+        while not self.done:
+            if self._remaining:
+                n = min(self._remaining, len(view) - pos)
+                if n == 0:
+                    break
+                parts.append(view[pos:pos + n])
+                pos += n
+                self._remaining -= n
+                self._expect_crlf = self._remaining == 0
+                continue
 
-    if isinstance(data, bytes):
-        data = data.decode()
-    (chunk_descriptor, rest) = data.split('\n', 1)
-    chunk_descriptor = chunk_descriptor.split(';')[0].strip()
+            eol = self._buffer.find(b'\n', pos)
+            if eol < 0:
+                break
+            line = bytes(view[pos:eol]).rstrip(b'\r')
+            pos = eol + 1
+
+            if self._expect_crlf:
+                self._expect_crlf = False
+                if line:
+                    raise ValueError('Chunk is longer than its size')
+            elif self.last_chunk_seen:
+                if line:
+                    self.trailers.append(line)
+                else:
+                    self.done = True
+            else:
+                chunk_size = line.split(b';', 1)[0].strip()
+                self._remaining = int(chunk_size, 16)
+                self.last_chunk_seen = self._remaining == 0
 
-    while chunk_descriptor != '0':
-        # On fail, exception, delta in header vs. payload chunkedness
-        chunk_dec_from_hex = int(chunk_descriptor, 16)  # Get dec for slice
+        decoded = b''.join(parts)
 
-        retStr += rest[:chunk_dec_from_hex]  # Add to payload
-        rest = rest[chunk_dec_from_hex:]  # Trim from the next chunk onward
+        # Release the views before the consumed data is dropped
+        for part in parts:
+            part.release()
+        view.release()
+        del self._buffer[:pos]
 
-        (CRLF, chunk_descriptor, rest) = rest.split('\n', 2)
-        chunk_descriptor = chunk_descriptor.split(';')[0].strip()
+        return decoded
 
-        if len(chunk_descriptor.strip()) == 0:
-            break
 
-    return retStr
+def extract_response_from_chunked_data(data):
+    decoder = ChunkedDecoder()
+    payload = decoder.feed(data)
+
+    # On fail, exception, delta in header vs. payload chunkedness
+    if not decoder.last_chunk_seen:
+        raise ValueError('Chunked data is truncated')
+
+    return payload
 
 
 def generate_daemon_status_button():
@@ -892,161 +1340,69 @@ def get_index_file_full_path(cdxj_file_path=INDEX_FILE):
     if os.path.isfile(cdxj_file_path):
         return cdxj_file_path
 
-    index_file_name = pkg_resources.resource_filename(
-        __name__, index_file_path)
+    # Relative to the package, as pkg_resources.resource_filename() did
+    index_file_name = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   *index_file_path.split('/'))
     return index_file_name
 
 
-def get_uris_and_datetimes_in_cdxj(cdxj_file_path=INDEX_FILE):
-    index_file_contents = get_web_archive_index(cdxj_file_path)
+def get_index_paths(cdxj_file_path):
+    """The paths of the indexes of the replay system, one or many"""
+    if isinstance(cdxj_file_path, str):
+        return [cdxj_file_path]
 
-    if not index_file_contents:
-        return 0
+    return list(cdxj_file_path)
 
-    lines = index_file_contents.strip().split('\n')
 
-    uris = {}
-    for i, l in enumerate(lines):
-        if not ipwb_utils.is_valid_cdxj_line(l):
-            continue
-
-        if ipwb_utils.is_cdxj_metadata_record(l):
-            continue
-
-        cdxj_fields = l.split(' ', 2)
-        uri = unsurt(cdxj_fields[0])
-        datetime = cdxj_fields[1]
-
-        try:
-            json_fields = json.loads(cdxj_fields[2])
-        except Exception as e:  # Skip lines w/o JSON block
-            continue
+def get_upload_index_path():
+    """
+    The path of the index uploaded WARCs are added to, the first one of the
+    replay system, None if it is not a local file
+    """
+    index_path = get_index_paths(app.cdxj_file_path)[0]
+    if not isinstance(get_backend(index_path), LocalIndexBackend):
+        return None
 
-        if uri not in uris:
-            uris[uri] = []
+    return get_index_file_full_path(index_path)
 
-        memento_as_json = {
-            'datetime': datetime,
-            'mime': json_fields['mime_type'] or '',
-            'status': json_fields['status_code']
-        }
-        if 'title' in json_fields:
-            memento_as_json['title'] = json_fields['title']
-
-        uris[uri].append(memento_as_json)
 
-    return json.dumps(uris)
+def load_replay_index(cdxj_file_path=INDEX_FILE):
+    """Load the index of the replay system, federated from many if a list"""
+    return load_indexes([get_index_file_full_path(path)
+                         for path in get_index_paths(cdxj_file_path)])
 
 
 def calculate_memento_info_in_index(cdxj_file_path=INDEX_FILE):
-    print(f'Retrieving URI-Ms from {cdxj_file_path}')
-    index_file_contents = get_web_archive_index(cdxj_file_path)
-
-    err_return = (0, 0)
-
-    if not index_file_contents:
-        return err_return
-
-    lines = index_file_contents.strip().split('\n')
-
-    if not lines:
-        return err_return
-
-    memento_info = {
-        'memento_count': 0,
-        'html_count': 0,
-        'surt_uris': {},
-        'oldest_datetime': None,
-        'newest_datetime': None
-    }
-
-    for i, l in enumerate(lines):
-        valid_cdxj_line = ipwb_utils.is_valid_cdxj_line(l)
-        metadata_record = ipwb_utils.is_cdxj_metadata_record(l)
-        if valid_cdxj_line and not metadata_record:
-            memento_info['memento_count'] += 1
-            (surt_uri, datetime, jsonInLine) = l.split(' ', 2)
-            if surt_uri not in memento_info['surt_uris']:
-                memento_info['surt_uris'][surt_uri] = 1
-            else:  # Unnecessary to keep count now, maybe useful later
-                memento_info['surt_uris'][surt_uri] += 1
-
-            j = json.loads(jsonInLine)
-
-            # Count only non-redirect HTML pages for html_count display
-            if j['mime_type'] and \
-                    j['mime_type'].lower().startswith('text/html') and \
-                    j['status_code'][0] != '3':
-                memento_info['html_count'] += 1
-
-            if memento_info['oldest_datetime'] is None:
-                memento_info['oldest_datetime'] = datetime
-                memento_info['newest_datetime'] = datetime
-                continue
-
-            if datetime < memento_info['oldest_datetime']:
-                memento_info['oldest_datetime'] = datetime
-            if datetime > memento_info['newest_datetime']:
-                memento_info['newest_datetime'] = datetime
-
-    return memento_info
-
-
-def objectify_cdxj_data(lines, only_uri):
-    cdxj_data = {'metadata': [], 'data': []}
-    for line in lines:
-        if len(line.strip()) == 0:
-            break
-        if line[0] != '!':
-            (surt, datetime, the_rest) = line.split(' ', 2)
-            search_string = f"{surt} {datetime}"
-            if only_uri:
-                search_string = surt
-            cdxj_data['data'].append(search_string)
-        else:
-            cdxj_data['metadata'].append(line)
-    return cdxj_data
+    index = load_replay_index(cdxj_file_path)
 
+    return index.get_summary()
 
-def binary_search(haystack, needle, returnIndex=False, only_uri=False):
-    lBound = 0
-    uBound = None
 
-    surt_uris_and_datetimes = []
+def summarize_counts(memento_info):
+    """
+    The memento, URI-R and HTML page counts of an index summary, unknown
+    for indexes searched in place
+    """
+    if memento_info['memento_count'] is None:
+        return ('Unknown', 'Unknown', 'Unknown')
 
-    cdxj_obj = objectify_cdxj_data(haystack, only_uri)
-    surt_uris_and_datetimes = cdxj_obj['data']
-
-    meta_line_count = len(cdxj_obj['metadata'])
-
-    uBound = len(surt_uris_and_datetimes)
-
-    pos = bisect_left(surt_uris_and_datetimes, needle, lBound, uBound)
-
-    if pos != uBound and surt_uris_and_datetimes[pos] == needle:
-        if returnIndex:  # Index useful for adjacent line searching
-            return pos + meta_line_count
-        return haystack[pos + meta_line_count]
-    else:
-        return None
+    return (memento_info['memento_count'], len(memento_info['surt_uris']),
+            memento_info['html_count'])
 
 
 def get_cdxj_line_binarySearch(
-         surt_uri, cdxj_file_path=INDEX_FILE, retIndex=False, only_uri=False):
-    full_file_path = get_index_file_full_path(cdxj_file_path)
-
-    content = get_web_archive_index(full_file_path)
+         surt_uri, cdxj_file_path=INDEX_FILE, only_uri=False):
+    index = load_replay_index(cdxj_file_path)
 
-    lines = content.split('\n')
+    line = index.find_line(surt_uri, only_uri)
+    if line is None:
+        print(f"Could not find {surt_uri} in CDXJ at {cdxj_file_path}")
 
-    line_found = binary_search(lines, surt_uri, retIndex, only_uri)
-    if line_found is None:
-        print(f"Could not find {surt_uri} in CDXJ at {full_file_path}")
+    return line
 
-    return line_found
 
-
-def start(cdxj_file_path, proxy=None):
+def setup_replay(cdxj_file_path, proxy=None):
+    """Configure the replay app, shared by all of the serving modes"""
     host_port = ipwb_utils.get_ipwb_replay_config()
     app.proxy = proxy
 
@@ -1055,10 +1411,21 @@ def start(cdxj_file_path, proxy=None):
 
     # This will throw an exception if daemon is not available.
     ipwb_utils.check_daemon_is_alive()
+    ipwb_utils.start_daemon_health_monitor()
 
     ipwb_utils.set_ipwb_replay_index_path(cdxj_file_path)
     app.cdxj_file_path = cdxj_file_path
 
+    # E.g., of the records added by `ipwb index -o` since the last time
+    for index_path in get_index_paths(cdxj_file_path):
+        index_path = get_index_file_full_path(index_path)
+        if os.path.isfile(index_path):
+            jobs.compact_later(index_path)
+
+
+def start(cdxj_file_path, proxy=None):
+    setup_replay(cdxj_file_path, proxy)
+
     try:
         print((f'IPWB replay started on '
                f'http://{IPWBREPLAY_HOST}:{IPWBREPLAY_PORT}'))
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+InterPlanetary Wayback asynchronous replay
+
+This script serves the routes of the ipwb replay system on an asyncio (ASGI)
+server. Mementos are fetched from IPFS with non-blocking HTTP calls, so a
+single process can hold many slow IPFS fetches at once. Every other route is
+handed over to the Flask app of the replay system, which is run in a thread
+pool.
+
+The async mode needs additional packages: pip install ipwb[async]
+"""
+
+import asyncio
+import functools
+import json
+import re
+import sys
+import traceback
+
+from flask import Response, redirect
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+
+from . import frames
+from . import replay
+from . import util as ipwb_utils
+from .util import IPWBREPLAY_HOST, IPWBREPLAY_PORT
+
+try:
+    import httpx
+    import uvicorn
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError as err:
+    raise ImportError(
+        'The async replay mode requires additional packages, install them '
+        'using: pip install ipwb[async]'
+    ) from err
+
+# Limits of the connections to the IPFS HTTP API
+IPFS_MAX_CONNECTIONS = 1000
+IPFS_TIMEOUT = 60
+
+memento_route = re.compile(r'^/memento/([0-9]{1,14})/(.+)$')
+
+wsgi_app = WsgiToAsgi(replay.app)
+
+_ipfs_http_client = None
+
+
+def ipfs_http_client():
+    """Create and cache an asynchronous client of the IPFS HTTP API."""
+    global _ipfs_http_client
+
+    if _ipfs_http_client is None:
+        _ipfs_http_client = httpx.AsyncClient(
+            base_url=ipwb_utils.multiaddr_to_url(
+                ipwb_utils.IPFSAPI_MUTLIADDRESS),
+            timeout=IPFS_TIMEOUT,
+            limits=httpx.Limits(max_connections=IPFS_MAX_CONNECTIONS))
+
+    return _ipfs_http_client
+
+
+async def cat(ipfs_hash, window=None):
+    """
+    Fetch the content at an IPFS hash without blocking the event loop, only
+    the (start, stop) bytes of it if a window is given
+    """
+    params = {'arg': ipfs_hash}
+    if window is not None:
+        params.update({'offset': window[0], 'length': window[1] - window[0]})
+    resp = await ipfs_http_client().post('/api/v0/cat', params=params)
+    resp.raise_for_status()
+
+    return resp.content
+
+
+async def fetch_payload_window(ipfs_hash, json_object, window):
+    """The async counterpart of replay.fetch_payload_window()"""
+    if json_object.get('compression') != 'zlib-frames':
+        return await cat(ipfs_hash, window)
+
+    size = frames.table_size(json_object['payload_length'],
+                             json_object['frame_size'])
+    table = frames.read_table(await cat(ipfs_hash, (0, size)))
+    stored = await cat(ipfs_hash, frames.locate(table, window))
+
+    return frames.extract(stored, table, window)
+
+
+async def run_sync(f, *args):
+    """Run a blocking function of the replay system in the thread pool"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, functools.partial(f, *args))
+
+
+async def show_memento(urir, datetime, request_url, request_headers):
+    try:
+        datetime = ipwb_utils.pad_digits14(datetime, validate=True)
+    except ValueError:
+        msg = f'Expected a 4-14 digits valid datetime: {datetime}'
+        return Response(msg, status=400)
+
+    resolved_memento = await run_sync(replay.resolve_memento, urir, datetime)
+
+    # resolved to a 404, flask Response object returned instead of tuple
+    if isinstance(resolved_memento, Response):
+        return resolved_memento
+    (new_datetime, link_header, uri) = resolved_memento
+
+    if new_datetime != datetime:
+        resp = redirect(f'/memento/{new_datetime}/{urir}', code=302)
+    else:
+        resp = await show_uri(uri, new_datetime, request_url,
+                              request_headers)
+
+    resp.headers['Link'] = link_header
+
+    return resp
+
+
+async def show_uri(path, datetime, request_url, request_headers):
+    if not ipwb_utils.daemon_health.is_available():
+        return Response(replay.DAEMON_NOT_RUNNING_MSG, status=503)
+
+    try:
+        cdxj_line = await run_sync(
+            replay.get_memento_cdxj_line, path, datetime)
+    except Exception:
+        print(sys.exc_info()[0])
+        return Response(f'{path} not found :(')
+
+    if cdxj_line is None:  # Resource not found in archives
+        return await run_sync(
+            replay.generate_no_mementos_interface, path, datetime)
+
+    cdxj_parts = cdxj_line.split(' ', 2)
+    json_object = json.loads(cdxj_parts[2])
+
+    etag = replay.get_memento_etag(json_object,
+                                   request_headers.get('accept-encoding'))
+    if replay.is_not_modified(request_headers.get('if-none-match'), etag):
+        return replay.generate_not_modified_response(etag, cdxj_parts[1])
+
+    try:
+        window = replay.get_payload_window(
+            json_object, request_headers.get('range'),
+            request_headers.get('if-range'))
+    except RequestedRangeNotSatisfiable as e:
+        return e.get_response()
+
+    digests = json_object['locator'].split('/')
+
+    try:
+        if window is None:
+            fetch_payload = cat(digests[-1])
+        else:
+            fetch_payload = fetch_payload_window(
+                digests[-1], json_object, window)
+
+        if 'headers' in json_object:  # Stored in the index already
+            (header, payload) = (None, await fetch_payload)
+        else:
+            (header, payload) = await asyncio.gather(
+                cat(digests[-2]), fetch_payload)
+        ipwb_utils.daemon_health.record_success()
+
+    except httpx.TimeoutException:
+        print(f'{path} not found at {digests[-1]}')
+        return Response(f'{path} not found in IPFS :(')
+    except httpx.TransportError:
+        ipwb_utils.daemon_health.record_failure()
+        return Response(replay.DAEMON_NOT_RUNNING_MSG, status=503)
+    except httpx.HTTPStatusError as e:
+        print('Fetching from the IPFS failed')
+        print(e)
+        return Response('Fetching from IPFS failed', status=503)
+
+    return await run_sync(
+        replay.build_memento_response, cdxj_line, header, payload,
+        request_url, request_headers.get('accept-encoding'), window)
+
+
+def get_request_url(scope):
+    """Reconstruct the full URL of a request from its ASGI scope"""
+    headers = dict(scope['headers'])
+    host = headers.get(b'host', b'').decode('latin-1')
+    if not host:
+        host = f'{IPWBREPLAY_HOST}:{IPWBREPLAY_PORT}'
+
+    url = (f"{scope['scheme']}://{host}"
+           f"{scope.get('root_path', '')}{scope['path']}")
+    if scope['query_string']:
+        url += f"?{scope['query_string'].decode('latin-1')}"
+
+    return url
+
+
+async def send_response(resp, send, include_body=True):
+    body = resp.get_data()
+
+    headers = [(k.lower().encode('latin-1'), v.encode('latin-1', 'replace'))
+               for (k, v) in resp.headers.items()
+               if k.lower() != 'content-length']
+    headers.append((b'content-length', str(len(body)).encode('latin-1')))
+
+    await send({'type': 'http.response.start',
+                'status': resp.status_code,
+                'headers': headers})
+    await send({'type': 'http.response.body',
+                'body': body if include_body else b''})
+
+
+async def application(scope, receive, send):
+    """ASGI entry point, mementos are served natively, the rest by Flask"""
+    if scope['type'] != 'http':
+        return
+
+    match = memento_route.match(scope['path'])
+    if match is None or scope['method'] not in ('GET', 'HEAD'):
+        return await wsgi_app(scope, receive, send)
+
+    (datetime, urir) = match.groups()
+    urir = replay.compile_target_uri(urir, scope['query_string'])
+
+    request_headers = {k.decode('latin-1'): v.decode('latin-1')
+                       for (k, v) in scope['headers']}
+
+    try:
+        resp = await show_memento(urir, datetime, get_request_url(scope),
+                                  request_headers)
+    except Exception as error:
+        print(error)
+        print(sys.exc_info())
+        traceback.print_tb(sys.exc_info()[-1])
+        resp = Response('Error', status=500)
+
+    replay.set_server_header(resp)
+    await send_response(resp, send, scope['method'] != 'HEAD')
+
+
+def start(cdxj_file_path, proxy=None):
+    replay.setup_replay(cdxj_file_path, proxy)
+
+    print((f'IPWB replay (async) started on '
+           f'http://{IPWBREPLAY_HOST}:{IPWBREPLAY_PORT}'))
+
+    uvicorn.run(application, host='0.0.0.0', port=IPWBREPLAY_PORT,
+                lifespan='off', log_level='warning')
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+InterPlanetary Wayback multi-worker replay
+
+This script serves the ipwb replay system from a pool of pre-forked worker
+processes, each with its own pool of threads, using gunicorn. The index is
+loaded in the master process before the workers are forked so that they
+share it copy-on-write instead of each loading their own copy. Sending
+SIGHUP to the master process reloads the index and gracefully replaces the
+workers.
+
+The multi-worker mode needs additional packages: pip install ipwb[production]
+"""
+
+import gc
+
+from . import replay
+from . import util as ipwb_utils
+from .backends import reload_indexes
+from .util import IPWBREPLAY_HOST, IPWBREPLAY_PORT
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError as err:
+    raise ImportError(
+        'The multi-worker replay mode requires additional packages, install '
+        'them using: pip install ipwb[production]'
+    ) from err
+
+
+class ReplayApplication(BaseApplication):
+    """Gunicorn application serving the pre-loaded Flask replay app"""
+
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return replay.app
+
+
+def preload_index(cdxj_file_path):
+    # The landing page summary is computed here as well to be shared
+    replay.calculate_memento_info_in_index(cdxj_file_path)
+
+    # Keep the garbage collector of the workers away from the objects of
+    # the index, touching them would copy the shared memory pages
+    gc.freeze()
+
+
+def on_reload(arbiter):
+    reload_indexes()
+    preload_index(replay.app.cdxj_file_path)
+
+
+def post_fork(arbiter, worker):
+    # The IPFS client and health monitor thread of the master do not
+    # survive the fork in a usable state
+    ipwb_utils.ipfs_client.cache_clear()
+    ipwb_utils.start_daemon_health_monitor()
+
+
+def get_options(workers=1, threads=1):
+    return {
+        'bind': f'0.0.0.0:{IPWBREPLAY_PORT}',
+        'workers': workers,
+        'threads': threads,
+        'preload_app': True,
+        'on_reload': on_reload,
+        'post_fork': post_fork
+    }
+
+
+def start(cdxj_file_path, proxy=None, workers=1, threads=1):
+    replay.setup_replay(cdxj_file_path, proxy)
+    preload_index(cdxj_file_path)
+
+    print((f'IPWB replay started on '
+           f'http://{IPWBREPLAY_HOST}:{IPWBREPLAY_PORT} '
+           f'with {workers} worker(s) of {threads} thread(s)'))
+
+    ReplayApplication(get_options(workers, threads)).run()
@@ -1,3 +1,4 @@
+import base64
 import functools
 from os.path import expanduser
 
@@ -5,6 +6,7 @@ import os
 
 import ipfshttpclient
 import requests
+import surt
 
 import re
 # Datetime conversion to rfc1123
@@ -12,6 +14,8 @@ import locale
 import datetime
 import logging
 import platform
+import threading
+import time
 
 from urllib.request import urlopen
 from urllib.error import URLError
@@ -21,7 +25,6 @@ from .__init__ import __version__ as ipwb_version
 
 from ipfshttpclient.exceptions import ConnectionError, AddressError
 from multiaddr.exceptions import StringParseError
-from pkg_resources import parse_version
 
 from .exceptions import IPFSDaemonNotAvailable
 
@@ -33,6 +36,9 @@ IPFSAPI_MUTLIADDRESS = '/dns/localhost/tcp/5001/http'
 # or '/ip4/{ipaddress}/tcp/{port}/http'
 # or '/ip6/{ipaddress}/tcp/{port}/http
 
+# Seconds between background liveness checks of the IPFS daemon
+DAEMON_HEALTH_CHECK_INTERVAL = 5
+
 IPWBREPLAY_ADDRESS = 'localhost:5000'
 
 (IPWBREPLAY_HOST, IPWBREPLAY_PORT) = IPWBREPLAY_ADDRESS.split(':')
@@ -40,6 +46,9 @@ IPWBREPLAY_PORT = int(IPWBREPLAY_PORT)
 
 INDEX_FILE = os.path.join('samples', 'indexes', 'salam-home.cdxj')
 
+# Archived HTTP headers replayed as-is, the others are prefixed
+REPLAYED_HTTP_HEADERS = ('content-type', 'content-encoding', 'location')
+
 log = logging.getLogger('werkzeug')
 log.setLevel(logging.ERROR)
 
@@ -66,6 +75,54 @@ def ipfs_client(daemonMultiaddr=IPFSAPI_MUTLIADDRESS):
     return create_ipfs_client(daemonMultiaddr)
 
 
+# Number of URIs whose SURT is remembered, see uri_to_surt()
+SURT_CACHE_SIZE = 65536
+
+
+@functools.lru_cache(maxsize=SURT_CACHE_SIZE)
+def uri_to_surt(uri):
+    """
+    The SURT of a URI as keyed in CDXJ indexes, memoized.
+
+    The same URI-R is canonicalized by many steps of a replay request and
+    the embedded resources of pages recur across WARC records, so the
+    indexer and the replay system share the cached SURTs.
+    """
+    return surt.surt(uri, path_strip_trailing_slash_unless_empty=False)
+
+
+@functools.lru_cache(maxsize=16)
+def derive_encryption_key(encryption_key):
+    """
+    The AES key of a key supplied by the user, derived once per key rather
+    than for every record
+    """
+    from Crypto.Cipher import AES  # Only needed to encrypt
+    from Crypto.Util.Padding import pad
+
+    if isinstance(encryption_key, str):
+        encryption_key = encryption_key.encode('utf-8')
+
+    return base64.b64encode(pad(encryption_key, AES.block_size))
+
+
+def multiaddr_to_url(daemonMultiaddr=IPFSAPI_MUTLIADDRESS):
+    """Convert an IPFS API multi-address to an HTTP base URL"""
+    parts = daemonMultiaddr.strip('/').split('/')
+    try:
+        (addr_type, host, _, port) = parts[:4]
+    except ValueError as err:
+        raise ValueError(
+            f'Unsupported IPFS API multi-address: {daemonMultiaddr}'
+        ) from err
+
+    if addr_type == 'ip6':
+        host = f'[{host}]'
+    scheme = 'https' if parts[4:5] == ['https'] else 'http'
+
+    return f'{scheme}://{host}:{port}'
+
+
 def check_daemon_is_alive(daemonMultiaddr=IPFSAPI_MUTLIADDRESS):
     """Ensure that the IPFS daemon is running via HTTP before proceeding"""
     client = ipfs_client()
@@ -73,24 +130,107 @@ def check_daemon_is_alive(daemonMultiaddr=IPFSAPI_MUTLIADDRESS):
     try:
         # ConnectionError/AttributeError if IPFS daemon not running
         client.id()
+        daemon_health.record_success()
         return True
 
     except ConnectionError as err:
+        daemon_health.record_failure()
         raise IPFSDaemonNotAvailable(
             f'Daemon is not running at: {daemonMultiaddr}',
         ) from err
 
     except OSError as err:
+        daemon_health.record_failure()
         raise IPFSDaemonNotAvailable(
             'IPFS is likely not installed. See https://ipfs.io/docs/install/'
         ) from err
 
     except Exception as err:
+        daemon_health.record_failure()
         raise IPFSDaemonNotAvailable(
             'Unknown error in retrieving IPFS daemon status.',
         ) from err
 
 
+class DaemonHealth:
+    """
+    Circuit breaker tracking the availability of the IPFS daemon.
+
+    Replay reports the outcome of the IPFS calls it makes anyway, so the hot
+    path never issues a dedicated liveness probe. After `failure_threshold`
+    consecutive connection failures the breaker opens and requests are
+    answered with a 503 straight away. Once `retry_after` seconds have passed
+    a single request is let through to probe the daemon again; the
+    background monitor started by `start_daemon_health_monitor()` closes the
+    breaker as soon as the daemon answers.
+    """
+
+    def __init__(self, failure_threshold=3, retry_after=5):
+        self.failure_threshold = failure_threshold
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+
+    def is_available(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+
+            if time.monotonic() - self._opened_at < self.retry_after:
+                return False
+
+            # Half-open: let one caller through and restart the window
+            self._opened_at = time.monotonic()
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+daemon_health = DaemonHealth()
+_daemon_health_monitor = None
+
+
+def start_daemon_health_monitor(interval=DAEMON_HEALTH_CHECK_INTERVAL,
+                                daemonMultiaddr=IPFSAPI_MUTLIADDRESS):
+    """Poll the IPFS daemon in a background thread to feed `daemon_health`"""
+    global _daemon_health_monitor
+
+    if _daemon_health_monitor is not None and \
+            _daemon_health_monitor.is_alive():
+        return _daemon_health_monitor
+
+    def monitor():
+        while True:
+            try:
+                check_daemon_is_alive(daemonMultiaddr)
+            except IPFSDaemonNotAvailable:
+                pass
+            time.sleep(interval)
+
+    _daemon_health_monitor = threading.Thread(
+        target=monitor, name='ipfs-daemon-health', daemon=True)
+    _daemon_health_monitor.start()
+
+    return _daemon_health_monitor
+
+
+def archived_header_name(name):
+    """Name to replay an archived HTTP header under"""
+    if name.lower() in REPLAYED_HTTP_HEADERS:
+        return name
+    return f'X-Archive-Orig-{name}'
+
+
 def is_valid_cdxj(stringIn):  # TODO: Check specific strict syntax
     # Also, be sure to mind the meta headers starting with @/#, etc.
     return True
@@ -114,9 +254,19 @@ def is_valid_cdxj_line(cdxj_line):
         return False
 
 
-# Compare versions of software, <0 if a<b, 0 if ==, >1 if b>a
 def compare_versions(versionA, versionB):
-    return parse_version(versionA) < parse_version(versionB)
+    """Whether a version is older than another, e.g., 0.4.9 than 0.4.10"""
+    return version_key(versionA) < version_key(versionB)
+
+
+def version_key(version):
+    """
+    Order dotted versions numerically, ignoring any pre-release suffix,
+    without the slow import of pkg_resources
+    """
+    release = version.strip().lstrip('v').split('-', 1)[0]
+
+    return tuple(int(n) for n in re.findall(r'\d+', release))
 
 
 def is_cdxj_metadata_record(cdxj_line):
@@ -32,6 +32,16 @@ setup(
         'six==1.11.0',
         'surt>=0.3.0'
     ],
+    extras_require={
+        'async': [
+            'uvicorn>=0.11.0',
+            'httpx>=0.13.0',
+            'asgiref>=3.2.0'
+        ],
+        'production': [
+            'gunicorn>=20.0.0'
+        ]
+    },
     tests_require=[
         'flake8>=3.4',
         'pytest>=3.6',
@@ -1,15 +1,27 @@
+import threading
 from unittest import mock
 
 import pytest
 from ipfshttpclient.exceptions import StatusError
 
 from ipwb.backends import get_web_archive_index, BackendError
+from ipwb.backends import CDXJIndex, load_index
+from ipwb.backends import append_to_index, compact_index, delta_path
+from ipwb.backends import needs_compaction
+from ipwb.backends import load_indexes
+from ipwb.backends import IPFSIndexBackend, WebIndexBackend
+from ipwb.backends import RemoteCDXJIndex, FederatedIndex
+from ipwb.backends import ZipNumIndex, write_zipnum_index
+from ipwb.backends import zipnum_blocks_path, SURTBloomFilter
 from pathlib import Path
 
 
 SAMPLE_INDEX = str(
     Path(__file__).parent.parent / 'samples/indexes/salam-home.cdxj'
 )
+MULTI_MEMENTO_INDEX = str(
+    Path(__file__).parent.parent / 'samples/indexes/sample-1.cdxj'
+)
 
 
 def test_local():
@@ -64,3 +76,440 @@ def test_ipfs_url_success():
         assert get_web_archive_index(
             'ipfs://QmReQCtRpmEhdWZVLhoE3e8bqreD8G3avGpVfcLD7r4K6W'
         ).startswith('!context ["http://tools.ietf.org/html/rfc7089"]')
+
+
+def test_cdxj_index_lookup():
+    index = load_index(MULTI_MEMENTO_INDEX)
+
+    assert len(index.metadata) == 2
+    assert index.find('com,yahoo,search)/mrss/ 20130411205500') == 0
+    assert index.find('com,yahoo,search)/mrss/ 20010101000000') is None
+    assert index.find('com,yahoo,search)/', only_uri=True) is None
+
+    pos = index.find('org,bitchmagazine)/blogs/feed/', only_uri=True)
+    assert index.lines[pos].startswith('org,bitchmagazine)/blogs/feed/ ')
+
+
+def test_cdxj_index_lines_with_surt():
+    index = CDXJIndex('\n'.join([
+        '!context ["http://tools.ietf.org/html/rfc7089"]',
+        'com,example)/ 20200101000000 {}',
+        'com,example)/ 20210101000000 {}',
+        'com,example)/a 20200101000000 {}',
+        ''
+    ]))
+
+    assert index.lines_with_surt('com,example)/') == [
+        'com,example)/ 20200101000000 {}',
+        'com,example)/ 20210101000000 {}'
+    ]
+    assert index.lines_with_surt('com,example)/b') == []
+
+
+def test_cdxj_index_surt_range():
+    index = load_index(MULTI_MEMENTO_INDEX)
+
+    assert index.surt_range() == (0, len(index))
+    assert index.surt_range('com,yahoo,search)/') == (0, 1)
+    assert index.surt_range('net,') == (1, 1)
+
+    (start, end) = index.surt_range('org,bitchmagazine)/blogs/')
+    assert (start, end) == (1, 5)
+    assert index.surt_range('org,bitchmagazine)/blogs/',
+                            index.surts[2]) == (3, 5)
+
+
+def test_cdxj_index_merged():
+    index = load_index(MULTI_MEMENTO_INDEX)
+    summary = index.get_summary()
+    new_lines = [
+        'com,example)/ 20200101000000 {"mime_type": "text/html", '
+        '"status_code": "200"}',
+        index.lines[3],
+        'zw,example)/ 20200101000000 {"mime_type": "image/png", '
+        '"status_code": "200"}'
+    ]
+
+    merged = index.merged(new_lines)
+
+    assert len(merged) == len(index) + 2
+    assert merged.lines == sorted(index.lines + new_lines[::2])
+    assert merged.find('com,example)/ 20200101000000') == 0
+    assert merged.find('zw,example)/', only_uri=True) == len(merged) - 1
+    assert merged.get_summary() == CDXJIndex(
+        '\n'.join(merged.lines)).get_summary()
+    assert index.get_summary() is summary
+    assert summary['memento_count'] == 65
+
+
+@pytest.mark.parametrize('surt_uri,match_type,expected', [
+    ('com,example)/a', 'exact', ['com,example)/a']),
+    ('com,example)/a', 'prefix', ['com,example)/a', 'com,example)/a/b']),
+    ('com,example)/a', 'host', ['com,example)/', 'com,example)/a',
+                                'com,example)/a/b']),
+    ('com,example)/', 'domain', ['com,example)/', 'com,example)/a',
+                                 'com,example)/a/b', 'com,example,www2)/']),
+    ('com,example,www2)/', 'host', ['com,example,www2)/']),
+    ('org,example)/', 'domain', []),
+])
+def test_cdxj_index_match_ranges(surt_uri, match_type, expected):
+    index = CDXJIndex('\n'.join([
+        'com,example)/ 20200101000000 {}',
+        'com,example)/a 20200101000000 {}',
+        'com,example)/a/b 20200101000000 {}',
+        'com,example,www2)/ 20200101000000 {}',
+        'com,examples)/ 20200101000000 {}'
+    ]))
+
+    lines = index.iter_ranges(index.match_ranges(surt_uri, match_type))
+    assert [line.split(' ')[0] for line in lines] == expected
+
+
+def test_load_index_reloads_changed_file(tmp_path):
+    index_path = tmp_path / 'index.cdxj'
+    index_path.write_text('com,example)/ 20200101000000 {}\n')
+    assert len(load_index(str(index_path))) == 1
+
+    index_path.write_text('com,example)/ 20200101000000 {}\n'
+                          'com,example)/ 20210101000000 {}\n')
+    assert len(load_index(str(index_path))) == 2
+
+
+def test_cdxj_index_summary():
+    summary = load_index(MULTI_MEMENTO_INDEX).get_summary()
+
+    assert summary['memento_count'] == 65
+    assert len(summary['surt_uris']) == 65
+    assert summary['oldest_datetime'] <= summary['newest_datetime']
+    assert 'com,yahoo,search)/mrss/' in summary['surt_uris']
+
+
+def test_append_to_index(tmp_path):
+    index_path = str(tmp_path / 'index.cdxj')
+    base = Path(MULTI_MEMENTO_INDEX).read_text()
+    Path(index_path).write_text(base)
+    base_lines = load_index(index_path).lines
+
+    new_lines = ['com,example)/ 20200101000000 {}',
+                 'zw,example)/ 20200101000000 {}']
+    append_to_index(index_path, new_lines)
+
+    # Only the delta file is written and read again
+    assert Path(index_path).read_text() == base
+    assert Path(delta_path(index_path)).read_text().split('\n')[:2] == \
+        new_lines
+    with mock.patch('ipwb.backends.fetch_local_index',
+                    side_effect=AssertionError):
+        index = load_index(index_path)
+    assert index.lines == sorted(base_lines + new_lines)
+
+    compact_index(index_path)
+
+    assert not Path(delta_path(index_path)).exists()
+    lines = Path(index_path).read_text().splitlines()
+    assert lines[:2] == base.splitlines()[:2]
+    assert lines[2:] == index.lines
+    assert load_index(index_path).lines == index.lines
+
+
+def test_append_to_index_appends_delta(tmp_path):
+    index_path = str(tmp_path / 'index.cdxj')
+    Path(index_path).write_text(Path(MULTI_MEMENTO_INDEX).read_text())
+
+    append_to_index(index_path, ['zw,example)/ 20200101000000 {}'])
+    delta = Path(delta_path(index_path)).read_text()
+    append_to_index(index_path, ['com,example)/ 20200101000000 {}'])
+
+    # The delta file is appended to, not rewritten
+    assert Path(delta_path(index_path)).read_text() == \
+        delta + 'com,example)/ 20200101000000 {}\n'
+
+    # A record still being appended is not read
+    with open(delta_path(index_path), 'a') as f:
+        f.write('org,example)/ 2020')
+    lines = load_index(index_path).lines
+    assert 'com,example)/ 20200101000000 {}' in lines
+    assert not any(line.startswith('org,example)/') for line in lines)
+
+
+def test_append_to_index_concurrently(tmp_path):
+    index_path = str(tmp_path / 'index.cdxj')
+    Path(index_path).write_text(Path(SAMPLE_INDEX).read_text())
+    base_lines = load_index(index_path).lines
+
+    # Writers compact the delta file while the others append to it
+    def append(writer):
+        for batch in range(20):
+            append_to_index(index_path, [
+                f'com,example)/{writer} 2020010100{batch:04} {{}}'])
+
+    writers = [threading.Thread(target=append, args=(writer,))
+               for writer in range(4)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+
+    assert len(load_index(index_path)) == len(base_lines) + 4 * 20
+
+
+def test_append_to_index_compaction(tmp_path):
+    index_path = str(tmp_path / 'index.cdxj')
+
+    append_to_index(index_path, ['com,example)/ 20200101000000 {}'],
+                    ['!context ["http://tools.ietf.org/html/rfc7089"]'])
+    append_to_index(index_path, ['com,example)/ 20210101000000 {}',
+                                 'com,example)/ 20200101000000 {}'])
+
+    # The delta file outgrew the index, it is merged into it apart
+    assert Path(delta_path(index_path)).exists()
+    assert needs_compaction(index_path)
+    compact_index(index_path)
+
+    assert not Path(delta_path(index_path)).exists()
+    assert not needs_compaction(index_path)
+    assert Path(index_path).read_text().splitlines() == [
+        '!context ["http://tools.ietf.org/html/rfc7089"]',
+        'com,example)/ 20200101000000 {}',
+        'com,example)/ 20210101000000 {}'
+    ]
+
+
+def test_federated_index():
+    indexes = [
+        CDXJIndex('!context ["http://tools.ietf.org/html/rfc7089"]\n'
+                  'com,example)/ 20200101000000 {}\n'
+                  'org,example)/ 20200101000000 {}'),
+        CDXJIndex('com,example)/ 20210101000000 {}\n'
+                  'org,example)/ 20200101000000 {}'),
+        CDXJIndex('')
+    ]
+
+    index = FederatedIndex(indexes)
+
+    assert list(index.iter_prefix()) == ['com,example)/ 20200101000000 {}',
+                                         'com,example)/ 20210101000000 {}',
+                                         'org,example)/ 20200101000000 {}']
+    assert len(index.lines_with_surt('com,example)/')) == 2
+    assert index.find_line('org,example)/ 20200101000000') == \
+        'org,example)/ 20200101000000 {}'
+    # Counted by the caller, as the record in both indexes is listed once
+    assert index.match('org,example)/')[0] is None
+    assert list(index.match('org,example)/')[1]) == [
+        'org,example)/ 20200101000000 {}']
+
+
+def test_load_indexes(tmp_path):
+    paths = [str(tmp_path / 'first.cdxj'), str(tmp_path / 'second.cdxj')]
+    Path(paths[0]).write_text('com,example)/ 20200101000000 {}\n')
+    Path(paths[1]).write_text('com,example)/ 20210101000000 {}\n')
+
+    index = load_indexes(paths)
+
+    assert isinstance(index, FederatedIndex)
+    assert len(list(index.iter_prefix())) == 2
+    assert load_indexes(paths) is index
+    assert load_indexes(paths[:1]) is load_index(paths[0])
+
+    first = load_index(paths[0])
+    append_to_index(paths[1], ['org,example)/ 20200101000000 {}'])
+    assert len(list(load_indexes(paths).iter_prefix())) == 3
+    # Only the index that changed is loaded again
+    assert load_indexes(paths).indexes[0] is first
+
+
+def test_ipfs_index_backend_cache(tmp_path):
+    content = Path(SAMPLE_INDEX).read_text()
+    connect_to_ipfs = mock.MagicMock()
+    connect_to_ipfs.return_value.__enter__.return_value.cat.return_value = \
+        content.encode('utf-8')
+
+    with mock.patch('ipwb.backends.INDEX_CACHE_DIR', str(tmp_path)), \
+            mock.patch('ipfshttpclient.connect', connect_to_ipfs):
+        backend = IPFSIndexBackend('ipfs://QmIndex')
+        assert backend.read() == content
+        assert IPFSIndexBackend('QmIndex').read() == content
+
+    assert connect_to_ipfs.call_count == 1
+    assert backend.signature() == (('ipfs', 'QmIndex'), None)
+
+
+def test_web_index_backend_refresh(tmp_path):
+    content = Path(SAMPLE_INDEX).read_text()
+    responses = [
+        mock.MagicMock(status_code=200, text=content,
+                       headers={'ETag': '"v1"'}),
+        mock.MagicMock(status_code=304, headers={})
+    ]
+
+    with mock.patch('ipwb.backends.INDEX_CACHE_DIR', str(tmp_path)), \
+            mock.patch('ipwb.backends.WEB_INDEX_REFRESH_INTERVAL', 0), \
+            mock.patch('requests.get', side_effect=responses) as get:
+        backend = WebIndexBackend('https://example.com/index.cdxj')
+        signature = backend.signature()
+        assert backend.read() == content
+
+        assert backend.signature() == signature
+        assert get.call_args[1]['headers'] == {'If-None-Match': '"v1"'}
+
+
+def serve_ranges(content, requested):
+    """A fake requests.get answering Range requests for some content"""
+    def get(url, headers):
+        (start, end) = map(int, headers['Range'][6:].split('-'))
+        end = min(end, len(content) - 1)
+        requested.append(end - start + 1)
+
+        content_range = f'bytes {start}-{end}/{len(content)}'
+
+        return mock.MagicMock(status_code=206, content=content[start:end + 1],
+                              headers={'ETag': '"v1"',
+                                       'Content-Range': content_range})
+
+    return get
+
+
+def test_remote_cdxj_index():
+    content = Path(MULTI_MEMENTO_INDEX).read_bytes()
+    index = CDXJIndex(content.decode('utf-8'))
+    requested = []
+
+    with mock.patch('ipwb.backends.REMOTE_INDEX_BLOCK_SIZE', 256), \
+            mock.patch('requests.get', serve_ranges(content, requested)):
+        remote = RemoteCDXJIndex('https://example.com/index.cdxj')
+
+        needle = ' '.join(index.lines[10].split(' ', 2)[:2])
+        assert remote.find_line(needle) == index.lines[10]
+        assert remote.find_line('com,example)/missing 20200101000000') \
+            is None
+        assert remote.lines_with_surt('com,yahoo,search)/mrss/') == \
+            index.lines_with_surt('com,yahoo,search)/mrss/')
+        for (surt_uri, match_type) in [
+                ('com,yahoo,search)/mrss/', 'exact'),
+                ('com,yahoo', 'prefix'),
+                ('com,yahoo,search)/', 'host'),
+                ('com,yahoo)/', 'domain')]:
+            (count, lines) = remote.match(surt_uri, match_type)
+            assert count is None
+            assert list(lines) == list(index.match(surt_uri, match_type)[1])
+        assert list(remote.iter_prefix('com,', 'com,yahoo')) == \
+            list(index.iter_prefix('com,', 'com,yahoo'))
+
+        # Only the blocks on the paths of the searches were read
+        assert sum(requested) < len(content)
+
+        assert len(list(remote.iter_prefix())) == len(index)
+
+
+def test_web_index_searched_in_place(tmp_path):
+    head = mock.MagicMock(status_code=200, headers={
+        'Accept-Ranges': 'bytes', 'Content-Length': str(2 ** 40)})
+    path = 'https://example.com/large-index.cdxj'
+
+    with mock.patch('ipwb.backends.INDEX_CACHE_DIR', str(tmp_path)), \
+            mock.patch('requests.head', return_value=head), \
+            mock.patch('requests.get', side_effect=AssertionError):
+        index = load_index(path)
+        assert isinstance(index, RemoteCDXJIndex)
+
+        federated = load_indexes([SAMPLE_INDEX, path])
+        assert isinstance(federated, FederatedIndex)
+
+
+def test_zipnum_index(tmp_path):
+    index = CDXJIndex(Path(MULTI_MEMENTO_INDEX).read_text())
+    path = str(tmp_path / 'index.cdxj.idx')
+
+    with mock.patch('ipwb.backends.ZIPNUM_BLOCK_LINES', 10):
+        write_zipnum_index(path, index.lines, index.metadata)
+    zipnum = ZipNumIndex(path)
+
+    assert zipnum.metadata == index.metadata
+    assert len(zipnum.locations) == 7
+    assert Path(zipnum_blocks_path(path)).stat().st_size < \
+        Path(MULTI_MEMENTO_INDEX).stat().st_size
+
+    with mock.patch.object(zipnum, '_read_block',
+                           wraps=zipnum._read_block) as read_block:
+        needle = ' '.join(index.lines[42].split(' ', 2)[:2])
+        assert zipnum.find_line(needle) == index.lines[42]
+        # Only the blocks that may hold the record are decompressed
+        assert read_block.call_count <= 2
+
+    for line in index.lines:
+        surt_uri = line.split(' ', 1)[0]
+        assert zipnum.lines_with_surt(surt_uri) == \
+            index.lines_with_surt(surt_uri)
+        assert list(zipnum.iter_prefix('', surt_uri)) == \
+            list(index.iter_prefix('', surt_uri))
+        for match_type in ('prefix', 'domain'):
+            assert list(zipnum.match(surt_uri, match_type)[1]) == \
+                list(index.match(surt_uri, match_type)[1])
+
+
+def test_append_to_zipnum_index(tmp_path):
+    index = CDXJIndex(Path(MULTI_MEMENTO_INDEX).read_text())
+    path = str(tmp_path / 'index.cdxj.idx')
+
+    append_to_index(path, index.lines[:30], index.metadata)
+    append_to_index(path, index.lines[20:])
+
+    loaded = load_index(path)
+    assert isinstance(loaded, ZipNumIndex)
+    assert loaded.metadata == index.metadata
+    assert list(loaded.iter_prefix()) == index.lines
+
+
+def test_zipnum_index_rewritten(tmp_path):
+    index = CDXJIndex(Path(MULTI_MEMENTO_INDEX).read_text())
+    path = str(tmp_path / 'index.cdxj.idx')
+    write_zipnum_index(path, index.lines[::2], index.metadata)
+    loaded = ZipNumIndex(path)
+
+    # The blocks are not read back to build the Bloom filter
+    with mock.patch.object(ZipNumIndex, '_read_block',
+                           side_effect=AssertionError):
+        write_zipnum_index(path, index.lines, index.metadata)
+
+    # Loaded before, the index still reads the blocks of its summary
+    assert list(loaded.iter_prefix()) == index.lines[::2]
+    assert list(ZipNumIndex(path).iter_prefix()) == index.lines
+
+
+def test_zipnum_index_blocks_replaced(tmp_path):
+    index = CDXJIndex(Path(MULTI_MEMENTO_INDEX).read_text())
+    path = str(tmp_path / 'index.cdxj.idx')
+    write_zipnum_index(path, index.lines, index.metadata)
+    summary = Path(path).read_text()
+    write_zipnum_index(path, index.lines[::2], index.metadata)
+
+    # The summary of other blocks than the ones on disk is read again
+    Path(path).write_text(summary)
+    with mock.patch('ipwb.backends.ZIPNUM_OPEN_RETRY_INTERVAL', 0), \
+            pytest.raises(BackendError):
+        ZipNumIndex(path)
+
+
+def test_surt_bloom_filter():
+    surt_uris = [f'com,example)/page/{i}' for i in range(1000)]
+    bloom_filter = SURTBloomFilter.for_count(len(surt_uris))
+    for surt_uri in surt_uris:
+        bloom_filter.add(surt_uri)
+
+    bloom_filter = SURTBloomFilter.from_bytes(bloom_filter.to_bytes())
+
+    assert all(surt_uri in bloom_filter for surt_uri in surt_uris)
+    false_positives = sum(f'org,example)/page/{i}' in bloom_filter
+                          for i in range(10000))
+    assert false_positives < 300
+
+
+def test_zipnum_index_bloom_filter(tmp_path):
+    index = CDXJIndex(Path(MULTI_MEMENTO_INDEX).read_text())
+    path = str(tmp_path / 'index.cdxj.idx')
+    write_zipnum_index(path, index.lines, index.metadata)
+
+    zipnum = ZipNumIndex(path)
+    with mock.patch.object(zipnum, '_read_block', side_effect=AssertionError):
+        assert all(zipnum.might_contain(surt_uri) for surt_uri in index.surts)
+        assert not zipnum.might_contain('com,example)/never-archived')
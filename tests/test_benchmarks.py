@@ -0,0 +1,28 @@
+import pytest
+
+from benchmarks import indexing, synthetic
+
+
+@pytest.mark.parametrize('distribution', synthetic.SIZE_DISTRIBUTIONS)
+def test_payload_sizes(distribution):
+    sizes = list(synthetic.payload_sizes(1000, 1024, distribution))
+
+    assert len(sizes) == 1000
+    assert min(sizes) >= 1
+    assert sorted(sizes)[500] == pytest.approx(1024, rel=0.2)
+    assert sizes == list(synthetic.payload_sizes(1000, 1024, distribution))
+
+
+@pytest.mark.parametrize('gzip', [False, True])
+@pytest.mark.parametrize('variant', ['plain', 'compressed-encrypted'])
+def test_index_offline(tmp_path, gzip, variant):
+    warc_path = str(tmp_path / 'synthetic.warc')
+    synthetic.generate_warc(warc_path, 20, 512, 'lognormal', 0.5, gzip)
+
+    result = indexing.index_offline(warc_path, variant)
+
+    assert result['records'] == 20
+    assert result['ipfs_bytes'] > 0
+    assert result['stages']['warc'] > 0
+    assert (result['stages']['encrypt'] > 0) == (variant != 'plain')
+    assert 'records/s' in indexing.format_results([result])
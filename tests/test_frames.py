@@ -0,0 +1,40 @@
+import os
+import zlib
+
+import pytest
+
+from ipwb import frames
+
+DATA = os.urandom(1000) + b'ipwb' * 1000
+
+
+@pytest.mark.parametrize('frame_size', [1, 7, 1000, 4096, 65536])
+def test_compress_frames(frame_size):
+    stored = frames.compress_frames(DATA, 6, frame_size)
+
+    assert frames.decompress_frames(stored) == DATA
+    assert frames.decompress_frames(
+        frames.compress_frames(b'', 6, frame_size)) == b''
+
+
+@pytest.mark.parametrize('window', [
+    (0, 1), (0, 5000), (999, 1001), (1000, 2000), (4999, 5000), (123, 4567)
+])
+def test_extract_window(window):
+    stored = frames.compress_frames(DATA, 6, 1000)
+    table = frames.read_table(stored[:frames.table_size(len(DATA), 1000)])
+    assert table.length == len(DATA)
+
+    (start, stop) = frames.locate(table, window)
+    # Only the frames holding the window are read
+    first = window[0] // 1000
+    last = (window[1] - 1) // 1000
+    assert (start, stop) == (table.offsets[first], table.offsets[last + 1])
+
+    assert frames.extract(stored[start:stop], table, window) == \
+        DATA[window[0]:window[1]]
+
+
+def test_read_table_not_framed():
+    with pytest.raises(ValueError):
+        frames.read_table(zlib.compress(DATA) + bytes(16))
@@ -2,7 +2,7 @@ from unittest.mock import MagicMock, patch
 
 import pytest
 
-from ipwb.util import check_daemon_is_alive, create_ipfs_client
+from ipwb.util import check_daemon_is_alive, create_ipfs_client, DaemonHealth
 from ipfshttpclient.exceptions import ConnectionError
 
 
@@ -49,3 +49,40 @@ def test_unknown_error():
     with patch('ipwb.util.ipfs_client', mock_client):
         with pytest.raises(Exception, match=expected_error):
             check_daemon_is_alive()
+
+
+def test_daemon_health_opens_after_failures():
+    health = DaemonHealth(failure_threshold=2, retry_after=60)
+
+    health.record_failure()
+    assert health.is_available()
+
+    health.record_failure()
+    assert not health.is_available()
+
+    health.record_success()
+    assert health.is_available()
+
+
+def test_daemon_health_half_open():
+    health = DaemonHealth(failure_threshold=1, retry_after=0)
+    health.record_failure()
+
+    # Retry window elapsed, a probing request is let through
+    assert health.is_available()
+
+
+def test_check_daemon_records_health():
+    mock_client = MagicMock()
+    mock_client.return_value.id.side_effect = ConnectionError('boo!')
+    health = DaemonHealth(failure_threshold=1, retry_after=60)
+
+    with patch('ipwb.util.ipfs_client', mock_client), \
+            patch('ipwb.util.daemon_health', health):
+        with pytest.raises(Exception):
+            check_daemon_is_alive()
+        assert not health.is_available()
+
+        mock_client.return_value.id.side_effect = None
+        check_daemon_is_alive()
+        assert health.is_available()
@@ -0,0 +1,278 @@
+import hashlib
+import io
+import queue
+import threading
+import time
+from pathlib import Path
+from unittest.mock import patch
+
+import pytest
+
+from ipwb import indexer, jobs, replay
+from ipwb.backends import delta_path, load_index
+
+SAMPLES = Path(__file__).parent.parent / 'samples'
+
+
+def fake_push_bytes_to_ipfs(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+@pytest.fixture
+def cdxj_path(tmp_path):
+    path = tmp_path / 'index.cdxj'
+    path.write_text((SAMPLES / 'indexes/salam-home.cdxj').read_text())
+
+    with patch('ipwb.indexer.push_bytes_to_ipfs',
+               side_effect=fake_push_bytes_to_ipfs):
+        yield str(path)
+
+
+def test_index_warc_into(cdxj_path):
+    before = load_index(cdxj_path)
+
+    count = jobs.index_warc_into(str(SAMPLES / 'warcs/2mementos.warc'),
+                                 cdxj_path)
+
+    assert count > 0
+    index = load_index(cdxj_path)
+    assert index is not before
+    assert len(index) == len(before) + count
+    assert index.lines == sorted(index.lines)
+
+    # The files on disk hold the same records as the index in memory
+    lines = Path(cdxj_path).read_text().splitlines()
+    if Path(delta_path(cdxj_path)).exists():
+        lines += Path(delta_path(cdxj_path)).read_text().splitlines()
+    assert sorted(line for line in lines if line[:1] != '!') == index.lines
+
+    # Indexing the same WARC again does not duplicate its records
+    jobs.index_warc_into(str(SAMPLES / 'warcs/2mementos.warc'), cdxj_path)
+    assert len(load_index(cdxj_path)) == len(before) + count
+
+
+def test_index_warc_into_zipnum(cdxj_path):
+    zipnum_path = f'{cdxj_path}.idx'
+    count = jobs.index_warc_into(str(SAMPLES / 'warcs/2mementos.warc'),
+                                 zipnum_path)
+    jobs.index_warc_into(str(SAMPLES / 'warcs/salam-home.warc'),
+                         zipnum_path)
+
+    index = load_index(zipnum_path)
+    assert len(list(index.iter_prefix())) == count + 1
+    assert index.find_line('edu,odu,cs)/~salam/', only_uri=True)
+
+
+def test_submit(cdxj_path):
+    job = jobs.submit(str(SAMPLES / 'warcs/1memento.warc'), cdxj_path)
+    jobs._job_queue.join()
+
+    # Read from the status file, as any worker process of the replay would
+    assert jobs.get_job(job.id, cdxj_path) == job
+    assert job.status == 'done'
+    assert len(load_index(cdxj_path)) == 1 + job.record_count
+    assert job.finished_at is not None
+
+
+def test_forget_old_jobs(cdxj_path):
+    with patch('ipwb.jobs.MAX_JOBS', 2):
+        submitted = [jobs.submit(str(SAMPLES / 'warcs/nonexistent.warc'),
+                                 cdxj_path) for _ in range(3)]
+        jobs._job_queue.join()
+
+    assert jobs.get_job(submitted[0].id, cdxj_path) is None
+    assert jobs.get_job(submitted[2].id, cdxj_path) == submitted[2]
+    assert jobs.get_job('../index.cdxj', cdxj_path) is None
+
+
+def test_submit_failure(cdxj_path):
+    job = jobs.submit(str(SAMPLES / 'warcs/nonexistent.warc'), cdxj_path)
+    jobs._job_queue.join()
+
+    assert job.status == 'failed'
+    assert job.error
+
+
+def test_upload(cdxj_path):
+    client = replay.app.test_client()
+    warc = SAMPLES / 'warcs/1memento.warc'
+
+    with patch.object(replay.app, 'cdxj_file_path', cdxj_path, create=True):
+        with open(warc, 'rb') as f:
+            resp = client.post('/upload', data={'file': (f, warc.name)},
+                               headers={'Accept': 'application/json'})
+        jobs._job_queue.join()
+
+        assert resp.status_code == 202
+        status = client.get(resp.headers['Location']).get_json()
+        assert status['id'] == resp.get_json()['id']
+        assert status['status'] == 'done'
+
+        assert client.get('/ipwbapi/jobs/unknown').status_code == 404
+
+
+def test_upload_resolved_index(cdxj_path):
+    client = replay.app.test_client()
+    warc = SAMPLES / 'warcs/1memento.warc'
+
+    # Given by a name that replay resolves to the index it serves
+    with patch.object(replay.app, 'cdxj_file_path', 'index.cdxj',
+                      create=True), \
+            patch('ipwb.replay.get_index_file_full_path',
+                  return_value=cdxj_path):
+        with open(warc, 'rb') as f:
+            resp = client.post('/upload', data={'file': (f, warc.name)},
+                               headers={'Accept': 'application/json'})
+        jobs._job_queue.join()
+
+        assert resp.get_json()['cdxj_path'] == cdxj_path
+        status = client.get(resp.headers['Location']).get_json()
+        assert status['status'] == 'done'
+
+
+@pytest.mark.parametrize('index_path', [
+    'QmReQCtRpmEhdWZVLhoE3e8bqreD8G3avGpVfcLD7r4K6W',
+    'https://example.com/index.cdxj',
+])
+def test_upload_remote_index(index_path):
+    client = replay.app.test_client()
+    warc = SAMPLES / 'warcs/1memento.warc'
+
+    with patch.object(replay.app, 'cdxj_file_path', index_path,
+                      create=True), \
+            patch('ipwb.jobs.submit', side_effect=AssertionError):
+        with open(warc, 'rb') as f:
+            resp = client.post('/upload', data={'file': (f, warc.name)},
+                               headers={'Accept': 'application/json'})
+
+    assert resp.status_code == 409
+
+
+def test_piped_index(cdxj_path, capsys):
+    indexer.index_file_at(str(SAMPLES / 'warcs/2mementos.warc'),
+                          stream=True)
+    lines = capsys.readouterr().out.splitlines()
+
+    assert lines[0].startswith('!context')
+    assert lines[1].startswith('!meta')
+    assert len(lines) > 2
+
+    ingester = jobs.start_stream_ingestion(io.StringIO('\n'.join(lines)),
+                                           cdxj_path)
+    ingester.join(timeout=10)
+
+    assert len(load_index(cdxj_path)) == 1 + len(lines) - 2
+
+
+def test_index_outfile_appends(tmp_path):
+    cdxj_path = tmp_path / 'index.cdxj'
+    cdxj_path.write_text((SAMPLES / 'indexes/sample-1.cdxj').read_text())
+    before = cdxj_path.stat()
+
+    with patch('ipwb.indexer.push_bytes_to_ipfs',
+               side_effect=fake_push_bytes_to_ipfs):
+        indexer.index_file_at(str(SAMPLES / 'warcs/1memento.warc'),
+                              outfile=str(cdxj_path))
+
+    # Only the delta file is written, the index is left untouched
+    after = cdxj_path.stat()
+    assert (after.st_size, after.st_mtime_ns) == \
+        (before.st_size, before.st_mtime_ns)
+    assert Path(delta_path(str(cdxj_path))).exists()
+    assert len(load_index(str(cdxj_path))) > 65
+
+
+def test_compact_later(cdxj_path):
+    with patch('ipwb.backends.COMPACTION_RATIO', 0):
+        count = jobs.index_warc_into(str(SAMPLES / 'warcs/1memento.warc'),
+                                     cdxj_path)
+        jobs._job_queue.join()
+
+    # Compacted by the job worker once the records were added
+    assert not Path(delta_path(cdxj_path)).exists()
+    assert len(load_index(cdxj_path)) == 1 + count
+
+
+def test_index_outfile_compact(cdxj_path):
+    before = load_index(cdxj_path)
+    with patch('ipwb.backends.COMPACTION_RATIO', 10):
+        jobs.index_warc_into(str(SAMPLES / 'warcs/1memento.warc'),
+                             cdxj_path)
+    assert Path(delta_path(cdxj_path)).exists()
+
+    indexer.index_file_at(str(SAMPLES / 'warcs/2mementos.warc'),
+                          outfile=cdxj_path, compact=True)
+
+    # The records added by the replay system and the indexer are all in
+    # the index file, without a delta file next to it
+    assert not Path(delta_path(cdxj_path)).exists()
+    lines = Path(cdxj_path).read_text().splitlines()
+    records = [line for line in lines if line[:1] != '!']
+    assert records == sorted(set(records))
+    assert len(records) > len(before)
+    assert records == load_index(cdxj_path).lines
+
+
+def test_index_output_sorted(cdxj_path, capsys):
+    indexer.index_file_at([str(SAMPLES / 'warcs/salam-home.warc'),
+                           str(SAMPLES / 'warcs/2mementos.warc')])
+    lines = capsys.readouterr().out.splitlines()
+
+    records = [line for line in lines if not line.startswith('!')]
+    assert len(records) > 2
+    assert records == sorted(set(records))
+
+
+def test_ingest_lines(cdxj_path):
+    lines = queue.Queue()
+    records = Path(SAMPLES / 'indexes/sample-1.cdxj').read_text().splitlines()
+
+    with patch('ipwb.jobs.STREAM_BATCH_INTERVAL', 0.01):
+        for line in records[:10]:
+            lines.put(line)
+        ingester = threading.Thread(target=jobs.ingest_lines,
+                                    args=(lines, cdxj_path))
+        ingester.start()
+
+        # Served before the end of the stream
+        deadline = time.monotonic() + 10
+        while len(load_index(cdxj_path)) < 1 + 8 and \
+                time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(load_index(cdxj_path)) == 1 + 8
+
+        for line in records[10:]:
+            lines.put(line)
+        lines.put(None)
+        ingester.join(timeout=10)
+
+    assert len(load_index(cdxj_path)) == 1 + len(records) - 2
+
+
+def test_ingest_lines_trickle(cdxj_path):
+    lines = queue.Queue()
+    records = Path(SAMPLES / 'indexes/sample-1.cdxj').read_text().splitlines()
+    records = records[2:]
+    served_at = []
+
+    def add_to_index(cdxj_path, batch, metadata):
+        served_at.append((time.monotonic(), len(batch)))
+
+    # Lines arrive more often than the interval, but never stop coming
+    with patch('ipwb.jobs.STREAM_BATCH_INTERVAL', 0.2), \
+            patch('ipwb.jobs.add_to_index', side_effect=add_to_index):
+        ingester = threading.Thread(target=jobs.ingest_lines,
+                                    args=(lines, cdxj_path))
+        ingester.start()
+
+        started_at = time.monotonic()
+        for line in records[:20]:
+            lines.put(line)
+            time.sleep(0.05)
+        lines.put(None)
+        ingester.join(timeout=10)
+
+    assert sum(count for (_, count) in served_at) == 20
+    # The first records were added long before the end of the stream
+    assert len(served_at) > 1
+    assert served_at[0][0] - started_at < 0.5
@@ -0,0 +1,58 @@
+import subprocess
+import sys
+import time
+
+import pytest
+
+# Modules slow to import, that the commands not needing them do not load
+SLOW_MODULES = ['flask', 'pkg_resources', 'bs4', 'Crypto', 'ipwb.replay',
+                'ipwb.indexer', 'ipfshttpclient']
+
+# Seconds to print the version, generous for slow machines
+STARTUP_TIME_BUDGET = 1.0
+
+LOADED_MODULES = '''
+import sys
+sys.argv = {argv!r}
+from ipwb import __main__
+try:
+    __main__.checkArgs(sys.argv)
+except SystemExit:
+    pass
+print(' '.join(sorted(sys.modules)))
+'''
+
+
+@pytest.mark.parametrize('argv', [
+    ['ipwb', '--version'],
+    ['ipwb', 'index', '-h'],
+    ['ipwb', 'replay', '-h'],
+])
+def test_lazy_imports(argv):
+    out = subprocess.run(
+        [sys.executable, '-c', LOADED_MODULES.format(argv=argv)],
+        capture_output=True, text=True, check=True).stdout
+    loaded = out.splitlines()[-1].split()
+
+    assert [module for module in SLOW_MODULES if module in loaded] == []
+
+
+def test_lazy_imports_indexer():
+    # The indexer loads what it needs to encrypt only when encrypting
+    out = subprocess.run(
+        [sys.executable, '-c',
+         'import sys; import ipwb.indexer; print(" ".join(sys.modules))'],
+        capture_output=True, text=True, check=True).stdout
+    loaded = out.splitlines()[-1].split()
+
+    assert 'ipwb.indexer' in loaded
+    assert [module for module in loaded
+            if module.split('.')[0] == 'Crypto'] == []
+
+
+def test_startup_time():
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-m', 'ipwb', '--version'],
+                   capture_output=True, check=True)
+
+    assert time.perf_counter() - start < STARTUP_TIME_BUDGET
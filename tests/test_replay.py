@@ -1,7 +1,14 @@
+import json
+import os
+import zlib
+from base64 import b64encode
+from unittest.mock import patch
+
 import pytest
 
 from . import testUtil as ipwb_test
-from ipwb import replay
+from ipwb import indexer, replay, util
+from ipwb.backends import CDXJIndex
 from time import sleep
 
 import requests
@@ -233,3 +240,466 @@ def test_isUri(expected, input):
 
 
 # TODO: Have unit tests for each function in replay.py
+
+
+IPWB_JS = replay.IPWB_JS_INJECT
+
+
+@pytest.mark.parametrize("payload,expected", [
+    (b'<html><body></body></html>',
+     b'<html><body></body>' + IPWB_JS + b'</html>'),
+    (b'<HTML><BODY></BODY></HTML >\n',
+     b'<HTML><BODY></BODY>' + IPWB_JS + b'</HTML >\n'),
+    (b'<p>No closing tag', b'<p>No closing tag' + IPWB_JS),
+    ('<html>été</html>'.encode('latin-1'),
+     '<html>été'.encode('latin-1') + IPWB_JS + b'</html>'),
+])
+def test_inject_ipwb_js(payload, expected):
+    assert replay.inject_ipwb_js(payload) == expected
+
+
+def test_inject_ipwb_js_utf16():
+    payload = '\ufeff<html>utf-16</html>'.encode('utf-16-le')
+    injected = replay.inject_ipwb_js(payload).decode('utf-16-le')
+
+    assert injected == ('\ufeff<html>utf-16' + IPWB_JS.decode('ascii') +
+                        '</html>')
+
+
+@pytest.mark.parametrize("data,expected", [
+    (b'5\r\nHello\r\n7\r\n, world\r\n0\r\n\r\n', b'Hello, world'),
+    (b'5;name=value\r\nHello\r\n0\r\n\r\n', b'Hello'),
+    (b'5\nHello\n0\n\n', b'Hello'),
+    (b'3\r\n\x00\xff\r\r\n0\r\nExpires: never\r\n\r\n', b'\x00\xff\r'),
+    (b'0\r\n', b''),
+])
+def test_extract_response_from_chunked_data(data, expected):
+    assert replay.extract_response_from_chunked_data(data) == expected
+
+
+@pytest.mark.parametrize("data", [
+    b'<html></html>',
+    b'5\r\nHello, world\r\n0\r\n\r\n',
+    b'a\r\nHello\r\n',
+])
+def test_extract_response_from_unchunked_data(data):
+    with pytest.raises(ValueError):
+        replay.extract_response_from_chunked_data(data)
+
+
+def test_chunked_decoder_incremental():
+    data = b'5\r\nHello\r\n7;ext\r\n, world\r\n0\r\nFoo: bar\r\n\r\n'
+    decoder = replay.ChunkedDecoder()
+
+    payload = b''.join(decoder.feed(data[i:i + 3])
+                       for i in range(0, len(data), 3))
+
+    assert payload == b'Hello, world'
+    assert decoder.done
+    assert decoder.trailers == [b'Foo: bar']
+
+
+def test_build_memento_response_inline_headers():
+    cdxj_line = 'us,memento)/ 20130202100000 ' + json.dumps({
+        'locator': 'urn:ipfs/QmHeader/QmPayload',
+        'status_code': '200',
+        'mime_type': 'text/plain',
+        'headers': [['Content-Type', 'text/plain'],
+                    ['X-Archive-Orig-Server', 'nginx']]
+    })
+
+    resp = replay.build_memento_response(
+        cdxj_line, None, b'Hello', 'http://localhost:5000/')
+
+    assert resp.get_data() == b'Hello'
+    assert resp.headers['Content-Type'] == 'text/plain'
+    assert resp.headers['X-Archive-Orig-Server'] == 'nginx'
+    assert resp.headers['ETag'] == '"QmPayload"'
+    assert 'X-Headers-Generated-By' not in resp.headers
+
+
+@pytest.mark.parametrize('encoding', ['binary', None])
+def test_build_memento_response_encrypted(encoding):
+    header = b'HTTP/1.1 200 OK\r\nContent-Type: text/plain'
+    payload = b'Hello'
+    (header, payload, nonce) = indexer.encrypt(
+        header, payload, util.derive_encryption_key('ipwb'))
+    json_object = {
+        'locator': 'urn:ipfs/QmHeader/QmPayload',
+        'status_code': '200',
+        'mime_type': 'text/plain',
+        'encryption_key': 'ipwb',
+        'encryption_method': 'aes',
+        'encryption_nonce': nonce
+    }
+    if encoding is None:  # Indexed by older versions
+        (header, payload) = (b64encode(header), b64encode(payload))
+    else:
+        json_object['encryption_encoding'] = encoding
+
+    resp = replay.build_memento_response(
+        'us,memento)/ 20130202100000 ' + json.dumps(json_object),
+        header, payload, 'http://localhost:5000/')
+
+    assert resp.get_data() == b'Hello'
+    assert resp.headers['Content-Type'] == 'text/plain'
+
+
+@pytest.mark.parametrize('mime,accept_encoding,compressed_first,passed', [
+    ('text/plain', 'gzip, deflate', None, True),
+    ('text/plain', 'deflate;q=0, gzip', None, False),
+    ('text/plain', None, None, False),
+    ('text/html', 'gzip, deflate', None, False),
+    ('text/plain', 'deflate', True, True),
+    ('text/plain', 'deflate', False, False),
+])
+def test_build_memento_response_compressed(mime, accept_encoding,
+                                           compressed_first, passed):
+    header = f'HTTP/1.1 200 OK\r\nContent-Type: {mime}'.encode()
+    payload = b'<p>Hello</p>' * 100
+    json_object = {
+        'locator': 'urn:ipfs/QmHeader/QmPayload',
+        'status_code': '200',
+        'mime_type': mime,
+        'compression': 'zlib'
+    }
+    (header, payload) = (zlib.compress(header), zlib.compress(payload))
+    if compressed_first is not None:
+        if compressed_first:
+            (header, payload, nonce) = indexer.encrypt(
+                header, payload, util.derive_encryption_key('ipwb'))
+        else:
+            (header, payload, nonce) = indexer.encrypt(
+                zlib.decompress(header), zlib.decompress(payload),
+                util.derive_encryption_key('ipwb'))
+            (header, payload) = (zlib.compress(header),
+                                 zlib.compress(payload))
+        json_object.update({'encryption_key': 'ipwb',
+                            'encryption_method': 'aes',
+                            'encryption_nonce': nonce,
+                            'encryption_encoding': 'binary',
+                            'compressed_first': compressed_first})
+
+    resp = replay.build_memento_response(
+        'us,memento)/ 20130202100000 ' + json.dumps(json_object),
+        header, payload, 'http://localhost:5000/', accept_encoding)
+
+    data = resp.get_data()
+    assert resp.headers['Content-Type'] == mime
+    assert resp.headers['Vary'] == 'Accept-Encoding'
+    if passed:
+        assert resp.headers['Content-Encoding'] == 'deflate'
+        data = zlib.decompress(data)
+    else:
+        assert 'Content-Encoding' not in resp.headers
+    assert b'<p>Hello</p>' * 100 in data
+
+    # The compressed and decompressed payloads are told apart by their tag
+    etag = replay.get_memento_etag(json_object, accept_encoding)
+    assert resp.headers['ETag'] == f'"{etag}"'
+    assert etag.endswith('-deflate') == passed
+    assert replay.is_not_modified(resp.headers['ETag'], etag)
+    assert replay.is_not_modified(
+        resp.headers['ETag'],
+        replay.get_memento_etag(json_object, 'identity')) != passed
+
+
+@pytest.mark.parametrize('window', [(0, 1), (5, 37), (16, 32), (999, 1000)])
+def test_build_memento_response_encrypted_range(window):
+    header = b'HTTP/1.1 200 OK\r\nContent-Type: text/plain'
+    payload = bytes(range(256)) * 4
+    (header, encrypted, nonce) = indexer.encrypt(
+        header, payload, util.derive_encryption_key('ipwb'))
+    json_object = {
+        'locator': 'urn:ipfs/QmHeader/QmPayload',
+        'status_code': '200',
+        'mime_type': 'text/plain',
+        'payload_length': len(payload),
+        'encryption_key': 'ipwb',
+        'encryption_method': 'aes',
+        'encryption_nonce': nonce,
+        'encryption_encoding': 'binary'
+    }
+    assert replay.get_payload_window(
+        json_object, f'bytes={window[0]}-{window[1] - 1}') == window
+
+    (start, stop) = window
+    resp = replay.build_memento_response(
+        'us,memento)/ 20130202100000 ' + json.dumps(json_object),
+        header, encrypted[start:stop], 'http://localhost:5000/',
+        payload_window=window)
+
+    assert resp.status_code == 206
+    assert resp.get_data() == payload[start:stop]
+    assert resp.headers['Content-Range'] == f'bytes {start}-{stop - 1}/1024'
+    assert resp.headers['Content-Type'] == 'text/plain'
+
+
+@pytest.mark.parametrize('json_update,range_header,if_range', [
+    ({}, None, None),
+    ({'mime_type': 'text/html'}, 'bytes=0-9', None),
+    ({'compression': 'zlib'}, 'bytes=0-9', None),
+    ({'status_code': '404'}, 'bytes=0-9', None),
+    ({}, 'bytes=0-9', '"QmOther"'),
+    ({}, 'items=0-9', None),
+])
+def test_payload_window_whole(json_update, range_header, if_range):
+    json_object = {'locator': 'urn:ipfs/QmHeader/QmPayload',
+                   'status_code': '200', 'mime_type': 'text/plain',
+                   'payload_length': 100}
+    json_object.update(json_update)
+
+    assert replay.get_payload_window(
+        json_object, range_header, if_range) is None
+
+
+@pytest.mark.parametrize('range_header,status,content,content_range', [
+    ('bytes=10-19', 206, b'0123456789', 'bytes 10-19/100'),
+    ('bytes=500-600', 416, None, 'bytes */100'),
+])
+def test_show_memento_range(range_header, status, content, content_range):
+    stored = {'QmHeader': b'HTTP/1.1 200 OK\r\nContent-Type: text/plain',
+              'QmPayload': b'0123456789' * 10}
+
+    def cat(ipfs_hash, offset=0, length=None):
+        return stored[ipfs_hash][offset:None if length is None
+                                 else offset + length]
+
+    cdxj_line = 'us,memento)/ 20130202100000 ' + json.dumps({
+        'locator': 'urn:ipfs/QmHeader/QmPayload', 'status_code': '200',
+        'mime_type': 'text/plain', 'payload_length': 100})
+    resolved = ('20130202100000', '<http://memento.us/>; rel="original"',
+                'memento.us/')
+    client = replay.app.test_client()
+
+    with patch('ipwb.util.daemon_health', util.DaemonHealth()), \
+            patch('ipwb.replay.resolve_memento', return_value=resolved), \
+            patch('ipwb.replay.get_memento_cdxj_line',
+                  return_value=cdxj_line), \
+            patch('ipwb.replay.ipfs_client') as ipfs_client:
+        ipfs_client.return_value.cat.side_effect = cat
+        resp = client.get('/memento/20130202100000/memento.us/',
+                          headers={'Range': range_header})
+
+    assert resp.status_code == status
+    assert resp.headers['Content-Range'] == content_range
+    if content is not None:
+        assert resp.get_data() == content
+
+
+@pytest.mark.parametrize('encryption_key,encrypt_first', [
+    (None, True), ('ipwb', True), ('ipwb', False)
+])
+def test_frames_range(encryption_key, encrypt_first):
+    stored = {}
+
+    def push_bytes_to_ipfs(content):
+        stored[str(len(stored))] = content
+        return str(len(stored) - 1)
+
+    def cat(ipfs_hash, offset=0, length=None):
+        assert length is not None
+        return stored[ipfs_hash][offset:offset + length]
+
+    warc_path = os.path.join(os.path.dirname(__file__), '..', 'samples',
+                             'warcs', 'frogTest.warc')
+    with patch('ipwb.indexer.push_bytes_to_ipfs',
+               side_effect=push_bytes_to_ipfs):
+        cdxj_lines = indexer.index_file_at(
+            warc_path, encryption_key, 6, encrypt_first, quiet=True,
+            frame_size=4096)
+
+    served = 0
+    for cdxj_line in cdxj_lines:
+        if cdxj_line.startswith('!'):
+            continue
+        json_object = json.loads(cdxj_line.split(' ', 2)[2])
+        assert json_object['compression'] == 'zlib-frames'
+        (header, payload) = [
+            stored[d] for d in json_object['locator'].split('/')[-2:]]
+        whole = replay.build_memento_response(
+            cdxj_line, header, payload, 'http://localhost:5000/')
+        length = json_object['payload_length']
+        if 'text/html' not in json_object['mime_type']:
+            assert len(whole.get_data()) == length
+        if not replay.is_seekable(json_object) or length < 10000:
+            continue
+
+        window = replay.get_payload_window(json_object, 'bytes=5000-9999')
+        payload = replay.fetch_payload_window(
+            cat, json_object['locator'].split('/')[-1], json_object, window)
+        resp = replay.build_memento_response(
+            cdxj_line, header, payload, 'http://localhost:5000/',
+            payload_window=window)
+
+        assert resp.status_code == 206
+        assert resp.get_data() == whole.get_data()[5000:10000]
+        assert resp.headers['Content-Range'] == f'bytes 5000-9999/{length}'
+        served += 1
+
+    # Ciphertexts compressed in frames are seekable, not the other way round
+    assert bool(served) == encrypt_first
+
+
+def test_memento_etag():
+    json_object = {'locator': 'urn:ipfs/QmHeader/QmPayload',
+                   'mime_type': 'image/png'}
+    etag = replay.get_memento_etag(json_object)
+
+    assert etag == 'QmPayload'
+    assert replay.is_not_modified('"QmPayload"', etag)
+    assert replay.is_not_modified('W/"QmPayload", "QmOther"', etag)
+    assert replay.is_not_modified('*', etag)
+    assert not replay.is_not_modified('"QmOther"', etag)
+    assert not replay.is_not_modified(None, etag)
+
+    json_object['mime_type'] = 'text/html'
+    assert replay.get_memento_etag(json_object) != etag
+
+
+def test_not_modified_response():
+    resp = replay.generate_not_modified_response(
+        'QmPayload', '20130202100000')
+
+    assert resp.status_code == 304
+    assert resp.headers['ETag'] == '"QmPayload"'
+    assert 'immutable' in resp.headers['Cache-Control']
+    assert resp.get_data() == b''
+
+
+def test_uris_page():
+    index = CDXJIndex('\n'.join([
+        'com,example)/ 20200101000000 {"mime_type": "text/html", '
+        '"status_code": "200", "title": "Example"}',
+        'com,example)/ 20210101000000 {"mime_type": "text/html", '
+        '"status_code": "301"}',
+        'com,example)/a 20200101000000 {"mime_type": "image/png", '
+        '"status_code": "200"}',
+        'org,example)/ 20200101000000 {"mime_type": "text/plain", '
+        '"status_code": "200"}'
+    ]))
+
+    (uris, cursor) = replay.get_uris_page(index, '', None, 2)
+    assert [u['uri'] for u in uris] == ['example.com/', 'example.com/a']
+    assert uris[0]['mementos'] == [
+        {'datetime': '20200101000000', 'mime': 'text/html',
+         'status': '200', 'title': 'Example'},
+        {'datetime': '20210101000000', 'mime': 'text/html',
+         'status': '301'}
+    ]
+    assert cursor == 'com,example)/a'
+
+    (uris, cursor) = replay.get_uris_page(index, '', cursor, 2)
+    assert [u['uri'] for u in uris] == ['example.org/']
+    assert cursor is None
+
+    (uris, cursor) = replay.get_uris_page(index, 'org,', None, 2)
+    assert [u['uri'] for u in uris] == ['example.org/']
+
+
+def test_uris_api():
+    sample_index = 'samples/indexes/sample-1.cdxj'
+    client = replay.app.test_client()
+
+    with patch('ipwb.util.get_ipwb_replay_index_path',
+               return_value=sample_index):
+        first = client.get('/ipwbapi/uris?limit=10').get_json()
+        second = client.get(
+            f'/ipwbapi/uris?limit=10&cursor={first["cursor"]}').get_json()
+        yahoo = client.get(
+            '/ipwbapi/uris?prefix=search.yahoo.com').get_json()
+        invalid = client.get('/ipwbapi/uris?limit=ten')
+
+    assert len(first['uris']) == 10
+    assert first['uris'][0]['uri'] == 'search.yahoo.com/mrss/'
+    assert len(second['uris']) == 10
+    assert second['uris'][0]['uri'] != first['uris'][-1]['uri']
+    assert [u['uri'] for u in yahoo['uris']] == ['search.yahoo.com/mrss/']
+    assert yahoo['cursor'] is None
+    assert invalid.status_code == 400
+
+
+@pytest.mark.parametrize('urir,expected', [
+    ('example.com/', ('example.com/', 'exact')),
+    ('example.com/*', ('example.com/', 'prefix')),
+    ('example.com/blog*', ('example.com/blog', 'prefix')),
+    ('*.example.com', ('example.com', 'domain')),
+    ('*.example.com/*', ('example.com/', 'domain')),
+])
+def test_parse_urir_query(urir, expected):
+    assert replay.parse_urir_query(urir) == expected
+
+
+def test_cdxj_query_api():
+    sample_index = 'samples/indexes/sample-1.cdxj'
+    client = replay.app.test_client()
+
+    with patch('ipwb.util.get_ipwb_replay_index_path',
+               return_value=sample_index):
+        blogs = client.get(
+            '/ipwbapi/cdxj?url=bitchmagazine.org/blogs/*').get_data(True)
+        domain = client.get('/ipwbapi/cdxj?url=bitchmagazine.org'
+                            '&matchType=domain&limit=5').get_data(True)
+        listing = client.get('/memento/*/*.yahoo.com')
+        invalid = client.get('/ipwbapi/cdxj?url=a.com&matchType=any')
+
+    assert len(blogs.splitlines()) == 4
+    assert all(line.startswith('org,bitchmagazine)/blogs/')
+               for line in blogs.splitlines())
+    assert len(domain.splitlines()) == 5
+    assert listing.status_code == 200
+    assert '/memento/20130411205500/search.yahoo.com/mrss/' in \
+        listing.get_data(True)
+    assert invalid.status_code == 400
+
+
+def test_federated_indexes():
+    index_paths = ['samples/indexes/sample-1.cdxj',
+                   'samples/indexes/salam-home.cdxj']
+    client = replay.app.test_client()
+
+    with patch('ipwb.util.get_ipwb_replay_index_path',
+               return_value=index_paths):
+        uris = client.get('/ipwbapi/uris?limit=1000').get_json()['uris']
+        salam = client.get('/memento/*/cs.odu.edu/~salam/')
+        landing_page = client.get('/').get_data(True)
+        admin_page = client.get('/ipwbadmin').get_data(True)
+
+    assert len(uris) == 66
+    assert salam.status_code == 302
+    assert ', '.join(index_paths) in landing_page
+    assert f'{index_paths[0]}</a> (65 / 65)' in admin_page
+    assert f'{index_paths[1]}</a> (1 / 1)' in admin_page
+
+
+def test_federated_indexes_same_record(tmp_path):
+    record = ('com,example)/ 20200101000000 {"locator": "urn:ipfs/a/b", '
+              '"mime_type": "text/html", "status_code": "200"}')
+    index_paths = [str(tmp_path / 'first.cdxj'),
+                   str(tmp_path / 'second.cdxj')]
+    for index_path in index_paths:
+        with open(index_path, 'w') as f:
+            f.write(f'{record}\n')
+    client = replay.app.test_client()
+
+    with patch('ipwb.util.get_ipwb_replay_index_path',
+               return_value=index_paths):
+        resp = client.get('/memento/*/example.com/')
+
+    # Captured once, although in both indexes
+    assert resp.status_code == 302
+    assert resp.headers['Location'].endswith(
+        '/memento/20200101000000/example.com/')
+
+
+def test_missing_urir():
+    client = replay.app.test_client()
+
+    with patch('ipwb.util.get_ipwb_replay_index_path',
+               return_value='samples/indexes/sample-1.cdxj'), \
+            patch('ipwb.replay.get_cdxj_lines_with_urir',
+                  side_effect=AssertionError):
+        resp = client.get('/memento/20130101000000/example.com/missing')
+
+    assert resp.status_code == 404
+    assert 'Link' not in resp.headers
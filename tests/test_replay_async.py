@@ -0,0 +1,132 @@
+import asyncio
+import json
+from unittest.mock import patch
+
+import pytest
+
+from ipwb import frames
+from ipwb.util import DaemonHealth
+
+httpx = pytest.importorskip('httpx')
+replay_async = pytest.importorskip('ipwb.replay_async')
+
+CDXJ_LINE = 'us,memento)/ 20130202100000 ' + json.dumps({
+    'locator': 'urn:ipfs/QmHeader/QmPayload',
+    'status_code': '200',
+    'mime_type': 'text/plain',
+    'original_uri': 'http://memento.us/',
+    'payload_length': 19
+})
+
+IPFS_CONTENTS = {
+    'QmHeader': b'HTTP/1.1 200 OK\r\nContent-Type: text/plain',
+    'QmPayload': b'Hello, async world!',
+    'QmFramedHeader': frames.compress_frames(
+        b'HTTP/1.1 200 OK\r\nContent-Type: text/plain', 6, 4),
+    'QmFramedPayload': frames.compress_frames(b'Hello, async world!', 6, 4)
+}
+
+
+def fake_ipfs_api(request):
+    params = request.url.params
+    content = IPFS_CONTENTS[params['arg']]
+    if 'offset' in params:
+        start = int(params['offset'])
+        content = content[start:start + int(params['length'])]
+
+    return httpx.Response(200, content=content)
+
+
+def get(path, headers=None):
+    async def fetch():
+        transport = httpx.ASGITransport(app=replay_async.application)
+        async with httpx.AsyncClient(transport=transport,
+                                     base_url='http://localhost:5000') as c:
+            return await c.get(path, headers=headers)
+
+    return asyncio.run(fetch())
+
+
+@pytest.fixture
+def fake_ipfs():
+    client = httpx.AsyncClient(base_url='http://localhost:5001',
+                               transport=httpx.MockTransport(fake_ipfs_api))
+    resolved = ('20130202100000', '<http://memento.us/>; rel="original"',
+                'memento.us/')
+
+    with patch('ipwb.replay_async._ipfs_http_client', client), \
+            patch('ipwb.util.daemon_health', DaemonHealth()), \
+            patch('ipwb.replay.resolve_memento', return_value=resolved), \
+            patch('ipwb.replay.get_memento_cdxj_line',
+                  return_value=CDXJ_LINE):
+        yield
+
+
+def test_async_memento(fake_ipfs):
+    resp = get('/memento/20130202100000/memento.us/')
+
+    assert resp.status_code == 200
+    assert resp.content == b'Hello, async world!'
+    assert resp.headers['Memento-Datetime'] == 'Sat, 02 Feb 2013 10:00:00 GMT'
+    assert resp.headers['Link'] == '<http://memento.us/>; rel="original"'
+    assert resp.headers['Server'].startswith('InterPlanetary Wayback Replay')
+
+
+def test_async_memento_redirect(fake_ipfs):
+    resp = get('/memento/2013/memento.us/')
+
+    assert resp.status_code == 302
+    assert resp.headers['Location'] == '/memento/20130202100000/memento.us/'
+
+
+def test_async_invalid_datetime(fake_ipfs):
+    resp = get('/memento/20181301000000/memento.us/')
+
+    assert resp.status_code == 400
+
+
+def test_async_memento_not_modified(fake_ipfs):
+    with patch('ipwb.replay_async.cat', side_effect=AssertionError):
+        resp = get('/memento/20130202100000/memento.us/',
+                   headers={'If-None-Match': '"QmPayload"'})
+
+    assert resp.status_code == 304
+    assert resp.headers['ETag'] == '"QmPayload"'
+
+
+@pytest.mark.parametrize('range_header,status,content,content_range', [
+    ('bytes=7-11', 206, b'async', 'bytes 7-11/19'),
+    ('bytes=-6', 206, b'world!', 'bytes 13-18/19'),
+    ('bytes=0-1,3-4', 200, b'Hello, async world!', None),
+    ('bytes=19-', 416, None, 'bytes */19'),
+])
+def test_async_memento_range(fake_ipfs, range_header, status, content,
+                             content_range):
+    resp = get('/memento/20130202100000/memento.us/',
+               headers={'Range': range_header})
+
+    assert resp.status_code == status
+    assert resp.headers.get('Content-Range') == content_range
+    if content is not None:
+        assert resp.content == content
+        assert resp.headers['Accept-Ranges'] == 'bytes'
+
+
+def test_async_memento_range_frames(fake_ipfs):
+    cdxj_line = 'us,memento)/ 20130202100000 ' + json.dumps({
+        'locator': 'urn:ipfs/QmFramedHeader/QmFramedPayload',
+        'status_code': '200',
+        'mime_type': 'text/plain',
+        'payload_length': 19,
+        'compression': 'zlib-frames',
+        'frame_size': 4
+    })
+
+    with patch('ipwb.replay.get_memento_cdxj_line', return_value=cdxj_line):
+        resp = get('/memento/20130202100000/memento.us/',
+                   headers={'Range': 'bytes=7-11'})
+        whole = get('/memento/20130202100000/memento.us/')
+
+    assert resp.status_code == 206
+    assert resp.content == b'async'
+    assert whole.content == b'Hello, async world!'
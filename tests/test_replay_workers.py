@@ -0,0 +1,36 @@
+from unittest.mock import patch
+
+import pytest
+
+from ipwb.backends import CDXJIndex, load_index
+from pathlib import Path
+
+replay_workers = pytest.importorskip('ipwb.replay_workers')
+
+SAMPLE_INDEX = str(
+    Path(__file__).parent.parent / 'samples/indexes/salam-home.cdxj'
+)
+
+
+def test_worker_options():
+    app = replay_workers.ReplayApplication(
+        replay_workers.get_options(workers=4, threads=8))
+
+    assert app.cfg.workers == 4
+    assert app.cfg.threads == 8
+    assert app.cfg.preload_app is True
+
+
+def test_preload_index():
+    with patch('gc.freeze') as freeze:
+        replay_workers.preload_index(SAMPLE_INDEX)
+
+    assert freeze.called
+
+    with patch('ipwb.backends.CDXJIndex', side_effect=AssertionError):
+        # Already in memory, nothing is loaded again in the workers
+        index = load_index(SAMPLE_INDEX)
+
+    assert isinstance(index, CDXJIndex)
+    assert len(index) == 1
+    assert index._summary is not None
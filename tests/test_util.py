@@ -47,3 +47,43 @@ def test_pad_digits14(expected, input):
 def test_pad_digits14_inalid(input):
     with pytest.raises(ValueError):
         util.pad_digits14(input, validate=True)
+
+
+@pytest.mark.parametrize('expected,input', [
+    ('http://localhost:5001', '/dns/localhost/tcp/5001/http'),
+    ('http://127.0.0.1:5001', '/ip4/127.0.0.1/tcp/5001/http'),
+    ('http://[::1]:5001', '/ip6/::1/tcp/5001/http'),
+    ('https://ipfs.example.com:443', '/dns4/ipfs.example.com/tcp/443/https'),
+])
+def test_multiaddr_to_url(expected, input):
+    assert expected == util.multiaddr_to_url(input)
+
+
+@pytest.mark.parametrize('expected,a,b', [
+    (True, '0.4.9', '0.4.10'),
+    (False, '0.4.10', '0.4.10'),
+    (False, '0.5.0-rc1', '0.4.10'),
+    (True, 'v0.2020.07.10.1854', '0.2021.01.01'),
+])
+def test_compare_versions(expected, a, b):
+    assert expected == util.compare_versions(a, b)
+
+
+@pytest.mark.parametrize('expected,input', [
+    ('com,example)/', 'http://example.com/'),
+    ('com,example)/a/', 'https://www.example.com/a/'),
+    ('com,example)/a?b=1&c=2', 'http://example.com/a?c=2&b=1'),
+])
+def test_uri_to_surt(expected, input):
+    assert expected == util.uri_to_surt(input)
+    assert expected == util.uri_to_surt(input)  # Memoized
+
+
+@pytest.mark.parametrize('expected,input', [
+    ('Content-Type', 'Content-Type'),
+    ('location', 'location'),
+    ('X-Archive-Orig-Server', 'Server'),
+    ('X-Archive-Orig-Transfer-Encoding', 'Transfer-Encoding'),
+])
+def test_archived_header_name(expected, input):
+    assert expected == util.archived_header_name(input)